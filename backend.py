@@ -3,12 +3,52 @@ FastAPI Chat Backend
 - Auth: JWT (RS256) verification using a PUBLIC key (no signing required)
 - Resources: Convos (rooms) and Messages
 - Endpoints:
-  * GET /convos?since=ISO-8601
-  * GET /messages?since=ISO-8601
+  * GET /convos/sync?since=<unix ts>&limit=&cursor=[&stream=true]
+    Each convo carries the caller's chat-list summary (last_message preview, message_count,
+    unread_count) from the convo_summaries projection, read in the same query.
+  * GET /messages/sync?since=<unix ts>&limit=&cursor=[&stream=true]
+    Pages are keyset-ordered on (updated_at, id), newest first. The opaque cursor for
+    the next page is returned in the X-Next-Cursor header. stream=true returns NDJSON
+    read with yield_per, so memory stays flat however large the backlog is.
+  * GET /sync?after_seq=N&limit=
+    Every change to a Convo or Message gets a gap-free per-convo seq and a row in the
+    global change log; this returns exactly the changes after N plus next_after_seq.
+  * GET /convos/{id}/messages?before=&limit=
+    One convo's history, newest first, paging backward on (created_at, id). Pages carry
+    an ETag derived from the convo's seq, so an unchanged page revalidates as 304.
+    Pages run on into the archive once the convo's hot messages are exhausted.
+  * GET /search?q=&convo_id=&cursor=&limit=
+    Full-text search over the caller's convos, best match first (SQLite FTS5 with bm25;
+    a LIKE scan on other engines). The index is updated in the same transaction as the
+    message write; `python backend.py rebuild-search` repopulates it from scratch.
+  * GET /convos/{id}/receipts
+  * POST /attachments {size, filename, content_type, sha256?} then PUT /attachments/{id} with
+    Content-Range chunks (resumable from `received`); GET /attachments/{id}[/content]
+    Files are stored once per sha256 under ATTACHMENT_DIR; messages carry only attachment
+    ids ({attachments: [id]} on send, metadata on the way out). Downloads honour Range.
+  * POST /messages/bulk  {messages: [{convo_id, local_id, content}]}  (outbox replay)
+  * GET /metrics  (Prometheus text: handler/DB/fan-out latency, connections, queue depth)
 - WebSocket: /ws for realtime events
-  * Events: CREATE_CONVO, UPDATE_CONVO, SEND_MESSAGE, DELETE_MESSAGE, UPDATE_MESSAGE,
-            MESSAGE_DELIVERED, MESSAGE_SEEN
+  * Subprotocols: "chat.v1.msgpack" (binary MessagePack frames) or "chat.v1.json"; clients
+    that offer neither get JSON text frames. Per-message deflate is negotiated when offered.
+  * Events: CREATE_CONVO, UPDATE_CONVO, SEND_MESSAGE, SEND_MESSAGES, DELETE_MESSAGE, UPDATE_MESSAGE,
+            MESSAGE_DELIVERED, MESSAGE_SEEN (range acks: {convo_id, upto_seq}), TYPING, PRESENCE
+  * Receipts are per-participant delivered_upto/seen_upto watermarks; the server
+    broadcasts them as coalesced RECEIPTS events, at most one per convo per interval.
+  * Presence and typing live only in memory. Connect with ?presence=1 (or send PRESENCE)
+    for one snapshot of your convo peers; PRESENCE updates follow, debounced on disconnect.
+  * Broadcast events carry an event_id; HELLO carries stream_id and the latest event_id.
+    Reconnect with ?last_event_id=&stream_id= to have missed events replayed from memory
+    (followed by RESUMED), or get RESYNC_REQUIRED when the gap is no longer buffered.
+  * Rate limits: token buckets per connection and per (user, event type), plus a global
+    cap on DB-bound handlers in flight. Rejected events get {"type": "ERROR",
+    "code": "RATE_LIMITED", "event", "retry_after"} (POST /messages/bulk: 429 + Retry-After).
 - Idempotency: (sender_id, local_id) unique to prevent duplicate messages
+- Hot/cold tiering: `python backend.py archive [days]` moves messages older than
+  ARCHIVE_AFTER_DAYS into compressed per-convo segments (message_archive_segments).
+  History, /sync and FTS5 search still return them; they can no longer be edited or
+  deleted, and /messages/sync?since= only covers the hot tier. A resend of an archived
+  message's local_id is still answered with the stored message.
 - Data model: SQLite + SQLAlchemy (replace with your DB of choice)
 
 Notes on user details from JWT:
@@ -19,24 +59,55 @@ Notes on user details from JWT:
 
 Run:
   uvicorn app:app --reload
+  python backend.py        # same, with the websocket settings below
+  python backend.py rebuild-search   # repopulate the search index from the messages table
+  python backend.py rebuild-summaries  # recompute convo_summaries from participants and messages
+  python backend.py archive [days]     # move older messages to the archive (e.g. daily from cron)
+  python backend.py gc-attachments [hours]  # drop abandoned or unattached uploads and their files
+  python -m pytest -q tests           # invariant tests on a scratch SQLite file
 
 Env:
-  PUBLIC_KEY_PEM=""
+  PUBLIC_KEY_PEM=""        # unset: development mode, the bearer token is the Django user id
+  INTERNAL_API_TOKEN=""    # enables POST /internal/users/{id}/invalidate
+  LOG_LEVEL=INFO           # DEBUG logs every inbound frame (rate-limited per message)
+  WS_PER_MESSAGE_DEFLATE=1 # permessage-deflate for clients that offer it
+  ARCHIVE_AFTER_DAYS=90    # age at which `archive` moves a message to the cold tier
+  WS_RATE_LIMITS="SEND_MESSAGE=10/30,CREATE_CONVO=0.2/5"  # per-user rate/burst overrides
+  WS_CONN_RATE=50 WS_CONN_BURST=100  # frames per connection; WS_ADMISSION_MAX / _WAIT_MS
+  ATTACHMENT_DIR=./attachments  ATTACHMENT_MAX_BYTES=104857600
+  ATTACHMENT_ACCEL_PREFIX=""  # set to serve downloads through nginx X-Accel-Redirect
 """
 
 from __future__ import annotations
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from enum import Enum
-from typing import Any, Dict, List, Optional
+from typing import Any, Deque, Dict, List, Optional
 
+import asyncio
+import base64
+import bisect
+import contextlib
+import hashlib
+import heapq
+import itertools
 import json
+import logging
 import os
+import re
+import sys
+import threading
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
 
-from fastapi import Depends, FastAPI, HTTPException, Query, WebSocket, WebSocketDisconnect, Header
-from fastapi.responses import JSONResponse
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect, Header
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
-from jose import jwt
+from jose import jwk, jwt
 from jose.exceptions import JWTError
 from uuid import uuid4
 
@@ -44,28 +115,251 @@ from sqlalchemy import (
     Column,
     String,
     Integer,
+    BigInteger,
     DateTime,
     Boolean,
     ForeignKey,
     Text,
+    LargeBinary,
     UniqueConstraint,
+    Index,
     create_engine,
     func,
     select,
+    update,
+    insert,
+    delete,
+    case,
     and_,
     or_,
     event as sqla_event,
+    text,
+    bindparam,
+    inspect as sqla_inspect,
 )
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker, Session
 
+# Optional speedups for the websocket wire formats (see WS_SUBPROTOCOL_*).
+try:
+    import orjson
+except ImportError:  # stdlib json fallback
+    orjson = None
+try:
+    import msgpack
+except ImportError:  # the msgpack subprotocol is simply not offered
+    msgpack = None
+
 # -----------------------------
 # DB setup
 # -----------------------------
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./chat.db")
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {})
+
+# Storage profile. SQLite gets WAL + synchronous=NORMAL (durable across app
+# crashes, one fsync per checkpoint instead of per commit), a large page cache and
+# mmap reads; other engines get a sized, pre-pinged pool.
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+    "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", str(-64 * 1024))),  # negative = KiB
+    "temp_store": "MEMORY",
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+}
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "16"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "16"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+def make_engine(url: str):
+    if not url.startswith("sqlite"):
+        return create_engine(url, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_pre_ping=True, pool_recycle=DB_POOL_RECYCLE)
+    eng = create_engine(url, connect_args={"check_same_thread": False})
+
+    @sqla_event.listens_for(eng, "connect")
+    def _sqlite_pragmas(dbapi_conn, _record):
+        cur = dbapi_conn.cursor()
+        for name, value in SQLITE_PRAGMAS.items():
+            cur.execute(f"PRAGMA {name}={value}")
+        cur.close()
+
+    # SQLite has no row locks and pysqlite only opens a transaction at the first
+    # write, so SELECT ... FOR UPDATE would lock nothing. Give it its intended
+    # meaning: take the database write lock (BEGIN IMMEDIATE, waiting up to
+    # busy_timeout) before the locking read, so what it returns stays current
+    # until commit. Inside a transaction pysqlite already holds the write lock.
+    @sqla_event.listens_for(eng, "before_cursor_execute")
+    def _sqlite_for_update(conn, cursor, statement, parameters, context, executemany):
+        compiled = getattr(context, "compiled", None)
+        if compiled is not None and getattr(compiled.statement, "_for_update_arg", None) is not None:
+            if not conn.connection.dbapi_connection.in_transaction:
+                cursor.execute("BEGIN IMMEDIATE")
+
+    return eng
+
+engine = make_engine(DATABASE_URL)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
 Base = declarative_base()
 
+# -----------------------------
+# Metrics and logging
+# -----------------------------
+# In-process counters and histograms, rendered in the Prometheus text format by
+# GET /metrics. Recording is a dict lookup and a few additions under one lock,
+# cheap enough to leave on in production.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 1000)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """Registry of labelled counters and histograms plus gauges read at scrape time."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.families: Dict[str, tuple] = {}  # name -> (kind, help, buckets)
+        self.series: Dict[str, Dict[tuple, Any]] = {}  # name -> labels -> value or Histogram
+        self.collectors: Dict[str, Any] = {}  # name -> fn() -> number or [(labels, number)]
+
+    def counter(self, name: str, help: str):
+        self.families[name] = ("counter", help, None)
+        self.series[name] = {}
+
+    def histogram(self, name: str, help: str, buckets=LATENCY_BUCKETS):
+        self.families[name] = ("histogram", help, buckets)
+        self.series[name] = {}
+
+    def gauge(self, name: str, help: str, fn, kind: str = "gauge"):
+        self.families[name] = (kind, help, None)
+        self.collectors[name] = fn
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series[name]
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series[name]
+            h = series.get(key)
+            if h is None:
+                h = series[key] = Histogram(self.families[name][2])
+            h.observe(value)
+
+    @staticmethod
+    def _labels(pairs) -> str:
+        if not pairs:
+            return ""
+        esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            snapshot = {name: dict(series) for name, series in self.series.items()}
+            hists = {name: {k: (list(h.counts), h.sum, h.count) for k, h in series.items()}
+                     for name, series in self.series.items() if self.families[name][0] == "histogram"}
+        for name, (kind, help, buckets) in self.families.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if name in self.collectors:
+                value = self.collectors[name]()
+                rows = value if isinstance(value, list) else [({}, value)]
+                for labels, v in rows:
+                    lines.append(f"{name}{self._labels(sorted(labels.items()))} {v}")
+            elif kind == "histogram":
+                for key, (counts, total, count) in hists[name].items():
+                    cumulative = 0
+                    for le, c in zip(list(buckets) + ["+Inf"], counts):
+                        cumulative += c
+                        lines.append(f"{name}_bucket{self._labels(key + (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{self._labels(key)} {total}")
+                    lines.append(f"{name}_count{self._labels(key)} {count}")
+            else:
+                for key, v in snapshot[name].items():
+                    lines.append(f"{name}{self._labels(key)} {v}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.counter("chat_ws_events_total", "Inbound websocket events by type and outcome")
+metrics.histogram("chat_ws_handler_seconds", "Time to handle one inbound event, excluding fan-out")
+metrics.histogram("chat_ws_event_db_seconds", "DB time spent on behalf of one inbound event")
+metrics.histogram("chat_db_seconds", "Time inside run_db calls by function")
+metrics.histogram("chat_fanout_recipients", "Sockets an event was queued for", COUNT_BUCKETS)
+metrics.histogram("chat_fanout_seconds", "Time to encode an event and queue it for every recipient")
+metrics.histogram("chat_ws_send_seconds", "Time to write one frame to a socket")
+metrics.counter("chat_ws_resumes_total", "Reconnects that asked to resume, by outcome")
+metrics.histogram("chat_ws_replayed_events", "Events replayed on a successful resume", COUNT_BUCKETS)
+metrics.histogram("chat_ws_order_wait_seconds", "Time an event waited behind earlier events with the same order key")
+metrics.counter("chat_ws_sent_bytes_total", "Encoded frame bytes written, before per-message compression")
+metrics.counter("chat_ws_received_bytes_total", "Frame bytes received")
+metrics.counter("chat_ws_outbound_dropped_total", "Frames dropped because the outbound queue was full")
+metrics.counter("chat_ws_slow_consumer_closes_total", "Sockets closed because the outbound queue was full")
+metrics.counter("chat_log_suppressed_total", "Log records dropped by the rate limiter")
+metrics.histogram("chat_search_seconds", "Time to run one /search query by index implementation")
+
+# DB time for the event being handled accumulates here (see run_db).
+_event_db_time: ContextVar[Optional[list]] = ContextVar("event_db_time", default=None)
+
+def charge_db_time(seconds: float):
+    acc = _event_db_time.get()
+    if acc is not None:
+        acc[0] += seconds
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_RATE_LIMIT = int(os.getenv("LOG_RATE_LIMIT", "20"))  # records per message per interval
+LOG_RATE_INTERVAL = float(os.getenv("LOG_RATE_INTERVAL", "10"))
+
+class RateLimitFilter(logging.Filter):
+    """Pass at most `limit` records per message template per interval.
+
+    The first record of the next window reports how many were suppressed.
+    """
+
+    def __init__(self, limit: int = LOG_RATE_LIMIT, interval: float = LOG_RATE_INTERVAL):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self.windows: Dict[str, list] = {}  # template -> [window start, passed, suppressed]
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        now = time.monotonic()
+        with self.lock:
+            w = self.windows.get(record.msg)
+            if w is None or now - w[0] >= self.interval:
+                suppressed = w[2] if w else 0
+                w = self.windows[record.msg] = [now, 0, 0]
+                if suppressed:
+                    record.msg = f"{record.msg} suppressed={suppressed}"
+            if w[1] >= self.limit:
+                w[2] += 1
+                metrics.inc("chat_log_suppressed_total")
+                return False
+            w[1] += 1
+            return True
+
+# key=value messages so lines can be grepped and parsed without a JSON formatter
+log = logging.getLogger("chat")
+log.setLevel(LOG_LEVEL)
+if not log.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+    log.addHandler(_handler)
+    log.propagate = False
+log.addFilter(RateLimitFilter())
+
 # -----------------------------
 # Models
 # -----------------------------
@@ -86,6 +380,7 @@ class Convo(Base):
     is_group = Column(Boolean, default=False)
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     updated_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), index=True)
+    seq = Column(Integer, nullable=False, default=0)  # last per-convo change seq handed out
     messages = relationship("Message", back_populates="convo")
 
 class ConvoParticipant(Base):
@@ -96,9 +391,16 @@ class ConvoParticipant(Base):
     role = Column(String, default="member")
     joined_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     last_read_at = Column(DateTime, nullable=True)
+    joined_seq = Column(Integer, nullable=True)  # convo seq of the change that added this participant
+    # receipt watermarks: every message with seq <= *_upto counts as delivered/seen
+    delivered_upto = Column(Integer, nullable=False, default=0)
+    seen_upto = Column(Integer, nullable=False, default=0)
     convo = relationship("Convo")
     user = relationship("DjangoUser")
-    __table_args__ = (UniqueConstraint("convo_id", "user_id", name="uq_convo_user"),)
+    __table_args__ = (
+        UniqueConstraint("convo_id", "user_id", name="uq_convo_user"),  # membership checks
+        Index("ix_participants_user_convo", "user_id", "convo_id"),  # user -> convos for sync joins
+    )
 
 class Message(Base):
     __tablename__ = "messages"
@@ -108,6 +410,7 @@ class Message(Base):
     sender_id = Column(Integer, ForeignKey("auth_user.id", ondelete="SET NULL"), index=True)
     content = Column(Text)
     deleted = Column(Boolean, default=False)
+    seq = Column(Integer, nullable=True)  # position in the convo, assigned once on insert
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     updated_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), index=True)
 
@@ -118,16 +421,830 @@ class Message(Base):
         UniqueConstraint("sender_id", "local_id", name="uq_sender_local_id"),
     )
 
-class MessageDelivery(Base):
-    __tablename__ = "message_deliveries"
+# Append-only change log: one row per change to a Convo or Message.
+# `seq` is global and monotonic and is the cursor for /sync?after_seq=;
+# `convo_seq` is gap-free within the convo (taken from Convo.seq under a row lock).
+class ChangeLog(Base):
+    __tablename__ = "change_log"
+    seq = Column(Integer, primary_key=True, autoincrement=True)
+    convo_id = Column(String, ForeignKey("convos.id", ondelete="CASCADE"), nullable=False)
+    convo_seq = Column(Integer, nullable=False)
+    entity = Column(String, nullable=False)  # "convo" | "message"
+    entity_id = Column(String, nullable=False)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    __table_args__ = (
+        UniqueConstraint("convo_id", "convo_seq", name="uq_change_convo_seq"),
+        Index("ix_change_log_convo_seq", "convo_id", "seq"),
+    )
+
+# Chat-list projection, one row per (convo, participant), kept current by the
+# message write paths (see "Conversation summaries") so /convos/sync can return
+# the last message and unread count without touching messages.
+class ConvoSummary(Base):
+    __tablename__ = "convo_summaries"
+    convo_id = Column(String, ForeignKey("convos.id", ondelete="CASCADE"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("auth_user.id", ondelete="CASCADE"), primary_key=True)
+    last_message_id = Column(String, nullable=True)
+    last_message_preview = Column(String, nullable=True)
+    last_sender_id = Column(Integer, nullable=True)
+    last_message_at = Column(DateTime, nullable=True)
+    message_count = Column(Integer, nullable=False, default=0)  # non-deleted messages
+    unread_count = Column(Integer, nullable=False, default=0)  # others' messages after seen_upto
+
+# Cold tier: messages moved out of `messages` by `python backend.py archive`, a
+# compressed run of up to ARCHIVE_SEGMENT_MAX messages of one convo per row
+# (see "Archive"). Segments are never updated in place and their ids never reused.
+class MessageArchiveSegment(Base):
+    __tablename__ = "message_archive_segments"
     id = Column(Integer, primary_key=True, autoincrement=True)
-    message_id = Column(String, ForeignKey("messages.id", ondelete="CASCADE"), index=True)
-    user_id = Column(Integer, ForeignKey("auth_user.id", ondelete="CASCADE"), index=True)
-    delivered_at = Column(DateTime, nullable=True)
-    seen_at = Column(DateTime, nullable=True)
-    __table_args__ = (UniqueConstraint("message_id", "user_id", name="uq_message_user"),)
+    convo_id = Column(String, ForeignKey("convos.id", ondelete="CASCADE"), nullable=False)
+    message_count = Column(Integer, nullable=False)
+    min_seq = Column(Integer, nullable=False)
+    max_seq = Column(Integer, nullable=False)
+    # (created_at, id) of the oldest and newest message, for history keysets
+    min_created_at = Column(DateTime, nullable=False)
+    min_id = Column(String, nullable=False)
+    max_created_at = Column(DateTime, nullable=False)
+    max_id = Column(String, nullable=False)
+    codec = Column(String, nullable=False)
+    raw_bytes = Column(Integer, nullable=False)  # encoded size before compression
+    data = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    __table_args__ = (
+        Index("ix_archive_segments_convo_max", "convo_id", "max_created_at", "max_id"),
+        Index("ix_archive_segments_convo_seq", "convo_id", "max_seq"),
+        {"sqlite_autoincrement": True},
+    )
+
+# message id -> archive segment, for lookups by id (/sync, search hits, edits).
+# (sender_id, local_id) carries the messages table's idempotency key over, so a
+# resend of an archived message is still recognised (see insert_messages).
+class MessageArchiveEntry(Base):
+    __tablename__ = "message_archive_index"
+    message_id = Column(String, primary_key=True)
+    segment_id = Column(Integer, ForeignKey("message_archive_segments.id", ondelete="CASCADE"), nullable=False, index=True)
+    sender_id = Column(Integer, nullable=True)
+    local_id = Column(String, nullable=True)
+    __table_args__ = (
+        UniqueConstraint("sender_id", "local_id", name="uq_archive_sender_local_id"),
+    )
+
+# One uploaded file. The row is also the resumable upload session until status
+# is "ready"; the bytes then live under ATTACHMENT_DIR named by their sha256, so
+# identical uploads share one file (see "Attachments").
+class Attachment(Base):
+    __tablename__ = "attachments"
+    id = Column(String, primary_key=True)
+    uploader_id = Column(Integer, ForeignKey("auth_user.id", ondelete="CASCADE"), nullable=False, index=True)
+    filename = Column(String, nullable=True)
+    content_type = Column(String, nullable=False, default="application/octet-stream")
+    size = Column(BigInteger, nullable=False)  # declared when the upload starts
+    received = Column(BigInteger, nullable=False, default=0)  # bytes stored so far
+    expected_sha256 = Column(String, nullable=True)  # optional client digest, checked on completion
+    sha256 = Column(String, nullable=True, index=True)  # set once complete
+    status = Column(String, nullable=False, default="uploading")  # "uploading" | "ready"
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    completed_at = Column(DateTime, nullable=True)
+
+# Attachment references of a message. No FK to messages: the message may have
+# moved to the archive. convo_id is what download access is checked against.
+class MessageAttachment(Base):
+    __tablename__ = "message_attachments"
+    message_id = Column(String, primary_key=True)
+    attachment_id = Column(String, ForeignKey("attachments.id", ondelete="CASCADE"), primary_key=True)
+    convo_id = Column(String, ForeignKey("convos.id", ondelete="CASCADE"), nullable=False)
+    position = Column(Integer, nullable=False, default=0)
+    __table_args__ = (Index("ix_message_attachments_attachment_convo", "attachment_id", "convo_id"),)
+
+def record_change(db: Session, convo: Convo, entity: str, entity_id: str) -> int:
+    """Assign the next per-convo seq to a change and append it to the change log.
+
+    The caller must hold the convo row (loaded with_for_update) and commit.
+    """
+    convo.seq = (convo.seq or 0) + 1
+    db.add(ChangeLog(convo_id=convo.id, convo_seq=convo.seq, entity=entity, entity_id=entity_id))
+    return convo.seq
+
+# Composite indexes matching the hot access paths. (sender_id, local_id) and
+# (convo_id, user_id) are already covered by their unique constraints.
+Index("ix_convos_updated_id", Convo.updated_at, Convo.id)  # /convos/sync keyset
+Index("ix_messages_convo_updated", Message.convo_id, Message.updated_at, Message.id)  # /messages/sync per-convo range
+Index("ix_messages_updated_id", Message.updated_at, Message.id)  # /messages/sync keyset
+Index("ix_messages_convo_seq", Message.convo_id, Message.seq)  # unread counts
+Index("ix_messages_convo_created_id", Message.convo_id, Message.created_at, Message.id)  # /convos/{id}/messages history
+
+STORAGE_INDEXES = [
+    "ix_participants_user_convo",
+    "ix_convos_updated_id",
+    "ix_messages_convo_updated",
+    "ix_messages_updated_id",
+    "ix_messages_convo_seq",
+    "ix_messages_convo_created_id",
+    "ix_change_log_convo_seq",
+]
+
+def apply_storage_profile(bind):
+    """Create any missing profile index (create_all skips existing tables) and refresh planner stats."""
+    for table in Base.metadata.sorted_tables:
+        for idx in table.indexes:
+            if idx.name in STORAGE_INDEXES:
+                idx.create(bind=bind, checkfirst=True)
+    if bind.dialect.name == "sqlite":
+        with bind.begin() as conn:
+            conn.exec_driver_sql("PRAGMA optimize")
+
+# Columns added to tables that older databases already have. create_all never
+# alters an existing table, so upgrade_schema adds them: (column, server default).
+UPGRADE_COLUMNS = [
+    (Convo.__table__.c.seq, "0"),
+    (Message.__table__.c.seq, None),
+    (ConvoParticipant.__table__.c.joined_seq, None),
+    (ConvoParticipant.__table__.c.delivered_upto, "0"),
+    (ConvoParticipant.__table__.c.seen_upto, "0"),
+]
+
+# Receipts used to be one row per (message, user) in message_deliveries; the
+# watermarks start at the highest seq each participant had acknowledged there.
+SEED_WATERMARKS = """
+UPDATE convo_participants SET
+    delivered_upto = COALESCE((SELECT MAX(m.seq) FROM message_deliveries d JOIN messages m ON m.id = d.message_id
+        WHERE m.convo_id = convo_participants.convo_id AND d.user_id = convo_participants.user_id
+        AND (d.delivered_at IS NOT NULL OR d.seen_at IS NOT NULL)), 0),
+    seen_upto = COALESCE((SELECT MAX(m.seq) FROM message_deliveries d JOIN messages m ON m.id = d.message_id
+        WHERE m.convo_id = convo_participants.convo_id AND d.user_id = convo_participants.user_id
+        AND d.seen_at IS NOT NULL), 0)
+"""
+
+def upgrade_schema(bind):
+    """Bring a database created by an older version up to the current models. Idempotent.
+
+    Adds the missing UPGRADE_COLUMNS, then gives every convo that has never logged a
+    change its history: a "convo" change, then one "message" change per message in
+    (created_at, id) order, which is also where each message's seq comes from.
+    Receipt watermarks added here are seeded from the old message_deliveries rows.
+    """
+    with bind.begin() as conn:
+        insp = sqla_inspect(conn)
+        added = set()
+        for col, default in UPGRADE_COLUMNS:
+            if col.name in {c["name"] for c in insp.get_columns(col.table.name)}:
+                continue
+            ddl = f"ALTER TABLE {col.table.name} ADD COLUMN {col.name} {col.type.compile(bind.dialect)}"
+            if default is not None:
+                ddl += f" NOT NULL DEFAULT {default}"
+            conn.exec_driver_sql(ddl)
+            added.add((col.table.name, col.name))
+            log.info("schema.upgrade added=%s.%s", col.table.name, col.name)
+
+        unlogged = list(conn.execute(select(Convo.id).where(Convo.seq == 0).order_by(Convo.created_at, Convo.id)).scalars())
+        messages = Message.__table__
+        set_seq = update(messages).where(messages.c.id == bindparam("mid")).values(seq=bindparam("mseq"))
+        for convo_id in unlogged:
+            changes = [{"convo_id": convo_id, "convo_seq": 1, "entity": "convo", "entity_id": convo_id}]
+            q = select(messages.c.id).where(messages.c.convo_id == convo_id).order_by(messages.c.created_at, messages.c.id)
+            ids = list(conn.execute(q).scalars())
+            for seq, mid in enumerate(ids, start=2):
+                changes.append({"convo_id": convo_id, "convo_seq": seq, "entity": "message", "entity_id": mid})
+            if ids:
+                conn.execute(set_seq, [{"mid": mid, "mseq": seq} for seq, mid in enumerate(ids, start=2)])
+            conn.execute(insert(ChangeLog), changes)
+            conn.execute(update(Convo).where(Convo.id == convo_id).values(seq=len(changes)))
+        if unlogged:
+            log.info("schema.upgrade backfilled_convos=%s", len(unlogged))
+
+        if ("convo_participants", "seen_upto") in added and insp.has_table("message_deliveries"):
+            conn.execute(text(SEED_WATERMARKS))
+            log.info("schema.upgrade seeded=receipt_watermarks")
 
 Base.metadata.create_all(bind=engine)
+upgrade_schema(engine)
+apply_storage_profile(engine)
+
+# -----------------------------
+# Archive
+# -----------------------------
+# Hot/cold tiering. `python backend.py archive` moves each convo's messages older
+# than ARCHIVE_AFTER_DAYS out of `messages` into MessageArchiveSegment rows, so
+# the hot table and its indexes only hold recent traffic. What gets archived is
+# always a prefix of the convo in (created_at, id) order, which lets history
+# pages run on from the hot tier into the archive. Archived messages cannot be
+# edited, only deleted (archive_delete rewrites the segment without the content);
+# reads go through ArchiveStore, which keeps decoded segments in an LRU.
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_SEGMENT_MAX = int(os.getenv("ARCHIVE_SEGMENT_MAX", "500"))
+ARCHIVE_ZLIB_LEVEL = int(os.getenv("ARCHIVE_ZLIB_LEVEL", "6"))
+ARCHIVE_CACHE_MESSAGES = int(os.getenv("ARCHIVE_CACHE_MESSAGES", "100000"))  # decoded messages kept in memory
+# a segment is a JSON list of [id, local_id, sender_id, content, deleted, seq,
+# created_at, updated_at] rows, oldest first; deleted messages keep no content
+ARCHIVE_CODEC = "json-zlib-v1"
+A_ID, A_LOCAL_ID, A_SENDER, A_CONTENT, A_DELETED, A_SEQ, A_CREATED, A_UPDATED = range(8)
+
+def archive_row(m: Message) -> tuple:
+    return (m.id, m.local_id, m.sender_id, None if m.deleted else m.content, bool(m.deleted), m.seq, m.created_at, m.updated_at)
+
+def encode_segment(rows: List[tuple]) -> tuple:
+    """(compressed bytes, uncompressed size) of archive rows."""
+    raw = json.dumps(
+        [[*r[:A_CREATED], r[A_CREATED].isoformat(), r[A_UPDATED].isoformat() if r[A_UPDATED] else None] for r in rows],
+        separators=(",", ":"),
+    ).encode()
+    return zlib.compress(raw, ARCHIVE_ZLIB_LEVEL), len(raw)
+
+def decode_segment(codec: str, data: bytes) -> List[tuple]:
+    if codec != ARCHIVE_CODEC:
+        raise ValueError(f"unknown archive codec {codec!r}")
+    return [
+        (*r[:A_CREATED], datetime.fromisoformat(r[A_CREATED]), datetime.fromisoformat(r[A_UPDATED]) if r[A_UPDATED] else None)
+        for r in json.loads(zlib.decompress(data))
+    ]
+
+def archived_message(convo_id: str, r: tuple) -> Message:
+    """A transient Message for an archive row; never add it to a Session."""
+    return Message(
+        id=r[A_ID], local_id=r[A_LOCAL_ID], convo_id=convo_id, sender_id=r[A_SENDER], content=r[A_CONTENT],
+        deleted=r[A_DELETED], seq=r[A_SEQ], created_at=r[A_CREATED], updated_at=r[A_UPDATED],
+    )
+
+class ArchiveStore:
+    """Read side of the archive.
+
+    Segment metadata is queried per call; decoded segments are cached as
+    (convo_id, rows, keys) in an LRU bounded by ARCHIVE_CACHE_MESSAGES. Segments
+    are immutable and their ids never reused, so a cached entry cannot go stale.
+    """
+
+    def __init__(self, max_messages: int = ARCHIVE_CACHE_MESSAGES):
+        self.max_messages = max_messages
+        self.segments: "OrderedDict[int, tuple]" = OrderedDict()
+        self.cached_messages = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _get(self, segment_id: int) -> Optional[tuple]:
+        with self.lock:
+            entry = self.segments.get(segment_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.segments.move_to_end(segment_id)
+            self.hits += 1
+            return entry
+
+    def _put(self, segment_id: int, entry: tuple):
+        with self.lock:
+            if segment_id in self.segments:
+                return
+            self.segments[segment_id] = entry
+            self.cached_messages += len(entry[1])
+            while self.cached_messages > self.max_messages and len(self.segments) > 1:
+                _, (_, rows, _) = self.segments.popitem(last=False)
+                self.cached_messages -= len(rows)
+
+    def segment(self, db: Session, segment_id: int) -> Optional[tuple]:
+        """(convo_id, rows oldest first, their (created_at, id) keys), or None if the
+        segment was merged away since the caller looked it up.
+        """
+        entry = self._get(segment_id)
+        if entry is None:
+            row = db.execute(select(MessageArchiveSegment.convo_id, MessageArchiveSegment.codec, MessageArchiveSegment.data).where(MessageArchiveSegment.id == segment_id)).first()
+            if row is None:
+                return None
+            rows = decode_segment(row.codec, row.data)
+            entry = (row.convo_id, rows, [(r[A_CREATED], r[A_ID]) for r in rows])
+            self._put(segment_id, entry)
+        return entry
+
+    def contains(self, db: Session, message_id: str) -> bool:
+        return db.get(MessageArchiveEntry, message_id) is not None
+
+    def get_many(self, db: Session, message_ids) -> Dict[str, Message]:
+        q = select(MessageArchiveEntry.message_id, MessageArchiveEntry.segment_id).where(MessageArchiveEntry.message_id.in_(list(message_ids)))
+        wanted: Dict[int, set] = {}
+        for mid, sid in db.execute(q).all():
+            wanted.setdefault(sid, set()).add(mid)
+        found = {}
+        for sid, ids in wanted.items():
+            entry = self.segment(db, sid)
+            if entry is not None:
+                convo_id, rows, _ = entry
+                found.update((r[A_ID], archived_message(convo_id, r)) for r in rows if r[A_ID] in ids)
+        return found
+
+    def history(self, db: Session, convo_id: str, cursor: Optional[tuple], limit: int) -> List[Message]:
+        """Up to `limit` archived messages of the convo before `cursor`, newest first."""
+        S = MessageArchiveSegment
+        q = select(S.id).where(S.convo_id == convo_id)
+        if cursor:
+            q = q.where(keyset_before(S.min_created_at, S.min_id, cursor))
+        # every segment holds at least one message
+        q = q.order_by(S.max_created_at.desc(), S.max_id.desc()).limit(limit)
+        out: List[Message] = []
+        for sid in db.execute(q).scalars().all():
+            entry = self.segment(db, sid)
+            if entry is None:
+                continue
+            _, rows, keys = entry
+            end = bisect.bisect_left(keys, cursor) if cursor else len(rows)
+            for r in reversed(rows[max(0, end - (limit - len(out))):end]):
+                out.append(archived_message(convo_id, r))
+            if len(out) >= limit:
+                break
+        return out
+
+    def in_seq_range(self, db: Session, convo_id: str, lo: int, hi: int) -> List[Message]:
+        """Archived messages of the convo with lo < seq <= hi."""
+        S = MessageArchiveSegment
+        q = select(S.id).where(and_(S.convo_id == convo_id, S.max_seq > lo, S.min_seq <= hi))
+        out = []
+        for sid in db.execute(q).scalars().all():
+            entry = self.segment(db, sid)
+            if entry is not None:
+                out.extend(archived_message(convo_id, r) for r in entry[1] if r[A_SEQ] is not None and lo < r[A_SEQ] <= hi)
+        return out
+
+    def latest(self, db: Session, convo_id: str) -> Optional[Message]:
+        """The convo's archived message with the highest seq that is not deleted.
+
+        Segments follow (created_at, id), which messages of one batch can tie on,
+        so the last message is chosen by seq like everywhere else.
+        """
+        S = MessageArchiveSegment
+        q = select(S.id, S.max_seq).where(S.convo_id == convo_id).order_by(S.max_seq.desc())
+        best = None
+        for sid, max_seq in db.execute(q).all():
+            if best is not None and max_seq <= (best[A_SEQ] or 0):
+                break
+            entry = self.segment(db, sid)
+            if entry is None:
+                continue
+            for r in entry[1]:
+                if not r[A_DELETED] and (best is None or (r[A_SEQ] or 0) > (best[A_SEQ] or 0)):
+                    best = r
+        return archived_message(convo_id, best) if best is not None else None
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "segments": len(self.segments), "messages": self.cached_messages}
+
+archive = ArchiveStore()
+metrics.gauge("chat_archive_cache_hits_total", "Archive segment reads answered from memory", lambda: archive.hits, kind="counter")
+metrics.gauge("chat_archive_cache_misses_total", "Archive segment reads that went to the DB", lambda: archive.misses, kind="counter")
+
+def iter_archived(conn, convo_id: Optional[str] = None):
+    """(convo_id, [Message]) per archive segment, by convo and oldest first, bypassing
+    the cache; for rebuilds.
+    """
+    S = MessageArchiveSegment
+    q = select(S.id, S.convo_id).order_by(S.convo_id, S.max_created_at, S.max_id)
+    if convo_id is not None:
+        q = q.where(S.convo_id == convo_id)
+    for sid, cid in conn.execute(q).all():
+        codec, data = conn.execute(select(S.codec, S.data).where(S.id == sid)).one()
+        yield cid, [archived_message(cid, r) for r in decode_segment(codec, data)]
+
+def messages_by_id(db: Session, message_ids) -> Dict[str, Message]:
+    """Messages by id from the hot table, then the archive for whatever is left."""
+    message_ids = set(message_ids)
+    if not message_ids:
+        return {}
+    found = {m.id: m for m in db.execute(select(Message).where(Message.id.in_(message_ids))).scalars()}
+    if len(found) < len(message_ids):
+        found.update(archive.get_many(db, message_ids - found.keys()))
+    return found
+
+def archive_messages(bind, cutoff: datetime, segment_max: int = ARCHIVE_SEGMENT_MAX) -> Dict[str, int]:
+    """Move messages created and last updated before `cutoff` into archive segments.
+
+    Works through each convo's oldest hot messages in (created_at, id) order, one
+    transaction per segment under the convo row lock; a message updated after
+    `cutoff` ends its convo's run, so the archive stays a prefix of the convo and
+    /messages/sync?since= within the window still sees every change. A convo's
+    last segment is topped up by writing a merged copy and dropping the old one.
+    """
+    S = MessageArchiveSegment
+    if cutoff.tzinfo is not None:  # stored timestamps are naive UTC
+        cutoff = cutoff.astimezone(timezone.utc).replace(tzinfo=None)
+    stats = {"convos": 0, "messages": 0, "segments_written": 0}
+    with bind.connect() as conn:
+        convo_ids = conn.execute(select(Message.convo_id).where(Message.created_at < cutoff).distinct()).scalars().all()
+    for convo_id in convo_ids:
+        moved = 0
+        while True:
+            with Session(bind) as db, db.begin():
+                db.get(Convo, convo_id, with_for_update=True)
+                tail = db.execute(select(S).where(S.convo_id == convo_id).order_by(S.max_created_at.desc(), S.max_id.desc()).limit(1)).scalar_one_or_none()
+                if tail is not None and tail.message_count >= segment_max:
+                    tail = None
+                q = select(Message).where(Message.convo_id == convo_id).order_by(Message.created_at, Message.id)
+                batch = []
+                for m in db.execute(q.limit(segment_max - (tail.message_count if tail else 0))).scalars():
+                    if m.created_at >= cutoff or (m.updated_at or m.created_at) >= cutoff:
+                        break
+                    batch.append(m)
+                if not batch:
+                    break
+                rows = (decode_segment(tail.codec, tail.data) if tail else []) + [archive_row(m) for m in batch]
+                data, raw_bytes = encode_segment(rows)
+                seqs = [r[A_SEQ] or 0 for r in rows]
+                seg = S(
+                    convo_id=convo_id, message_count=len(rows), min_seq=min(seqs), max_seq=max(seqs),
+                    min_created_at=rows[0][A_CREATED], min_id=rows[0][A_ID], max_created_at=rows[-1][A_CREATED], max_id=rows[-1][A_ID],
+                    codec=ARCHIVE_CODEC, raw_bytes=raw_bytes, data=data,
+                )
+                db.add(seg)
+                db.flush()
+                if tail is not None:
+                    db.execute(update(MessageArchiveEntry).where(MessageArchiveEntry.segment_id == tail.id).values(segment_id=seg.id))
+                    db.delete(tail)
+                db.execute(insert(MessageArchiveEntry), [{"message_id": m.id, "segment_id": seg.id, "sender_id": m.sender_id, "local_id": m.local_id} for m in batch])
+                db.execute(delete(Message).where(Message.id.in_([m.id for m in batch])), execution_options={"synchronize_session": False})
+            moved += len(batch)
+            stats["segments_written"] += 1
+        if moved:
+            stats["convos"] += 1
+            stats["messages"] += moved
+    if bind.dialect.name == "sqlite":
+        with bind.begin() as conn:
+            conn.exec_driver_sql("PRAGMA optimize")
+    return stats
+
+def archive_delete(db: Session, message_id: str, now: datetime) -> Optional[Message]:
+    """Mark an archived message deleted and drop its content from storage.
+
+    Segments are immutable, so this writes a copy of the message's segment and
+    drops the old one, as archive_messages does when topping up a segment. The
+    caller holds the convo row lock. Returns the message as it is now, or None if
+    it is not archived.
+    """
+    S = MessageArchiveSegment
+    entry = db.get(MessageArchiveEntry, message_id)
+    if entry is None:
+        return None
+    old = db.get(S, entry.segment_id)
+    rows = decode_segment(old.codec, old.data)
+    i = next(i for i, r in enumerate(rows) if r[A_ID] == message_id)
+    if not rows[i][A_DELETED]:
+        r = list(rows[i])
+        r[A_CONTENT], r[A_DELETED] = None, True
+        r[A_UPDATED] = now.astimezone(timezone.utc).replace(tzinfo=None)  # stored timestamps are naive UTC
+        rows[i] = tuple(r)
+        data, raw_bytes = encode_segment(rows)
+        seg = S(
+            convo_id=old.convo_id, message_count=old.message_count, min_seq=old.min_seq, max_seq=old.max_seq,
+            min_created_at=old.min_created_at, min_id=old.min_id, max_created_at=old.max_created_at, max_id=old.max_id,
+            codec=ARCHIVE_CODEC, raw_bytes=raw_bytes, data=data,
+        )
+        db.add(seg)
+        db.flush()
+        db.execute(update(MessageArchiveEntry).where(MessageArchiveEntry.segment_id == old.id).values(segment_id=seg.id))
+        db.delete(old)
+        db.flush()
+    return archived_message(old.convo_id, rows[i])
+
+def archive_totals(bind) -> Dict[str, int]:
+    S = MessageArchiveSegment
+    with bind.connect() as conn:
+        row = conn.execute(select(func.count(S.id), func.coalesce(func.sum(S.message_count), 0), func.coalesce(func.sum(S.raw_bytes), 0), func.coalesce(func.sum(func.length(S.data)), 0))).one()
+    return {"segments": row[0], "messages": row[1], "raw_bytes": row[2], "stored_bytes": row[3]}
+
+# -----------------------------
+# Search
+# -----------------------------
+# Full-text search over message content. Writes go through the caller's Session,
+# so the index commits or rolls back together with the message change; the
+# engine-specific part lives behind SearchIndex.
+SEARCH_PAGE_DEFAULT = int(os.getenv("SEARCH_PAGE_DEFAULT", "20"))
+SEARCH_PAGE_MAX = int(os.getenv("SEARCH_PAGE_MAX", "100"))
+SEARCH_MAX_OFFSET = int(os.getenv("SEARCH_MAX_OFFSET", "1000"))  # deepest result a cursor can reach
+SEARCH_MAX_TERMS = int(os.getenv("SEARCH_MAX_TERMS", "8"))
+SEARCH_SCOPE_CHUNK = int(os.getenv("SEARCH_SCOPE_CHUNK", "32"))  # convos per FTS query
+SEARCH_REBUILD_BATCH = int(os.getenv("SEARCH_REBUILD_BATCH", "5000"))
+
+def text_words(value: str) -> List[str]:
+    """Letter/digit runs of `value`, NFKC-normalised and lowercased."""
+    return re.findall(r"[^\W_]+", unicodedata.normalize("NFKC", value).lower())
+
+def search_terms(query: str) -> List[str]:
+    """Word tokens of a user query; operators and punctuation are never passed through."""
+    return text_words(query)[:SEARCH_MAX_TERMS]
+
+class SearchIndex:
+    """Interface for the message search index. The base class indexes nothing.
+
+    `add`/`remove` are called from the message write paths with the open Session
+    and must not commit. `search` returns matching messages from `convo_ids` (the
+    caller's convos), best first; `rebuild` repopulates the index from the
+    messages table.
+    """
+
+    name = "none"
+
+    def setup(self, bind) -> bool:
+        """Create the index if missing; True when it was just created and is empty."""
+        return False
+
+    def add(self, db: Session, messages: List[Message]):
+        pass
+
+    def remove(self, db: Session, message_ids: List[str]):
+        pass
+
+    def search(self, db: Session, convo_ids, terms: List[str], limit: int, offset: int) -> List[Message]:
+        return []
+
+    def rebuild(self, bind) -> int:
+        return 0
+
+class LikeSearchIndex(SearchIndex):
+    """Fallback for engines without an index implementation: every term must appear
+    as a substring, newest first. Scans the caller's messages, so keep it for small
+    deployments or swap in an engine-native index (e.g. a tsvector column on Postgres).
+    Only the hot table is scanned; archived messages are not found.
+    """
+
+    name = "like"
+
+    def search(self, db, convo_ids, terms, limit, offset):
+        q = select(Message).where(and_(Message.convo_id.in_(convo_ids), Message.deleted == False))  # noqa: E712
+        for t in terms:
+            q = q.where(Message.content.icontains(t, autoescape=True))
+        q = q.order_by(Message.created_at.desc(), Message.id.desc()).limit(limit).offset(offset)
+        return db.execute(q).scalars().all()
+
+class Fts5SearchIndex(SearchIndex):
+    """SQLite FTS5 table ranked with bm25.
+
+    Searches are always limited to the caller's convos, so instead of the raw text
+    each row stores its words prefixed with a token derived from the convo id
+    ("s<hash>word"). A query ORs the scoped terms of each convo and only ever reads
+    those convos' postings; with plain words, a common word would rank every hit in
+    the corpus before the scope could be applied. bm25 cost per hit grows with the
+    number of ORed phrases, so convos are queried SEARCH_SCOPE_CHUNK at a time and
+    the top hits merged by score.
+
+    messages.id is a string, so the FTS rowid is a 63-bit hash of it, which keeps
+    removal a rowid lookup.
+    """
+
+    name = "fts5"
+    table = "messages_fts"
+
+    @staticmethod
+    def rowid(message_id: str) -> int:
+        return int.from_bytes(hashlib.blake2b(message_id.encode(), digest_size=8).digest(), "big") >> 1
+
+    @staticmethod
+    def scope(convo_id: str) -> str:
+        return "s" + hashlib.blake2b(convo_id.encode(), digest_size=8).hexdigest()
+
+    def setup(self, bind) -> bool:
+        """Create the table if missing; True if it did not exist before.
+
+        Several workers may start at once: IF NOT EXISTS makes the create safe to
+        race, and a worker that also saw no table only repeats the backfill, which
+        replaces the table's contents in one transaction.
+        """
+        with bind.begin() as conn:
+            exists = conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = ?", (self.table,)).first()
+            conn.exec_driver_sql(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} USING fts5("
+                "content, message_id UNINDEXED, tokenize = 'unicode61 remove_diacritics 2')"
+            )
+        return not exists
+
+    def _rows(self, messages) -> List[Dict[str, Any]]:
+        rows = []
+        for m in messages:
+            if m.content:
+                scope = self.scope(m.convo_id)
+                rows.append({"rowid": self.rowid(m.id), "content": " ".join(scope + w for w in text_words(m.content)), "message_id": m.id})
+        return rows
+
+    def _insert(self, conn, rows):
+        if rows:
+            conn.execute(text(f"INSERT INTO {self.table} (rowid, content, message_id) VALUES (:rowid, :content, :message_id)"), rows)
+
+    def add(self, db, messages):
+        self._insert(db, self._rows(messages))
+
+    def remove(self, db, message_ids):
+        if message_ids:
+            db.execute(text(f"DELETE FROM {self.table} WHERE rowid = :rowid"), [{"rowid": self.rowid(mid)} for mid in message_ids])
+
+    def _match(self, convo_ids, terms) -> str:
+        # every term must match; the last one also as a prefix, for search-as-you-type
+        star = "*" if len(terms[-1]) >= 2 else ""
+        groups = []
+        for cid in convo_ids:
+            scope = self.scope(cid)
+            groups.append("(" + " AND ".join(f'"{scope}{t}"' for t in terms) + star + ")")
+        return " OR ".join(groups)
+
+    def search(self, db, convo_ids, terms, limit, offset):
+        sql = text(
+            f"SELECT bm25({self.table}) AS score, rowid, message_id FROM {self.table} "
+            f"WHERE {self.table} MATCH :match ORDER BY score, rowid LIMIT :n"
+        )
+        hits = []
+        for i in range(0, len(convo_ids), SEARCH_SCOPE_CHUNK):
+            match = self._match(convo_ids[i:i + SEARCH_SCOPE_CHUNK], terms)
+            hits.extend(db.execute(sql, {"match": match, "n": offset + limit}).all())
+        ids = [h.message_id for h in heapq.nsmallest(offset + limit, hits, key=lambda h: (h.score, h.rowid))[offset:]]
+        if not ids:
+            return []
+        # the convo check also covers the (2^-64) chance of two convos sharing a scope
+        allowed = set(convo_ids)
+        by_id = messages_by_id(db, ids)
+        return [by_id[i] for i in ids if i in by_id and by_id[i].convo_id in allowed]
+
+    def rebuild(self, bind) -> int:
+        """Repopulate from the messages table and the archive in one transaction,
+        then merge segments.
+        """
+        n = 0
+        with bind.begin() as conn:
+            conn.exec_driver_sql(f"DELETE FROM {self.table}")
+            q = select(Message.id, Message.convo_id, Message.content).where(and_(Message.deleted == False, Message.content.is_not(None)))  # noqa: E712
+            for rows in conn.execution_options(yield_per=SEARCH_REBUILD_BATCH).execute(q).partitions():
+                batch = self._rows(rows)
+                self._insert(conn, batch)
+                n += len(batch)
+            for _, messages in iter_archived(conn):
+                batch = self._rows([m for m in messages if not m.deleted])
+                self._insert(conn, batch)
+                n += len(batch)
+            conn.exec_driver_sql(f"INSERT INTO {self.table} ({self.table}) VALUES ('optimize')")
+        return n
+
+def make_search_index(bind) -> SearchIndex:
+    if bind.dialect.name == "sqlite":
+        index = Fts5SearchIndex()
+        try:
+            created = index.setup(bind)
+        except OperationalError as e:
+            if "no such module: fts5" not in str(e):
+                raise  # e.g. a locked database: falling back would leave this worker's writes unindexed
+            log.warning("search.fts5_unavailable fallback=like")
+            return LikeSearchIndex()
+        if created:
+            with bind.connect() as conn:
+                backlog = conn.execute(select(func.count()).select_from(Message)).scalar() + conn.execute(select(func.count()).select_from(MessageArchiveEntry)).scalar()
+            if backlog:
+                log.info("search.backfill messages=%s", backlog)
+                index.rebuild(bind)
+        return index
+    return LikeSearchIndex()
+
+search_index = make_search_index(engine)
+
+# -----------------------------
+# Conversation summaries
+# -----------------------------
+# ConvoSummary rows are updated in the same transaction as the change they
+# reflect. Counts move by deltas rather than being recounted, so a concurrent
+# writer's increment is never overwritten; only the last-message fields are
+# re-read, and only when the last message itself was deleted. Archiving moves
+# messages without changing any summary; only recounts read the archive.
+SUMMARY_PREVIEW_CHARS = int(os.getenv("SUMMARY_PREVIEW_CHARS", "120"))
+
+def message_preview(content: Optional[str]) -> Optional[str]:
+    return content[:SUMMARY_PREVIEW_CHARS] if content else None
+
+def _last_message_values(m: Optional[Message]) -> Dict[str, Any]:
+    return {
+        "last_message_id": m.id if m else None,
+        "last_message_preview": message_preview(m.content) if m else None,
+        "last_sender_id": m.sender_id if m else None,
+        "last_message_at": m.created_at if m else None,
+    }
+
+def summary_add_participants(db: Session, convo_id: str, user_ids: List[int]):
+    """Create summary rows for new participants from the convo's existing messages."""
+    _insert_summaries(
+        db,
+        and_(ConvoParticipant.convo_id == convo_id, ConvoParticipant.user_id.in_(user_ids)),
+        and_(ConvoSummary.convo_id == convo_id, ConvoSummary.user_id.in_(user_ids)),
+    )
+    _add_archived_to_summaries(db, convo_id, user_ids)
+
+def summary_add_messages(db: Session, convo_id: str, messages: List[Message]):
+    """New (flushed) messages in one convo: bump the counts, move the last message."""
+    own = {}
+    for m in messages:
+        own[m.sender_id] = own.get(m.sender_id, 0) + 1
+    n = len(messages)
+    values = _last_message_values(max(messages, key=lambda m: m.seq))
+    values["message_count"] = ConvoSummary.message_count + n
+    values["unread_count"] = ConvoSummary.unread_count + n - case(own, value=ConvoSummary.user_id, else_=0)
+    db.execute(update(ConvoSummary).where(ConvoSummary.convo_id == convo_id).values(**values))
+
+def summary_edit_message(db: Session, m: Message) -> bool:
+    """True if `m` is the convo's last message, i.e. the chat list changed."""
+    q = update(ConvoSummary).where(and_(ConvoSummary.convo_id == m.convo_id, ConvoSummary.last_message_id == m.id))
+    return db.execute(q.values(last_message_preview=message_preview(m.content))).rowcount > 0
+
+def summary_delete_message(db: Session, m: Message) -> bool:
+    """`m` is being deleted; call before the deletion is flushed (for an archived
+    message, after archive_delete). True if it was the convo's last message.
+    """
+    unread_for = select(ConvoParticipant.user_id).where(and_(
+        ConvoParticipant.convo_id == m.convo_id,
+        ConvoParticipant.seen_upto < m.seq,
+        ConvoParticipant.user_id != m.sender_id,
+    ))
+    db.execute(update(ConvoSummary).where(and_(ConvoSummary.convo_id == m.convo_id, ConvoSummary.user_id.in_(unread_for))).values(unread_count=ConvoSummary.unread_count - 1))
+    db.execute(update(ConvoSummary).where(ConvoSummary.convo_id == m.convo_id).values(message_count=ConvoSummary.message_count - 1))
+    q = (
+        select(Message)
+        .where(and_(Message.convo_id == m.convo_id, Message.deleted == False, Message.id != m.id))  # noqa: E712
+        .order_by(Message.seq.desc())
+        .limit(1)
+    )
+    last = db.execute(q).scalar_one_or_none() or archive.latest(db, m.convo_id)
+    was_last = and_(ConvoSummary.convo_id == m.convo_id, ConvoSummary.last_message_id == m.id)
+    return db.execute(update(ConvoSummary).where(was_last).values(**_last_message_values(last))).rowcount > 0
+
+def summary_seen(db: Session, convo_id: str, user_id: int, old_upto: int, new_upto: int):
+    """The participant's seen watermark moved from old_upto to new_upto."""
+    q = select(func.count(Message.id)).where(and_(
+        Message.convo_id == convo_id,
+        Message.seq > old_upto,
+        Message.seq <= new_upto,
+        Message.sender_id != user_id,
+        Message.deleted == False,  # noqa: E712
+    ))
+    read = db.execute(q).scalar() or 0
+    read += sum(1 for a in archive.in_seq_range(db, convo_id, old_upto, new_upto) if not a.deleted and a.sender_id is not None and a.sender_id != user_id)
+    if read:
+        mine = and_(ConvoSummary.convo_id == convo_id, ConvoSummary.user_id == user_id)
+        db.execute(update(ConvoSummary).where(mine).values(unread_count=ConvoSummary.unread_count - read))
+
+def _insert_summaries(conn, participants, summaries):
+    """INSERT ... SELECT summary rows for the ConvoParticipant rows matching
+    `participants`, then fill in the last-message fields of `summaries` (the same rows).
+    """
+    live = and_(Message.convo_id == ConvoParticipant.convo_id, Message.deleted == False)  # noqa: E712
+    message_count = select(func.count(Message.id)).where(live).scalar_subquery()
+    unread = select(func.count(Message.id)).where(and_(live, Message.seq > ConvoParticipant.seen_upto, Message.sender_id != ConvoParticipant.user_id)).scalar_subquery()
+    last_id = select(Message.id).where(live).order_by(Message.seq.desc()).limit(1).scalar_subquery()
+    rows = select(ConvoParticipant.convo_id, ConvoParticipant.user_id, message_count, unread, last_id).where(participants)
+    cols = ["convo_id", "user_id", "message_count", "unread_count", "last_message_id"]
+    conn.execute(insert(ConvoSummary).from_select(cols, rows))
+    conn.execute(
+        update(ConvoSummary)
+        .where(and_(summaries, ConvoSummary.last_message_id == Message.id))
+        .values(
+            last_message_preview=func.substr(Message.content, 1, SUMMARY_PREVIEW_CHARS),
+            last_sender_id=Message.sender_id,
+            last_message_at=Message.created_at,
+        )
+    )
+
+def _add_archived_to_summaries(conn, convo_id: Optional[str] = None, user_ids: Optional[List[int]] = None):
+    """Fold archived messages into summary rows just built by _insert_summaries from
+    the hot table. Archived messages precede hot ones, so they only supply the last
+    message where the hot table had none.
+    """
+    counts = (
+        update(ConvoSummary.__table__)
+        .where(and_(ConvoSummary.convo_id == bindparam("b_convo"), ConvoSummary.user_id == bindparam("b_user")))
+        .values(message_count=ConvoSummary.message_count + bindparam("b_live"), unread_count=ConvoSummary.unread_count + bindparam("b_unread"))
+    )
+    for cid, segments in itertools.groupby(iter_archived(conn, convo_id), key=lambda s: s[0]):
+        live = [m for _, messages in segments for m in messages if not m.deleted]
+        if not live:
+            continue
+        q = select(ConvoParticipant.user_id, ConvoParticipant.seen_upto).where(ConvoParticipant.convo_id == cid)
+        if user_ids is not None:
+            q = q.where(ConvoParticipant.user_id.in_(user_ids))
+        params = []
+        for uid, seen in conn.execute(q).all():
+            unread = sum(1 for m in live if (m.seq or 0) > (seen or 0) and m.sender_id is not None and m.sender_id != uid)
+            params.append({"b_convo": cid, "b_user": uid, "b_live": len(live), "b_unread": unread})
+        if params:
+            conn.execute(counts, params)
+            no_last = and_(ConvoSummary.convo_id == cid, ConvoSummary.last_message_id.is_(None))
+            conn.execute(update(ConvoSummary).where(no_last).values(**_last_message_values(max(live, key=lambda m: m.seq or 0))))
+
+def rebuild_summaries(bind) -> int:
+    """Recompute every ConvoSummary row from participants, messages and the archive
+    in one transaction.
+    """
+    with bind.begin() as conn:
+        conn.execute(ConvoSummary.__table__.delete())
+        _insert_summaries(conn, True, True)
+        _add_archived_to_summaries(conn)
+        return conn.execute(select(func.count()).select_from(ConvoSummary)).scalar()
+
+def ensure_summaries(bind):
+    """Backfill the projection once, when it is empty but participants exist (e.g. after an upgrade)."""
+    with bind.connect() as conn:
+        empty = conn.execute(select(ConvoSummary.convo_id).limit(1)).first() is None
+        needed = conn.execute(select(ConvoParticipant.id).limit(1)).first() is not None
+    if empty and needed:
+        log.info("summaries.backfill rows=%s", rebuild_summaries(bind))
+
+ensure_summaries(engine)
 
 # -----------------------------
 # Auth
@@ -150,51 +1267,198 @@ def get_db():
         db.close()
 
 
-from typing import Annotated
+# Async code never touches a Session directly: blocking DB work is offloaded to a
+# bounded thread pool and every call gets its own short-lived session.
+DB_THREADS = int(os.getenv("DB_THREADS", "8"))
+db_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="db")
 
-def get_current_user(authorization: Annotated[Optional[str], Header(alias="Authorization")] = None, db: Session = Depends(get_db)) -> AuthedUser:
-    if authorization is None:
-        raise HTTPException(status_code=401, detail="Missing Authorization header")
-    # try:
-    #     scheme, _, token = authorization.partition(" ")
-    #     if scheme.lower() != "bearer" or not token:
-    #         raise HTTPException(status_code=401, detail="Invalid Authorization header")
-    #     if not PUBLIC_KEY_PEM:
-    #         raise HTTPException(status_code=500, detail="Server missing PUBLIC_KEY_PEM")
-    #     claims = jwt.decode(token, PUBLIC_KEY_PEM, algorithms=[ALGO])
-    # except JWTError as e:
-    #     raise HTTPException(status_code=401, detail=f"Invalid token: {str(e)}")
-
-    # sub = claims.get("sub")
-    # if sub is None:
-    #     raise HTTPException(status_code=401, detail="Token missing 'sub'")
-
-    # Ensure Django user exists and is active.
-    sub = authorization
+def _call_with_session(fn, args, timing):
+    db = SessionLocal()
+    t0 = time.perf_counter()
     try:
-        uid = int(sub)
-    except (ValueError, TypeError):
-        raise HTTPException(status_code=401, detail="Invalid 'sub' for Django user id")
+        return fn(db, *args)
+    finally:
+        db.close()
+        timing[0] = time.perf_counter() - t0
+
+async def run_db(fn, *args):
+    """Run `fn(db, *args)` on the DB thread pool with a fresh session.
+
+    Time spent inside `fn` is recorded per function and charged to the event
+    being handled, if any.
+    """
+    loop = asyncio.get_running_loop()
+    timing = [0.0]
+    try:
+        return await loop.run_in_executor(db_executor, _call_with_session, fn, args, timing)
+    finally:
+        metrics.observe("chat_db_seconds", timing[0], fn=fn.__name__)
+        charge_db_time(timing[0])
+
+
+from typing import Annotated
+
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "50000"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+INTERNAL_API_TOKEN = os.getenv("INTERNAL_API_TOKEN")
+
+class TTLCache:
+    """Thread-safe LRU whose entries also expire at a per-entry deadline."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[Any, tuple]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, expires_at: float):
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def discard_where(self, predicate):
+        with self.lock:
+            for key in [k for k, (v, _) in self.entries.items() if predicate(v)]:
+                del self.entries[key]
+
+class Authenticator:
+    """Token and user checks shared by REST and /ws.
+
+    The public key is parsed once. Verified claims are cached until the token's
+    `exp`, and active Django users for USER_CACHE_TTL seconds, so a warm request
+    costs neither a signature check nor a DB round-trip. Without PUBLIC_KEY_PEM
+    the bearer token is taken as the Django user id (development mode).
+    """
+
+    def __init__(self, public_key_pem: Optional[str]):
+        self.key = jwk.construct(public_key_pem, ALGO) if public_key_pem else None
+        self.tokens = TTLCache(AUTH_TOKEN_CACHE_SIZE)
+        self.users = TTLCache(USER_CACHE_SIZE)
+
+    def verify(self, token: str) -> Dict[str, Any]:
+        claims = self.tokens.get(token)
+        if claims is not None:
+            return claims
+        if self.key is None:
+            claims = {"sub": token}
+            expires_at = time.time() + USER_CACHE_TTL
+        else:
+            try:
+                claims = jwt.decode(token, self.key, algorithms=[ALGO])
+            except JWTError as e:
+                raise HTTPException(status_code=401, detail=f"Invalid token: {str(e)}")
+            expires_at = float(claims.get("exp") or time.time() + USER_CACHE_TTL)
+        if claims.get("sub") is None:
+            raise HTTPException(status_code=401, detail="Token missing 'sub'")
+        self.tokens.put(token, claims, expires_at)
+        return claims
+
+    def _authed(self, claims: Dict[str, Any], user: Dict[str, Any]) -> AuthedUser:
+        return AuthedUser(
+            user_id=user["user_id"],
+            username=claims.get("preferred_username") or claims.get("username") or user["username"],
+            email=claims.get("email") or user["email"],
+            raw_claims=claims,
+        )
+
+    def _uid(self, claims: Dict[str, Any]) -> int:
+        try:
+            return int(claims["sub"])
+        except (ValueError, TypeError):
+            raise HTTPException(status_code=401, detail="Invalid 'sub' for Django user id")
+
+    def cached(self, token: str) -> Optional[AuthedUser]:
+        """The user for `token` if it can be answered without the DB or a signature check."""
+        claims = self.tokens.get(token)
+        if claims is None:
+            return None
+        try:
+            user = self.users.get(self._uid(claims))
+        except HTTPException:
+            return None
+        return self._authed(claims, user) if user is not None else None
+
+    def authenticate(self, db: Session, token: str) -> AuthedUser:
+        claims = self.verify(token)
+        uid = self._uid(claims)
+        user = self.users.get(uid)
+        if user is None:
+            # Ensure Django user exists and is active.
+            row = db.get(DjangoUser, uid)
+            if not row or row.is_active is False:
+                raise HTTPException(status_code=403, detail="User not found or inactive")
+            user = {"user_id": str(uid), "username": row.username, "email": row.email}
+            self.users.put(uid, user, time.time() + USER_CACHE_TTL)
+        return self._authed(claims, user)
 
-    user = db.get(DjangoUser, uid)
-    if not user or user.is_active is False:
-        raise HTTPException(status_code=403, detail="User not found or inactive")
+    def invalidate_user(self, uid: int):
+        """Forget a user and every cached token for them (e.g. after deactivation)."""
+        self.users.pop(uid)
+        self.tokens.discard_where(lambda claims: str(claims.get("sub")) == str(uid))
 
-    # username = claims.get("preferred_username") or claims.get("username") or user.username
-    # email = claims.get("email") or user.email
+authenticator = Authenticator(PUBLIC_KEY_PEM)
 
-    return AuthedUser(user_id=str(uid), username=user.username, email=user.email, raw_claims={})
+def bearer_token(authorization: Optional[str]) -> Optional[str]:
+    """Accept both "Bearer <token>" and a bare token."""
+    if not authorization:
+        return None
+    scheme, _, token = authorization.partition(" ")
+    if token and scheme.lower() == "bearer":
+        return token.strip() or None
+    return authorization.strip() or None
+
+def get_current_user(authorization: Annotated[Optional[str], Header(alias="Authorization")] = None, db: Session = Depends(get_db)) -> AuthedUser:
+    token = bearer_token(authorization)
+    if token is None:
+        raise HTTPException(status_code=401, detail="Missing Authorization header")
+    return authenticator.cached(token) or authenticator.authenticate(db, token)
 
 # -----------------------------
 # Schemas
 # -----------------------------
+class LastMessageOut(BaseModel):
+    id: str
+    sender_id: Optional[str]
+    preview: Optional[str]  # first SUMMARY_PREVIEW_CHARS characters
+    created_at: datetime
+
 class ConvoOut(BaseModel):
     id: str
     title: Optional[str]
     is_group: bool
+    seq: int = 0
+    seen_upto: int = 0
+    unread_count: int = 0
+    message_count: int = 0
+    last_message: Optional[LastMessageOut] = None
     updated_at: datetime
     created_at: datetime
 
+class AttachmentOut(BaseModel):
+    id: str  # bytes at GET /attachments/{id}/content
+    filename: Optional[str]
+    content_type: str
+    size: int
+    sha256: str
+
 class MessageOut(BaseModel):
     id: str
     local_id: Optional[str]
@@ -202,9 +1466,64 @@ class MessageOut(BaseModel):
     sender_id: Optional[str]
     content: Optional[str]
     deleted: bool
+    seq: Optional[int] = None
+    attachments: List[AttachmentOut] = []
     created_at: datetime
     updated_at: datetime
 
+class MessagePageOut(BaseModel):
+    messages: List[MessageOut]  # newest first
+    next_before: Optional[str] = None  # pass as ?before= for the next (older) page
+    has_more: bool
+
+class SearchPageOut(BaseModel):
+    messages: List[MessageOut]  # best match first
+    next_cursor: Optional[str] = None  # pass as ?cursor= for the next page
+    has_more: bool
+
+class SyncOut(BaseModel):
+    convos: List[ConvoOut]
+    messages: List[MessageOut]
+    next_after_seq: int
+    has_more: bool
+
+class BulkMessageIn(BaseModel):
+    convo_id: str
+    local_id: str
+    content: Optional[str] = None
+    attachments: List[str] = []  # ids of the sender's completed uploads
+
+class AttachmentCreateIn(BaseModel):
+    size: int = Field(..., ge=1)
+    filename: Optional[str] = Field(None, max_length=255)
+    content_type: Optional[str] = Field(None, max_length=255)
+    sha256: Optional[str] = Field(None, pattern=r"^[0-9a-fA-F]{64}$")  # verified once the last byte arrives
+
+class AttachmentUploadOut(BaseModel):
+    id: str
+    size: int
+    received: int  # resume with Content-Range: bytes <received>-...
+    status: str  # "uploading" | "ready"
+    chunk_max: int
+    attachment: Optional[AttachmentOut] = None  # once ready
+
+class BulkMessagesIn(BaseModel):
+    messages: List[BulkMessageIn]
+
+class RejectedMessage(BaseModel):
+    local_id: Optional[str]
+    convo_id: Optional[str]
+    error: str
+
+class BulkMessagesOut(BaseModel):
+    messages: List[MessageOut]
+    rejected: List[RejectedMessage]
+
+class ReceiptOut(BaseModel):
+    user_id: str
+    delivered_upto: int
+    seen_upto: int
+
 # -----------------------------
 # App
 # -----------------------------
@@ -215,6 +1534,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 # Helper to parse since timestamps
@@ -231,43 +1551,193 @@ def parse_since(since: Optional[str]) -> datetime:
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid 'since' format. Use Unix timestamp.")
 
+# Keyset cursors: opaque base64 of the (updated_at, id) of the last row on a page
+
+SYNC_PAGE_DEFAULT = int(os.getenv("SYNC_PAGE_DEFAULT", "500"))
+SYNC_PAGE_MAX = int(os.getenv("SYNC_PAGE_MAX", "5000"))
+SYNC_STREAM_BATCH = int(os.getenv("SYNC_STREAM_BATCH", "500"))
+HISTORY_PAGE_DEFAULT = int(os.getenv("HISTORY_PAGE_DEFAULT", "50"))
+HISTORY_PAGE_MAX = int(os.getenv("HISTORY_PAGE_MAX", "200"))
+
+def encode_cursor(ts: datetime, row_id: str) -> str:
+    raw = json.dumps([ts.isoformat(), row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: Optional[str]) -> Optional[tuple]:
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        ts, row_id = json.loads(raw)
+        return datetime.fromisoformat(ts), str(row_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid 'cursor'")
+
+# Ranked results have no stable keyset, so search pages use an opaque offset.
+def encode_offset_cursor(offset: int) -> str:
+    return base64.urlsafe_b64encode(f"o:{offset}".encode()).decode().rstrip("=")
+
+def decode_offset_cursor(cursor: Optional[str]) -> int:
+    if not cursor:
+        return 0
+    try:
+        tag, offset = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode().split(":")
+        if tag != "o" or int(offset) < 0:
+            raise ValueError
+        return int(offset)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid 'cursor'")
+
+def keyset_before(ts_col, id_col, cursor: Optional[tuple]):
+    """WHERE clause for rows strictly after `cursor` in (ts desc, id desc) order."""
+    ts, row_id = cursor
+    return or_(ts_col < ts, and_(ts_col == ts, id_col < row_id))
+
+def convo_out(c: Convo, seen_upto: int = 0, summary: Optional[ConvoSummary] = None) -> ConvoOut:
+    last = None
+    if summary is not None and summary.last_message_id:
+        last = LastMessageOut(
+            id=summary.last_message_id,
+            sender_id=str(summary.last_sender_id) if summary.last_sender_id is not None else None,
+            preview=summary.last_message_preview,
+            created_at=summary.last_message_at,
+        )
+    return ConvoOut(
+        id=c.id,
+        title=c.title,
+        is_group=c.is_group,
+        seq=c.seq or 0,
+        seen_upto=seen_upto or 0,
+        unread_count=summary.unread_count if summary is not None else 0,
+        message_count=summary.message_count if summary is not None else 0,
+        last_message=last,
+        updated_at=c.updated_at,
+        created_at=c.created_at,
+    )
+
+def convo_page_query(user_id: str):
+    """The caller's convos with their watermark and summary row, in one indexed join."""
+    uid = int(user_id)
+    return (
+        select(Convo, ConvoParticipant.seen_upto, ConvoSummary)
+        .join(ConvoParticipant, and_(ConvoParticipant.convo_id == Convo.id, ConvoParticipant.user_id == uid))
+        .outerjoin(ConvoSummary, and_(ConvoSummary.convo_id == Convo.id, ConvoSummary.user_id == uid))
+    )
+
+def convo_outs(db: Session, user_id: str, convos: List[Convo]) -> List[ConvoOut]:
+    """ConvoOut for convos already loaded elsewhere; one primary-key lookup per page."""
+    if not convos:
+        return []
+    q = convo_page_query(user_id).where(Convo.id.in_([c.id for c in convos]))
+    rows = {c.id: (seen, summary) for c, seen, summary in db.execute(q).all()}
+    return [convo_out(c, *rows.get(c.id, (0, None))) for c in convos]
+
+def message_out(m: Message, attachments: Optional[List[AttachmentOut]] = None) -> MessageOut:
+    return MessageOut(
+        id=m.id,
+        local_id=m.local_id,
+        convo_id=m.convo_id,
+        sender_id=str(m.sender_id) if m.sender_id is not None else None,
+        content=None if m.deleted else m.content,
+        deleted=m.deleted,
+        seq=m.seq,
+        attachments=[] if m.deleted else attachments or [],
+        created_at=m.created_at,
+        updated_at=m.updated_at,
+    )
+
+def message_outs(db: Session, messages: List[Message]) -> List[MessageOut]:
+    """MessageOut for a page of messages, with their attachments in one query."""
+    refs = attachment_refs(db, [m.id for m in messages])
+    return [message_out(m, refs.get(m.id)) for m in messages]
+
+def message_event(m: Message, attachments: Optional[List[AttachmentOut]] = None) -> Dict[str, Any]:
+    return {
+        "id": m.id,
+        "local_id": m.local_id,
+        "convo_id": m.convo_id,
+        "sender_id": m.sender_id,
+        "content": None if m.deleted else m.content,
+        "deleted": m.deleted,
+        "seq": m.seq,
+        "attachments": [] if m.deleted else [a.model_dump() for a in attachments or []],
+        "created_at": m.created_at,
+        "updated_at": m.updated_at,
+    }
+
+def paginate(db: Session, q, ts_col, id_col, cursor: Optional[str], limit: int, response: Response, scalars: bool = True) -> list:
+    """Run one keyset page of `q`; the next cursor goes into the X-Next-Cursor header.
+
+    With scalars=False rows are tuples whose first element carries the key columns.
+    """
+    after = decode_cursor(cursor)
+    if after:
+        q = q.where(keyset_before(ts_col, id_col, after))
+    q = q.order_by(ts_col.desc(), id_col.desc()).limit(limit + 1)
+    result = db.execute(q)
+    rows = result.scalars().all() if scalars else result.all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1] if scalars else rows[-1][0]
+        response.headers["X-Next-Cursor"] = encode_cursor(getattr(last, ts_col.key), getattr(last, id_col.key))
+    return rows
+
+def stream_ndjson(q, to_outs, scalars: bool = True):
+    """Stream `q` as NDJSON from its own session, one yield_per partition per chunk.
+
+    `to_outs(db, rows)` turns a partition of rows (tuples with scalars=False)
+    into output models.
+
+    FastAPI closes yield-dependencies before the body is sent, so the request
+    session cannot be used here.
+    """
+    db = SessionLocal()
+    try:
+        result = db.execute(q.execution_options(yield_per=SYNC_STREAM_BATCH))
+        if scalars:
+            result = result.scalars()
+        for rows in result.partitions():
+            yield "".join(o.model_dump_json() + "\n" for o in to_outs(db, rows))
+            db.expunge_all()
+    finally:
+        db.close()
+
 # -----------------------------
 # REST Endpoints
 # -----------------------------
 @app.get("/convos/sync", response_model=List[ConvoOut])
 def get_convos(
+    response: Response,
     since: Optional[str] = Query(None, description="Unix timestamp"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor from the previous page"),
+    limit: int = Query(SYNC_PAGE_DEFAULT, ge=1, le=SYNC_PAGE_MAX),
+    stream: bool = Query(False, description="Stream every row as NDJSON instead of one page"),
     user: AuthedUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     since_dt = parse_since(since)
 
-    q = (
-        select(Convo)
-        .join(ConvoParticipant, ConvoParticipant.convo_id == Convo.id)
-        .where(
-            and_(
-                ConvoParticipant.user_id == int(user.user_id),
-                Convo.updated_at >= since_dt,
-            )
-        )
-        .order_by(Convo.updated_at.desc())
-    )
-    rows = db.execute(q).scalars().all()
-    return [
-        ConvoOut(
-            id=c.id,
-            title=c.title,
-            is_group=c.is_group,
-            updated_at=c.updated_at,
-            created_at=c.created_at,
-        )
-        for c in rows
-    ]
+    # convo, watermark and chat-list summary come back from the same query. A seen
+    # receipt only changes the caller's own row (seen_upto, unread_count), and it
+    # stamps last_read_at rather than the convo
+    q = convo_page_query(user.user_id).where(or_(Convo.updated_at >= since_dt, ConvoParticipant.last_read_at >= since_dt))
+    to_outs = lambda _db, rows: [convo_out(c, seen, summary) for c, seen, summary in rows]
+    if stream:
+        after = decode_cursor(cursor)
+        if after:
+            q = q.where(keyset_before(Convo.updated_at, Convo.id, after))
+        q = q.order_by(Convo.updated_at.desc(), Convo.id.desc())
+        return StreamingResponse(stream_ndjson(q, to_outs, scalars=False), media_type="application/x-ndjson")
+    rows = paginate(db, q, Convo.updated_at, Convo.id, cursor, limit, response, scalars=False)
+    return to_outs(db, rows)
 
 @app.get("/messages/sync", response_model=List[MessageOut])
 def get_messages(
+    response: Response,
     since: Optional[str] = Query(None, description="Unix timestamp"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor from the previous page"),
+    limit: int = Query(SYNC_PAGE_DEFAULT, ge=1, le=SYNC_PAGE_MAX),
+    stream: bool = Query(False, description="Stream every row as NDJSON instead of one page"),
     user: AuthedUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
@@ -276,30 +1746,414 @@ def get_messages(
     # Only messages from convos where user participates, updated since
     q = (
         select(Message)
-        .join(Convo, Convo.id == Message.convo_id)
-        .join(ConvoParticipant, ConvoParticipant.convo_id == Convo.id)
+        .join(ConvoParticipant, ConvoParticipant.convo_id == Message.convo_id)
         .where(
             and_(
                 ConvoParticipant.user_id == int(user.user_id),
                 Message.updated_at >= since_dt,
             )
         )
-        .order_by(Message.updated_at.desc())
     )
+    if stream:
+        after = decode_cursor(cursor)
+        if after:
+            q = q.where(keyset_before(Message.updated_at, Message.id, after))
+        q = q.order_by(Message.updated_at.desc(), Message.id.desc())
+        to_outs = message_outs
+        return StreamingResponse(stream_ndjson(q, to_outs), media_type="application/x-ndjson")
+    rows = paginate(db, q, Message.updated_at, Message.id, cursor, limit, response)
+    return message_outs(db, rows)
+
+@app.get("/sync", response_model=SyncOut)
+def sync_changes(
+    after_seq: int = Query(0, ge=0, description="next_after_seq from the previous call"),
+    limit: int = Query(SYNC_PAGE_DEFAULT, ge=1, le=SYNC_PAGE_MAX),
+    user: AuthedUser = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Changes to the caller's convos and messages after `after_seq`, oldest first.
+
+    Each entity is returned once in its current state, however many times it
+    changed within the page; `next_after_seq` is the cursor for the next call.
+    A convo the caller joined after `after_seq` brings its earlier history along
+    (everything an after_seq=0 sync would have returned for it) on the page that
+    carries the join.
+    """
+    q = (
+        select(ChangeLog.seq, ChangeLog.convo_id, ChangeLog.entity, ChangeLog.entity_id, (ChangeLog.convo_seq == ConvoParticipant.joined_seq).label("joins"))
+        .join(ConvoParticipant, ConvoParticipant.convo_id == ChangeLog.convo_id)
+        .where(
+            and_(
+                ConvoParticipant.user_id == int(user.user_id),
+                ChangeLog.seq > after_seq,
+            )
+        )
+        .order_by(ChangeLog.seq)
+        .limit(limit + 1)
+    )
+    changes = db.execute(q).all()
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+
+    entities = [(c.entity, c.entity_id) for c in changes]
+    joined = [c.convo_id for c in changes if c.joins]
+    if joined and after_seq:
+        q = select(ChangeLog.entity, ChangeLog.entity_id).where(and_(ChangeLog.convo_id.in_(joined), ChangeLog.seq <= after_seq))
+        entities += db.execute(q).all()
+
+    convo_ids = {entity_id for entity, entity_id in entities if entity == "convo"}
+    message_ids = {entity_id for entity, entity_id in entities if entity == "message"}
+    convos = db.execute(select(Convo).where(Convo.id.in_(convo_ids))).scalars().all() if convo_ids else []
+    messages = list(messages_by_id(db, message_ids).values())
+    return SyncOut(
+        convos=convo_outs(db, user.user_id, sorted(convos, key=lambda c: c.seq or 0)),
+        messages=message_outs(db, sorted(messages, key=lambda m: (m.convo_id, m.seq or 0))),
+        next_after_seq=changes[-1].seq if changes else after_seq,
+        has_more=has_more,
+    )
+
+@app.get("/convos/{convo_id}/messages", response_model=MessagePageOut)
+def get_convo_messages(
+    convo_id: str,
+    before: Optional[str] = Query(None, description="next_before from the previous page"),
+    limit: int = Query(HISTORY_PAGE_DEFAULT, ge=1, le=HISTORY_PAGE_MAX),
+    if_none_match: Annotated[Optional[str], Header()] = None,
+    user: AuthedUser = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """One convo's history, newest first, paging backward on (created_at, id).
+
+    Every change to the convo or its messages bumps Convo.seq, so (seq, before,
+    limit) identifies a page's content and is used as its ETag; a matching
+    If-None-Match is answered with 304 before any message is read.
+    """
+    q = (
+        select(Convo.seq)
+        .join(ConvoParticipant, ConvoParticipant.convo_id == Convo.id)
+        .where(and_(Convo.id == convo_id, ConvoParticipant.user_id == int(user.user_id)))
+    )
+    seq = db.execute(q).scalar_one_or_none()
+    if seq is None:
+        raise HTTPException(status_code=404, detail="Convo not found")
+    page_key = hashlib.blake2b(f"{before or ''}:{limit}".encode(), digest_size=6).hexdigest()
+    etag = f'W/"{seq or 0}-{page_key}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+
+    cursor = decode_cursor(before)
+    q = select(Message).where(Message.convo_id == convo_id)
+    if cursor:
+        q = q.where(keyset_before(Message.created_at, Message.id, cursor))
+    q = q.order_by(Message.created_at.desc(), Message.id.desc()).limit(limit + 1)
     rows = db.execute(q).scalars().all()
-    return [
-        MessageOut(
-            id=m.id,
-            local_id=m.local_id,
-            convo_id=m.convo_id,
-            sender_id=str(m.sender_id) if m.sender_id is not None else None,
-            content=None if m.deleted else m.content,
-            deleted=m.deleted,
-            created_at=m.created_at,
-            updated_at=m.updated_at,
+    if len(rows) <= limit:
+        # older history continues in the archive
+        rows += archive.history(db, convo_id, (rows[-1].created_at, rows[-1].id) if rows else cursor, limit + 1 - len(rows))
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    page = MessagePageOut(
+        messages=message_outs(db, rows),
+        next_before=encode_cursor(rows[-1].created_at, rows[-1].id) if has_more else None,
+        has_more=has_more,
+    )
+    return JSONResponse(page.model_dump(mode="json"), headers=headers)
+
+@app.get("/search", response_model=SearchPageOut)
+def search_messages(
+    q: str = Query(..., min_length=1, max_length=256, description="Words to find; the last one also matches as a prefix"),
+    convo_id: Optional[str] = Query(None, description="Only search this convo"),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    limit: int = Query(SEARCH_PAGE_DEFAULT, ge=1, le=SEARCH_PAGE_MAX),
+    user: AuthedUser = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Full-text search over the caller's convos, best match first."""
+    offset = decode_offset_cursor(cursor)
+    terms = search_terms(q)
+    convo_ids = manager.membership.convos_for_user(db, user.user_id)
+    if convo_id is not None:
+        convo_ids = convo_ids & {convo_id}
+    if not terms or not convo_ids or offset >= SEARCH_MAX_OFFSET:
+        return SearchPageOut(messages=[], has_more=False)
+    limit = min(limit, SEARCH_MAX_OFFSET - offset)
+    t0 = time.perf_counter()
+    rows = search_index.search(db, sorted(convo_ids), terms, limit + 1, offset)
+    metrics.observe("chat_search_seconds", time.perf_counter() - t0, index=search_index.name)
+    has_more = len(rows) > limit and offset + limit < SEARCH_MAX_OFFSET
+    return SearchPageOut(
+        messages=message_outs(db, rows[:limit]),
+        next_cursor=encode_offset_cursor(offset + limit) if has_more else None,
+        has_more=has_more,
+    )
+
+@app.get("/convos/{convo_id}/receipts", response_model=List[ReceiptOut])
+def get_receipts(
+    convo_id: str,
+    user: AuthedUser = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Every participant's delivered/seen watermarks, for drawing ticks on open."""
+    q = select(ConvoParticipant.user_id, ConvoParticipant.delivered_upto, ConvoParticipant.seen_upto).where(ConvoParticipant.convo_id == convo_id)
+    rows = db.execute(q).all()
+    if not any(str(r.user_id) == user.user_id for r in rows):
+        raise HTTPException(status_code=404, detail="Convo not found")
+    return [ReceiptOut(user_id=str(r.user_id), delivered_upto=r.delivered_upto or 0, seen_upto=r.seen_upto or 0) for r in rows]
+
+# -----------------------------
+# Attachments
+# -----------------------------
+# Files never travel through the messages table or the websocket: a client
+# uploads the bytes in chunks (POST /attachments, then PUT with Content-Range,
+# resumable from `received`), and a message carries only attachment ids. The
+# finished file is renamed to blobs/<sha256>, so identical uploads share one
+# file. Downloads are FileResponses (Range requests, and zero-copy pathsend where
+# the server supports it) or, with ATTACHMENT_ACCEL_PREFIX, handed to the
+# reverse proxy via X-Accel-Redirect.
+ATTACHMENT_DIR = os.getenv("ATTACHMENT_DIR", "./attachments")
+ATTACHMENT_MAX_BYTES = int(os.getenv("ATTACHMENT_MAX_BYTES", str(100 * 1024 * 1024)))
+ATTACHMENT_CHUNK_MAX = int(os.getenv("ATTACHMENT_CHUNK_MAX", str(8 * 1024 * 1024)))  # bytes per PUT
+ATTACHMENT_MAX_PER_MESSAGE = int(os.getenv("ATTACHMENT_MAX_PER_MESSAGE", "10"))
+ATTACHMENT_UPLOAD_TTL_HOURS = float(os.getenv("ATTACHMENT_UPLOAD_TTL_HOURS", "24"))  # see `gc-attachments`
+ATTACHMENT_ACCEL_PREFIX = os.getenv("ATTACHMENT_ACCEL_PREFIX")  # e.g. "/_blobs/", an nginx internal location on ATTACHMENT_DIR/blobs
+# served inline; anything else is a download, so uploaded HTML/SVG never renders on our origin
+ATTACHMENT_INLINE_TYPES = {
+    "image/png", "image/jpeg", "image/gif", "image/webp",
+    "video/mp4", "video/webm", "audio/mpeg", "audio/ogg", "audio/webm", "audio/mp4",
+}
+CONTENT_RANGE_RE = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+
+def blob_path(sha256: str) -> str:
+    return os.path.join(ATTACHMENT_DIR, "blobs", sha256[:2], sha256[2:4], sha256)
+
+def upload_path(attachment_id: str) -> str:
+    return os.path.join(ATTACHMENT_DIR, "uploads", f"{attachment_id}.part")
+
+def write_chunk(path: str, offset: int, data: bytes):
+    """Write `data` at `offset` and fsync, so `received` never runs ahead of the disk."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o640)
+    try:
+        os.pwrite(fd, data, offset)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def store_blob(part: str, expected: Optional[str] = None) -> str:
+    """Hash a finished upload and, unless it differs from `expected` (then it is
+    discarded), move it to its content address. Returns the sha256.
+
+    The rename also replaces an existing identical blob, which refreshes its mtime
+    so `gc-attachments` leaves it alone while the new row commits.
+    """
+    h = hashlib.sha256()
+    with open(part, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    digest = h.hexdigest()
+    if expected and digest != expected:
+        os.remove(part)
+        return digest
+    dest = blob_path(digest)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    os.replace(part, dest)
+    return digest
+
+def attachment_out(a: Attachment) -> AttachmentOut:
+    return AttachmentOut(id=a.id, filename=a.filename, content_type=a.content_type, size=a.size, sha256=a.sha256)
+
+def upload_out(a: Attachment) -> AttachmentUploadOut:
+    return AttachmentUploadOut(
+        id=a.id, size=a.size, received=a.received, status=a.status, chunk_max=ATTACHMENT_CHUNK_MAX,
+        attachment=attachment_out(a) if a.status == "ready" else None,
+    )
+
+def attachment_refs(db: Session, message_ids: List[str]) -> Dict[str, List[AttachmentOut]]:
+    """message id -> its attachments in order, for the messages that have any."""
+    refs: Dict[str, List[AttachmentOut]] = {}
+    for i in range(0, len(message_ids), 500):
+        q = (
+            select(MessageAttachment.message_id, Attachment)
+            .join(Attachment, Attachment.id == MessageAttachment.attachment_id)
+            .where(MessageAttachment.message_id.in_(message_ids[i:i + 500]))
+            .order_by(MessageAttachment.message_id, MessageAttachment.position)
         )
-        for m in rows
-    ]
+        for message_id, a in db.execute(q).all():
+            refs.setdefault(message_id, []).append(attachment_out(a))
+    return refs
+
+def readable_attachment(db: Session, user_id: str, attachment_id: str) -> Attachment:
+    """The attachment if the caller uploaded it or it is on a message in one of their convos; else 404."""
+    a = db.get(Attachment, attachment_id)
+    if a is not None and a.uploader_id != int(user_id):
+        q = select(MessageAttachment.convo_id).where(MessageAttachment.attachment_id == attachment_id)
+        convo_ids = set(db.execute(q).scalars().all())
+        if not convo_ids & manager.membership.convos_for_user(db, user_id):
+            a = None
+    if a is None:
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    return a
+
+def db_own_upload(db: Session, user_id: str, attachment_id: str) -> Attachment:
+    a = db.get(Attachment, attachment_id)
+    if a is None or a.uploader_id != int(user_id):
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return a
+
+def db_record_chunk(db: Session, attachment_id: str, start: int, end: int) -> bool:
+    """Move `received` from start to end; False if another request moved it first."""
+    q = update(Attachment).where(and_(Attachment.id == attachment_id, Attachment.received == start, Attachment.status == "uploading"))
+    moved = db.execute(q.values(received=end)).rowcount
+    db.commit()
+    return moved > 0
+
+def db_complete_upload(db: Session, attachment_id: str, digest: Optional[str]) -> Attachment:
+    """Mark the upload ready with its digest, or (digest None) start it over."""
+    a = db.get(Attachment, attachment_id)
+    if digest is None:
+        a.received = 0
+    else:
+        a.sha256 = digest
+        a.status = "ready"
+        a.completed_at = datetime.now(timezone.utc)
+    db.commit()
+    db.refresh(a)  # returned after the session closes
+    return a
+
+# one chunk at a time per upload: attachment id -> [lock, requests holding or awaiting it]
+upload_locks: Dict[str, list] = {}
+
+@app.post("/attachments", response_model=AttachmentUploadOut, status_code=201)
+def create_upload(body: AttachmentCreateIn, user: AuthedUser = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Start a resumable upload of `size` bytes."""
+    if body.size > ATTACHMENT_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"Attachment too large (max {ATTACHMENT_MAX_BYTES} bytes)")
+    a = Attachment(
+        id=str(uuid4()),
+        uploader_id=int(user.user_id),
+        filename=body.filename,
+        content_type=(body.content_type or "application/octet-stream").lower(),
+        size=body.size,
+        expected_sha256=body.sha256.lower() if body.sha256 else None,
+    )
+    db.add(a)
+    db.commit()
+    return upload_out(a)
+
+@app.put("/attachments/{attachment_id}", response_model=AttachmentUploadOut)
+async def upload_chunk(
+    attachment_id: str,
+    request: Request,
+    content_range: Annotated[Optional[str], Header()] = None,
+    user: AuthedUser = Depends(get_current_user),
+):
+    """Store bytes start-end (Content-Range: bytes start-end/size) of an upload.
+
+    Chunks must continue from `received`; bytes before it are accepted and
+    skipped, so a chunk whose response was lost can simply be sent again. The
+    last chunk completes the upload: the file is hashed, checked against the
+    declared sha256 if any, and moved to its content address.
+    """
+    m = CONTENT_RANGE_RE.match(content_range or "")
+    if not m:
+        raise HTTPException(status_code=400, detail="Content-Range: bytes <start>-<end>/<size> required")
+    start, end, total = (int(g) for g in m.groups())
+    if end < start or end - start + 1 > ATTACHMENT_CHUNK_MAX:
+        raise HTTPException(status_code=413 if end >= start else 400, detail=f"Chunks are 1..{ATTACHMENT_CHUNK_MAX} bytes")
+    entry = upload_locks.setdefault(attachment_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            a = await run_db(db_own_upload, user.user_id, attachment_id)
+            if a.status == "ready":
+                return upload_out(a)
+            if total != a.size or end >= a.size:
+                raise HTTPException(status_code=400, detail=f"Upload size is {a.size}")
+            if start > a.received:
+                raise HTTPException(status_code=409, detail={"error": "Chunk does not continue the upload", "received": a.received})
+            data = bytearray()
+            async for block in request.stream():
+                data += block
+                if len(data) > end - start + 1:
+                    break
+            if len(data) != end - start + 1:
+                raise HTTPException(status_code=400, detail="Body length does not match Content-Range")
+            if end >= a.received:
+                await asyncio.to_thread(write_chunk, upload_path(a.id), a.received, bytes(data[a.received - start:]))
+                if not await run_db(db_record_chunk, a.id, a.received, end + 1):
+                    raise HTTPException(status_code=409, detail="Upload changed concurrently; fetch its status and resume")
+                a.received = end + 1
+            if a.received == a.size:
+                digest = await asyncio.to_thread(store_blob, upload_path(a.id), a.expected_sha256)
+                if a.expected_sha256 and digest != a.expected_sha256:
+                    await run_db(db_complete_upload, a.id, None)
+                    raise HTTPException(status_code=422, detail="sha256 mismatch; the upload was reset")
+                a = await run_db(db_complete_upload, a.id, digest)
+                metrics.inc("chat_attachment_bytes_total", a.size)
+            return upload_out(a)
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del upload_locks[attachment_id]
+
+@app.get("/attachments/{attachment_id}", response_model=AttachmentUploadOut)
+def get_attachment(attachment_id: str, user: AuthedUser = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Metadata, and for the uploader the progress to resume from."""
+    return upload_out(readable_attachment(db, user.user_id, attachment_id))
+
+@app.get("/attachments/{attachment_id}/content")
+def download_attachment(
+    attachment_id: str,
+    if_none_match: Annotated[Optional[str], Header()] = None,
+    user: AuthedUser = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """The file. Content never changes, so its sha256 is a strong ETag and it may be cached for good."""
+    a = readable_attachment(db, user.user_id, attachment_id)
+    if a.status != "ready":
+        raise HTTPException(status_code=409, detail="Upload not complete")
+    etag = f'"{a.sha256}"'
+    inline = a.content_type in ATTACHMENT_INLINE_TYPES
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=31536000, immutable", "X-Content-Type-Options": "nosniff"}
+    if if_none_match and etag in [t.strip() for t in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    if ATTACHMENT_ACCEL_PREFIX:
+        headers["X-Accel-Redirect"] = ATTACHMENT_ACCEL_PREFIX + os.path.relpath(blob_path(a.sha256), os.path.join(ATTACHMENT_DIR, "blobs"))
+        headers["Content-Disposition"] = "inline" if inline else "attachment"
+        return Response(media_type=a.content_type, headers=headers)
+    return FileResponse(
+        blob_path(a.sha256), media_type=a.content_type, headers=headers,
+        filename=a.filename or a.id, content_disposition_type="inline" if inline else "attachment",
+    )
+
+metrics.counter("chat_attachment_bytes_total", "Bytes of completed uploads")
+
+def gc_attachments(bind, cutoff: datetime) -> Dict[str, int]:
+    """Drop uploads started before `cutoff` that never finished or were never put
+    on a (live) message, then unlink the blobs no row refers to any more.
+    """
+    if cutoff.tzinfo is not None:  # stored timestamps are naive UTC
+        cutoff = cutoff.astimezone(timezone.utc).replace(tzinfo=None)
+    unused = or_(Attachment.status == "uploading", Attachment.id.not_in(select(MessageAttachment.attachment_id)))
+    with Session(bind) as db, db.begin():
+        stale = db.execute(select(Attachment.id, Attachment.sha256).where(and_(Attachment.created_at < cutoff, unused))).all()
+        for i in range(0, len(stale), 500):
+            db.execute(delete(Attachment).where(Attachment.id.in_([r.id for r in stale[i:i + 500]])))
+    removed_blobs = 0
+    for r in stale:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(upload_path(r.id))
+    with bind.connect() as conn:
+        for sha in {r.sha256 for r in stale if r.sha256}:
+            path = blob_path(sha)
+            if conn.execute(select(Attachment.id).where(Attachment.sha256 == sha).limit(1)).first() is not None:
+                continue
+            # a blob renamed into place after the cutoff may belong to an upload still committing
+            with contextlib.suppress(FileNotFoundError):
+                if datetime.fromtimestamp(os.path.getmtime(path), timezone.utc).replace(tzinfo=None) < cutoff:
+                    os.remove(path)
+                    removed_blobs += 1
+    return {"attachments": len(stale), "blobs": removed_blobs}
 
 # -----------------------------
 # WebSocket Realtime
@@ -308,265 +2162,1561 @@ class EventType(str, Enum):
     CREATE_CONVO = "CREATE_CONVO"
     UPDATE_CONVO = "UPDATE_CONVO"
     SEND_MESSAGE = "SEND_MESSAGE"
+    SEND_MESSAGES = "SEND_MESSAGES"  # bulk outbox replay, fanned out once per convo
     DELETE_MESSAGE = "DELETE_MESSAGE"
     UPDATE_MESSAGE = "UPDATE_MESSAGE"
     MESSAGE_DELIVERED = "MESSAGE_DELIVERED"
     MESSAGE_SEEN = "MESSAGE_SEEN"
+    RECEIPTS = "RECEIPTS"  # server -> client: coalesced watermark updates
+    TYPING = "TYPING"  # {convo_id, typing}; relayed to the convo as {convo_id, user_id, typing}
+    PRESENCE = "PRESENCE"  # server -> client: {users: [{user_id, online, last_seen}]}; client -> server: snapshot request
+    RESUMED = "RESUMED"  # server -> client: missed events were replayed after HELLO
+    RESYNC_REQUIRED = "RESYNC_REQUIRED"  # server -> client: the gap is not buffered, sync over REST
 
 class WSMessage(BaseModel):
     type: EventType
     payload: Dict[str, Any]
 
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", "10000"))
+
+class MembershipIndex:
+    """In-process convo_id -> member ids and user_id -> convo ids, lazily filled.
+
+    Both maps are size-bounded LRUs. Writers that change participants must call
+    `add_members` in the same request so cached entries never go stale. A load
+    that read the database before such a change is not cached: every key has a
+    generation that add_members/invalidate bump, and the fill is dropped if it
+    moved while the query ran.
+    """
+
+    def __init__(self, max_entries: int = MEMBERSHIP_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.members_by_convo: "OrderedDict[str, set]" = OrderedDict()
+        self.convos_by_user: "OrderedDict[str, set]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # (map, key) -> generation, bounded; forgotten keys read as `generation_floor`,
+        # the newest generation ever forgotten, so an eviction never looks like "unchanged"
+        self.generations: "OrderedDict[tuple, int]" = OrderedDict()
+        self.generation_floor = 0
+        self._next_generation = itertools.count(1)
+
+    def _get(self, cache: OrderedDict, key: str) -> Optional[set]:
+        with self.lock:
+            entry = cache.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            cache.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def _gen_key(self, cache: OrderedDict, key: str) -> tuple:
+        return ("convo" if cache is self.members_by_convo else "user", key)
+
+    def generation(self, cache: OrderedDict, key: str) -> int:
+        """Take before reading the database; pass to _put with the result."""
+        with self.lock:
+            return self.generations.get(self._gen_key(cache, key), self.generation_floor)
+
+    def _bump(self, cache: OrderedDict, key: str):
+        # caller holds the lock
+        gk = self._gen_key(cache, key)
+        self.generations[gk] = next(self._next_generation)
+        self.generations.move_to_end(gk)
+        while len(self.generations) > 2 * self.max_entries:
+            _, gen = self.generations.popitem(last=False)
+            self.generation_floor = max(self.generation_floor, gen)
+
+    def _put(self, cache: OrderedDict, key: str, value: set, generation: int):
+        with self.lock:
+            if self.generations.get(self._gen_key(cache, key), self.generation_floor) != generation:
+                return  # membership changed while this was loading
+            cache[key] = value
+            cache.move_to_end(key)
+            while len(cache) > self.max_entries:
+                cache.popitem(last=False)
+
+    def cached_members(self, convo_id: str) -> Optional[set]:
+        return self._get(self.members_by_convo, convo_id)
+
+    def members(self, db: Session, convo_id: str) -> set:
+        cached = self.cached_members(convo_id)
+        if cached is not None:
+            return cached
+        return self.load_members(db, convo_id)
+
+    def load_members(self, db: Session, convo_id: str) -> set:
+        generation = self.generation(self.members_by_convo, convo_id)
+        q = select(ConvoParticipant.user_id).where(ConvoParticipant.convo_id == convo_id)
+        ids = {str(row[0]) for row in db.execute(q).all()}
+        self._put(self.members_by_convo, convo_id, ids, generation)
+        return ids
+
+    def convos_for_user(self, db: Session, user_id: str) -> set:
+        cached = self._get(self.convos_by_user, user_id)
+        if cached is not None:
+            return cached
+        generation = self.generation(self.convos_by_user, user_id)
+        q = select(ConvoParticipant.convo_id).where(ConvoParticipant.user_id == int(user_id))
+        ids = {row[0] for row in db.execute(q).all()}
+        self._put(self.convos_by_user, user_id, ids, generation)
+        return ids
+
+    def is_member(self, db: Session, convo_id: str, user_id: str) -> bool:
+        return str(user_id) in self.members(db, convo_id)
+
+    def add_members(self, convo_id: str, user_ids):
+        """Record committed participant rows; only entries already cached are touched."""
+        user_ids = {str(u) for u in user_ids}
+        with self.lock:
+            self._bump(self.members_by_convo, convo_id)
+            members = self.members_by_convo.get(convo_id)
+            if members is not None:
+                self.members_by_convo[convo_id] = members | user_ids
+            for uid in user_ids:
+                self._bump(self.convos_by_user, uid)
+                convos = self.convos_by_user.get(uid)
+                if convos is not None:
+                    self.convos_by_user[uid] = convos | {convo_id}
+
+    def invalidate(self, convo_id: Optional[str] = None, user_id: Optional[str] = None):
+        with self.lock:
+            if convo_id is not None:
+                self._bump(self.members_by_convo, convo_id)
+                self.members_by_convo.pop(convo_id, None)
+            if user_id is not None:
+                self._bump(self.convos_by_user, str(user_id))
+                self.convos_by_user.pop(str(user_id), None)
+
+    def cached_peers(self, user_id: str) -> Optional[set]:
+        """Everyone sharing a convo with `user_id`, or None if anything is not cached."""
+        with self.lock:
+            convos = self.convos_by_user.get(user_id)
+            if convos is None:
+                return None
+            peers = set()
+            for convo_id in convos:
+                members = self.members_by_convo.get(convo_id)
+                if members is None:
+                    return None
+                peers |= members
+            return peers
+
+    def peers(self, db: Session, user_id: str) -> set:
+        """Like cached_peers, loading whatever is missing in one query per 500 convos."""
+        convos = self.convos_for_user(db, user_id)
+        found: Dict[str, set] = {}
+        with self.lock:
+            for convo_id in convos:
+                members = self.members_by_convo.get(convo_id)
+                if members is not None:
+                    found[convo_id] = members
+        missing = [c for c in convos if c not in found]
+        for i in range(0, len(missing), 500):
+            chunk = missing[i:i + 500]
+            loaded: Dict[str, set] = {c: set() for c in chunk}
+            generations = {c: self.generation(self.members_by_convo, c) for c in chunk}
+            q = select(ConvoParticipant.convo_id, ConvoParticipant.user_id).where(ConvoParticipant.convo_id.in_(chunk))
+            for convo_id, uid in db.execute(q).all():
+                loaded[convo_id].add(str(uid))
+            for convo_id, ids in loaded.items():
+                self._put(self.members_by_convo, convo_id, ids, generations[convo_id])
+            found.update(loaded)
+        return set().union(*found.values()) if found else set()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "convos": len(self.members_by_convo),
+            "users": len(self.convos_by_user),
+        }
+
+OUTBOUND_QUEUE_SIZE = int(os.getenv("OUTBOUND_QUEUE_SIZE", "256"))
+# What to do with a consumer whose outbound queue is full:
+#   drop       - discard the new frame
+#   coalesce   - frames with a coalesce key replace the queued frame with the same key
+#                (latest state wins); if the queue is still full, disconnect
+#   disconnect - close the socket; the client resyncs over REST when it reconnects
+SLOW_CONSUMER_POLICY = os.getenv("SLOW_CONSUMER_POLICY", "coalesce")
+
+# Wire formats. Clients pick a format by offering a WebSocket subprotocol; the first one offered
+# that the server supports wins. Clients that offer none get JSON text frames, so
+# existing clients keep working. Datetimes are ISO 8601 strings in both formats,
+# the same as the REST responses.
+WS_SUBPROTOCOL_JSON = "chat.v1.json"
+WS_SUBPROTOCOL_MSGPACK = "chat.v1.msgpack"
+
+def _wire_default(o):
+    if isinstance(o, datetime):
+        return o.isoformat()
+    if isinstance(o, Enum):
+        return o.value
+    return str(o)
+
+def encode_event(data: Dict[str, Any]) -> str:
+    """JSON text frame. orjson when installed (native datetimes, no Python-level walk)."""
+    if orjson is not None:
+        return orjson.dumps(data, default=_wire_default, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(data, default=_wire_default, separators=(",", ":"))
+
+class WireCodec:
+    def __init__(self, name: str, subprotocol: Optional[str], binary: bool, encode, decode):
+        self.name = name
+        self.subprotocol = subprotocol
+        self.binary = binary
+        self.encode = encode  # dict -> str (text frame) or bytes (binary frame)
+        self.decode = decode  # bytes -> dict
+
+JSON_CODEC = WireCodec("json", None, False, encode_event, lambda raw: json.loads(raw))
+CODECS: Dict[str, WireCodec] = {WS_SUBPROTOCOL_JSON: WireCodec("json", WS_SUBPROTOCOL_JSON, False, encode_event, JSON_CODEC.decode)}
+if msgpack is not None:
+    CODECS[WS_SUBPROTOCOL_MSGPACK] = WireCodec(
+        "msgpack", WS_SUBPROTOCOL_MSGPACK, True,
+        lambda data: msgpack.packb(data, default=_wire_default, use_bin_type=True),
+        lambda raw: msgpack.unpackb(raw, raw=False),
+    )
+
+def negotiate_codec(websocket: WebSocket) -> WireCodec:
+    for proto in websocket.scope.get("subprotocols") or ():
+        codec = CODECS.get(proto)
+        if codec is not None:
+            return codec
+    return JSON_CODEC
+
+class OutboundEvent:
+    """An event being fanned out, encoded at most once per wire format."""
+
+    __slots__ = ("data", "frames")
+
+    def __init__(self, data: Dict[str, Any]):
+        self.data = data
+        self.frames: Dict[str, Any] = {}
+
+    def frame(self, codec: WireCodec):
+        frame = self.frames.get(codec.name)
+        if frame is None:
+            frame = self.frames[codec.name] = codec.encode(self.data)
+        return frame
+
+class ClientConnection:
+    """One socket with a bounded outbound queue drained by its own writer task.
+
+    `send` never awaits, so a slow client only ever backs up its own queue.
+    """
+
+    def __init__(self, user_id: str, websocket: WebSocket, codec: WireCodec = JSON_CODEC, max_queue: int = OUTBOUND_QUEUE_SIZE, policy: str = SLOW_CONSUMER_POLICY):
+        self.user_id = user_id
+        self.websocket = websocket
+        self.codec = codec
+        self.max_queue = max_queue
+        self.policy = policy
+        # entries are [coalesce_key, frame]; `keyed` points at queued entries by key.
+        # A superseded entry stays in place with frame None until drained or compacted.
+        self.queue: Deque[list] = deque()
+        self.keyed: Dict[str, list] = {}
+        self.stale = 0
+        self.ready = asyncio.Event()
+        self.writer: Optional[asyncio.Task] = None
+        self.closed = False
+        self.dropped = 0
+
+    def start(self):
+        self.writer = asyncio.create_task(self._drain())
+
+    def send(self, frame, key: Optional[str] = None) -> bool:
+        if self.closed:
+            return False
+        superseded = self.keyed.get(key) if key is not None and self.policy == "coalesce" else None
+        if superseded is not None:
+            # the new frame goes to the tail, not into the old one's slot, so frames
+            # still leave in broadcast (event_id) order and a resume point is never
+            # ahead of an event the client has not received
+            superseded[1] = None
+            self.stale += 1
+            if self.stale > self.max_queue:
+                self._compact()
+        elif self.queued() >= self.max_queue:
+            if self.policy == "drop":
+                self.dropped += 1
+                metrics.inc("chat_ws_outbound_dropped_total")
+                return False
+            metrics.inc("chat_ws_slow_consumer_closes_total")
+            log.warning("ws.slow_consumer user=%s queued=%d policy=%s", self.user_id, self.queued(), self.policy)
+            self.abort()
+            return False
+        entry = [key, frame]
+        self.queue.append(entry)
+        if key is not None:
+            self.keyed[key] = entry
+        self.ready.set()
+        return True
+
+    def queued(self) -> int:
+        return len(self.queue) - self.stale
+
+    def _compact(self):
+        self.queue = deque(e for e in self.queue if e[1] is not None)
+        self.stale = 0
+
+    def send_event(self, data: Dict[str, Any]) -> bool:
+        return self.send(self.codec.encode(data))
+
+    def send_shared(self, event: OutboundEvent, key: Optional[str] = None) -> bool:
+        return self.send(event.frame(self.codec), key)
+
+    async def _drain(self):
+        try:
+            while True:
+                while not self.queue:
+                    self.ready.clear()
+                    await self.ready.wait()
+                entry = self.queue.popleft()
+                key, frame = entry
+                if frame is None:
+                    self.stale -= 1
+                    continue
+                if key is not None and self.keyed.get(key) is entry:
+                    del self.keyed[key]
+                t0 = time.perf_counter()
+                if self.codec.binary:
+                    await self.websocket.send_bytes(frame)
+                else:
+                    await self.websocket.send_text(frame)
+                metrics.observe("chat_ws_send_seconds", time.perf_counter() - t0)
+                metrics.inc("chat_ws_sent_bytes_total", len(frame), codec=self.codec.name)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # socket is gone; the receive loop sees the disconnect and cleans up
+            self.closed = True
+
+    def abort(self, code: int = 1013):
+        """Drop the queue and close the socket (default 1013: try again later)."""
+        if self.closed:
+            return
+        self.stop()
+        asyncio.get_running_loop().create_task(self._close(code))
+
+    async def _close(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    def stop(self):
+        self.closed = True
+        self.queue.clear()
+        self.keyed.clear()
+        self.stale = 0
+        if self.writer and not self.writer.done():
+            self.writer.cancel()
+
+REPLAY_BUFFER_SIZE = int(os.getenv("REPLAY_BUFFER_SIZE", "128"))  # events kept per user
+REPLAY_BUFFER_AGE_S = float(os.getenv("REPLAY_BUFFER_AGE_S", "120"))
+REPLAY_MAX_USERS = int(os.getenv("REPLAY_MAX_USERS", "100000"))
+
+class ReplayBuffer:
+    """Recently broadcast events per user, so a reconnecting client can catch up from memory.
+
+    Buffered events get an event_id that increases across the process; ids are only
+    comparable within one `stream_id`, which changes on restart. Each user's ring
+    keeps at most `size` events, none older than `max_age` seconds, and rings of
+    users who received nothing for `max_age` are dropped whole. `lost` remembers the
+    newest id evicted for each user, so resuming from before it is refused instead
+    of silently skipping events. It is bounded the same way: a record is forgotten
+    after `max_age` (or beyond `max_users` records) and its id raises `floor`, below
+    which every resume is refused.
+    """
+
+    def __init__(self, size: int = REPLAY_BUFFER_SIZE, max_age: float = REPLAY_BUFFER_AGE_S, max_users: int = REPLAY_MAX_USERS):
+        self.stream_id = uuid4().hex
+        self.last_id = 0
+        self.size = size
+        self.max_age = max_age
+        self.max_users = max_users
+        # user_id -> deque of (event_id, monotonic ts, OutboundEvent, coalesce_key); least recently written first
+        self.rings: "OrderedDict[str, Deque[tuple]]" = OrderedDict()
+        # user_id -> (newest evicted event_id, monotonic ts of the eviction); oldest first
+        self.lost: "OrderedDict[str, tuple]" = OrderedDict()
+        self.floor = 0  # at or above the id of every forgotten `lost` record
+
+    def next_id(self) -> int:
+        self.last_id += 1
+        return self.last_id
+
+    def add(self, user_id: str, event_id: int, event: OutboundEvent, key: Optional[str], now: float):
+        ring = self.rings.get(user_id)
+        if ring is None:
+            ring = self.rings[user_id] = deque()
+        else:
+            self.rings.move_to_end(user_id)
+        ring.append((event_id, now, event, key))
+        while len(ring) > self.size or now - ring[0][1] > self.max_age:
+            self._evicted(user_id, ring.popleft()[0], now)
+
+    def _evicted(self, user_id: str, event_id: int, now: float):
+        self.lost[user_id] = (event_id, now)
+        self.lost.move_to_end(user_id)
+
+    def prune(self, now: float):
+        while self.rings:
+            user_id, ring = next(iter(self.rings.items()))
+            if now - ring[-1][1] <= self.max_age and len(self.rings) <= self.max_users:
+                break
+            self.rings.popitem(last=False)
+            self._evicted(user_id, ring[-1][0], now)
+        while self.lost:
+            event_id, ts = next(iter(self.lost.values()))
+            if now - ts <= self.max_age and len(self.lost) <= self.max_users:
+                break
+            self.lost.popitem(last=False)
+            self.floor = max(self.floor, event_id)
+
+    def since(self, user_id: str, last_event_id: int) -> Optional[list]:
+        """Entries for `user_id` after `last_event_id`, or None if some were evicted."""
+        lost = self.lost.get(user_id)
+        if last_event_id > self.last_id or last_event_id < max(self.floor, lost[0] if lost else 0):
+            return None
+        entries = []
+        seen_keys = set()
+        # newest first, so a later event with the same coalesce key supersedes earlier ones
+        for entry in reversed(self.rings.get(user_id, ())):
+            if entry[0] <= last_event_id:
+                break
+            key = entry[3]
+            if key is not None:
+                if key in seen_keys:
+                    continue
+                seen_keys.add(key)
+            entries.append(entry)
+        entries.reverse()
+        return entries
+
+    def stats(self) -> Dict[str, int]:
+        return {"users": len(self.rings), "events": sum(len(r) for r in self.rings.values()), "last_event_id": self.last_id,
+                "lost": len(self.lost), "floor": self.floor}
+
 class ConnectionManager:
     def __init__(self):
-        # user_id -> set(WebSocket)
-        self.connections: Dict[str, List[WebSocket]] = {}
+        # user_id -> list(ClientConnection)
+        self.connections: Dict[str, List[ClientConnection]] = {}
+        self.membership = MembershipIndex()
+        self.replay = ReplayBuffer()
+
+    async def connect(self, user_id: str, websocket: WebSocket, hello: Dict[str, Any], resume_from: Optional[int] = None, stream_id: Optional[str] = None) -> ClientConnection:
+        """Accept and register a socket, queueing `hello` and, when resuming, the missed events.
+
+        There is no await between taking the replay snapshot and registering the
+        connection, so every later broadcast lands in the queue behind the replay.
+        """
+        codec = negotiate_codec(websocket)
+        await websocket.accept(subprotocol=codec.subprotocol)
+        conn = ClientConnection(user_id, websocket, codec)
+        conn.start()
+        conn.send_event({**hello, "stream_id": self.replay.stream_id, "event_id": self.replay.last_id})
+        if resume_from is not None:
+            self._resume(conn, resume_from, stream_id)
+        self.connections.setdefault(user_id, []).append(conn)
+        presence.connected(user_id)
+        return conn
 
-    async def connect(self, user_id: str, websocket: WebSocket):
-        await websocket.accept()
-        self.connections.setdefault(user_id, []).append(websocket)
+    def _resume(self, conn: ClientConnection, last_event_id: int, stream_id: Optional[str]):
+        entries = self.replay.since(conn.user_id, last_event_id) if stream_id == self.replay.stream_id else None
+        # the replay has to fit in the outbound queue next to HELLO and RESUMED
+        if entries is None or len(entries) + 2 > conn.max_queue:
+            metrics.inc("chat_ws_resumes_total", outcome="resync")
+            conn.send_event({"type": EventType.RESYNC_REQUIRED, "event_id": self.replay.last_id})
+            return
+        for _, _, event, key in entries:
+            conn.send_shared(event, key)
+        metrics.inc("chat_ws_resumes_total", outcome="replayed")
+        metrics.observe("chat_ws_replayed_events", len(entries))
+        conn.send_event({"type": EventType.RESUMED, "replayed": len(entries), "event_id": self.replay.last_id})
 
-    def disconnect(self, user_id: str, websocket: WebSocket):
+    def disconnect(self, user_id: str, conn: ClientConnection):
+        conn.stop()
         lst = self.connections.get(user_id, [])
-        if websocket in lst:
-            lst.remove(websocket)
+        if conn in lst:
+            lst.remove(conn)
         if not lst and user_id in self.connections:
             del self.connections[user_id]
+            presence.disconnected(user_id)
 
-    async def send_to_user(self, user_id: str, data: Dict[str, Any]):
-        for ws in self.connections.get(user_id, []):
-            await ws.send_text(json.dumps(data, default=str))
+    def send_to_users(self, user_ids, data: Dict[str, Any], exclude_user: Optional[str] = None, key: Optional[str] = None, replay: bool = False) -> int:
+        """Encode `data` once per wire format and queue the frames for every listed user's sockets.
 
-    async def broadcast_to_convo(self, db: Session, convo_id: str, data: Dict[str, Any], exclude_user: Optional[str] = None):
-        # fetch participants
-        q = select(ConvoParticipant.user_id).where(ConvoParticipant.convo_id == convo_id)
-        user_ids = [row[0] for row in db.execute(q).all()]
+        With `replay` the event gets an event_id and is kept in each recipient's
+        replay buffer, connected or not.
+        """
+        t0 = time.perf_counter()
+        event_id = None
+        if replay:
+            event_id = self.replay.next_id()
+            data = {**data, "event_id": event_id}
+        event = OutboundEvent(data)
+        now = time.monotonic()
+        sent = 0
         for uid in user_ids:
-            if exclude_user and str(uid) == str(exclude_user):
+            if exclude_user and uid == str(exclude_user):
                 continue
-            await self.send_to_user(str(uid), data)
+            sent += self.send_frame(uid, event, key)
+            if event_id is not None:
+                self.replay.add(uid, event_id, event, key, now)
+        if event_id is not None:
+            self.replay.prune(now)
+        metrics.observe("chat_fanout_recipients", sent)
+        metrics.observe("chat_fanout_seconds", time.perf_counter() - t0)
+        return sent
+
+    def send_frame(self, user_id: str, event: OutboundEvent, key: Optional[str] = None) -> int:
+        sent = 0
+        for conn in self.connections.get(user_id, ()):
+            sent += conn.send_shared(event, key)
+        return sent
+
+    async def send_to_user(self, user_id: str, data: Dict[str, Any]):
+        self.send_frame(user_id, OutboundEvent(data))
+
+    async def broadcast_to_convo(self, convo_id: str, data: Dict[str, Any], exclude_user: Optional[str] = None, key: Optional[str] = None, replay: bool = True):
+        """Queue `data` for every member's sockets (see send_to_users)."""
+        members = self.membership.cached_members(convo_id)
+        if members is None:
+            members = await run_db(self.membership.load_members, convo_id)
+        self.send_to_users(members, data, exclude_user, key, replay)
 
 manager = ConnectionManager()
 
+PRESENCE_OFFLINE_GRACE_S = float(os.getenv("PRESENCE_OFFLINE_GRACE_S", "5"))
+TYPING_TTL_S = float(os.getenv("TYPING_TTL_S", "6"))
+TYPING_INTERVAL_S = float(os.getenv("TYPING_INTERVAL_S", "2"))
+
+async def peers_of(user_id: str) -> set:
+    peers = manager.membership.cached_peers(user_id)
+    if peers is None:
+        peers = await run_db(manager.membership.peers, user_id)
+    return peers
+
+class PresenceTracker:
+    """Online/offline state and typing indicators, kept only in memory.
+
+    A user is online from their first socket until PRESENCE_OFFLINE_GRACE_S after
+    their last one closes, so a flapping connection announces nothing. Changes go
+    to connected convo peers, under a per-user coalesce key.
+
+    Typing state expires TYPING_TTL_S after the last TYPING event and is
+    broadcast only when it changes, at most once per user per convo every
+    TYPING_INTERVAL_S; a change inside the interval is sent when it ends.
+    """
+
+    def __init__(self, grace: float = PRESENCE_OFFLINE_GRACE_S, typing_ttl: float = TYPING_TTL_S, typing_interval: float = TYPING_INTERVAL_S):
+        self.grace = grace
+        self.typing_ttl = typing_ttl
+        self.typing_interval = typing_interval
+        self.online: set = set()
+        self.last_seen: Dict[str, str] = {}  # user_id -> when they went offline (ISO)
+        self.offline_timers: Dict[str, asyncio.TimerHandle] = {}
+        # (convo_id, user_id) -> {"typing", "sent", "sent_at", "flush", "expire"}
+        self.typing: Dict[tuple, Dict[str, Any]] = {}
+        self.tasks: set = set()
+
+    def _spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def status(self, user_id: str) -> Dict[str, Any]:
+        return {"user_id": user_id, "online": user_id in self.online, "last_seen": self.last_seen.get(user_id)}
+
+    def connected(self, user_id: str):
+        timer = self.offline_timers.pop(user_id, None)
+        if timer is not None:
+            timer.cancel()  # back within the grace period, peers never saw them leave
+        elif user_id not in self.online:
+            self.online.add(user_id)
+            self._spawn(self._announce(user_id))
+
+    def disconnected(self, user_id: str):
+        for convo_id, uid in [k for k in self.typing if k[1] == user_id]:
+            self.set_typing(convo_id, uid, False)
+        if user_id in self.online and user_id not in self.offline_timers:
+            self.offline_timers[user_id] = asyncio.get_running_loop().call_later(self.grace, self._went_offline, user_id)
+
+    def _went_offline(self, user_id: str):
+        self.offline_timers.pop(user_id, None)
+        if user_id in manager.connections:
+            return
+        self.online.discard(user_id)
+        self.last_seen[user_id] = datetime.now(timezone.utc).isoformat()
+        self._spawn(self._announce(user_id))
+
+    async def _announce(self, user_id: str):
+        peers = await peers_of(user_id)
+        # status is read after the await so a quick online/offline pair ends on the latest state
+        evt = {"type": EventType.PRESENCE, "payload": {"users": [self.status(user_id)]}}
+        manager.send_to_users(peers, evt, exclude_user=user_id, key=f"presence:{user_id}")
+
+    async def snapshot(self, conn: ClientConnection):
+        """One PRESENCE event with the state of every peer of `conn`'s user."""
+        peers = await peers_of(conn.user_id)
+        peers.discard(conn.user_id)
+        conn.send_event({"type": EventType.PRESENCE, "payload": {"users": [self.status(u) for u in sorted(peers)]}})
+
+    def set_typing(self, convo_id: str, user_id: str, typing: bool):
+        key = (convo_id, user_id)
+        entry = self.typing.get(key)
+        if entry is None:
+            if not typing:
+                return
+            entry = self.typing[key] = {"typing": False, "sent": False, "sent_at": float("-inf"), "flush": None, "expire": None}
+        entry["typing"] = typing
+        if entry["expire"] is not None:
+            entry["expire"].cancel()
+            entry["expire"] = None
+        loop = asyncio.get_running_loop()
+        if typing:
+            entry["expire"] = loop.call_later(self.typing_ttl, self.set_typing, convo_id, user_id, False)
+        if entry["flush"] is None:
+            wait = entry["sent_at"] + self.typing_interval - time.monotonic()
+            if wait <= 0:
+                self._flush_typing(key)
+            else:
+                entry["flush"] = loop.call_later(wait, self._flush_typing, key)
+
+    def _flush_typing(self, key: tuple):
+        entry = self.typing.get(key)
+        if entry is None:
+            return
+        entry["flush"] = None
+        if entry["typing"] != entry["sent"]:
+            entry["sent"] = entry["typing"]
+            entry["sent_at"] = time.monotonic()
+            convo_id, user_id = key
+            evt = {"type": EventType.TYPING, "payload": {"convo_id": convo_id, "user_id": user_id, "typing": entry["sent"]}}
+            self._spawn(manager.broadcast_to_convo(convo_id, evt, exclude_user=user_id, key=f"typing:{convo_id}:{user_id}", replay=False))
+            if not entry["sent"]:
+                # keep the entry one more interval so a quick restart is still throttled
+                entry["flush"] = asyncio.get_running_loop().call_later(self.typing_interval, self._flush_typing, key)
+        elif not entry["typing"]:
+            del self.typing[key]
+
+presence = PresenceTracker()
+
+def _open_connections():
+    return [c for conns in list(manager.connections.values()) for c in conns]
+
+def _connections_by_codec():
+    counts = {name: 0 for name in {c.name for c in CODECS.values()}}
+    for c in _open_connections():
+        counts[c.codec.name] += 1
+    return [({"codec": name}, n) for name, n in counts.items()]
+
+metrics.gauge("chat_ws_connections", "Open websocket connections by wire format", _connections_by_codec)
+metrics.gauge("chat_ws_users", "Users with at least one open websocket", lambda: len(manager.connections))
+metrics.gauge("chat_ws_outbound_queue_depth", "Frames waiting in outbound queues, summed over connections",
+              lambda: sum(c.queued() for c in _open_connections()))
+metrics.gauge("chat_ws_outbound_queue_depth_max", "Deepest outbound queue",
+              lambda: max((c.queued() for c in _open_connections()), default=0))
+metrics.gauge("chat_replay_buffered_events", "Events held in per-user replay buffers", lambda: manager.replay.stats()["events"])
+metrics.gauge("chat_membership_cache_hits_total", "MembershipIndex lookups answered from memory",
+              lambda: manager.membership.hits, kind="counter")
+metrics.gauge("chat_membership_cache_misses_total", "MembershipIndex lookups that went to the DB",
+              lambda: manager.membership.misses, kind="counter")
+
+# -----------------------------
+# WebSocket event handlers
+# -----------------------------
+# Each handler runs on the DB thread pool with its own short-lived session
+# (see run_db) and returns (convo_id, event, coalesce_key) for the caller to
+# broadcast. Client errors are raised as WSError. WS_HANDLERS below maps every
+# EventType to its handler and ordering keys.
+
+class WSError(Exception):
+    pass
+
+def db_create_convo(db: Session, user_id: str, payload: Dict[str, Any]):
+    convo_id = payload.get("id")
+    title = payload.get("title")
+    participant_ids: List[str] = [str(p) for p in payload.get("participants", [])]
+    if not convo_id:
+        raise WSError("Missing convo id")
+    convo = db.get(Convo, convo_id, with_for_update=True)
+    if not convo:
+        convo = Convo(id=convo_id, title=title, is_group=len(participant_ids) > 2)
+        db.add(convo)
+        db.commit()
+        convo = db.get(Convo, convo_id, with_for_update=True)
+    # ensure participants (include sender)
+    if user_id not in participant_ids:
+        participant_ids.append(user_id)
+    existing = {str(row[0]) for row in db.execute(select(ConvoParticipant.user_id).where(ConvoParticipant.convo_id == convo_id)).all()}
+    joined = [int(pid) for pid in set(participant_ids) - existing]
+    convo.updated_at = datetime.now(timezone.utc)
+    seq = record_change(db, convo, "convo", convo.id)
+    for pid in joined:
+        db.add(ConvoParticipant(convo_id=convo_id, user_id=pid, joined_seq=seq))
+    if joined:
+        db.flush()
+        summary_add_participants(db, convo_id, joined)
+    db.commit()
+    manager.membership.add_members(convo_id, participant_ids)
+    evt = {"type": EventType.CREATE_CONVO, "payload": {"convo": {"id": convo.id, "title": convo.title, "is_group": convo.is_group, "seq": convo.seq, "updated_at": convo.updated_at}}, "ack_local_id": convo.local_id}
+    return convo_id, evt, None
+
+def db_update_convo(db: Session, user_id: str, payload: Dict[str, Any]):
+    convo_id = payload.get("id")
+    title = payload.get("title")
+    if not convo_id:
+        raise WSError("Missing convo id")
+    convo = db.get(Convo, convo_id, with_for_update=True)
+    if not convo:
+        raise WSError("Convo not found")
+    if title is not None:
+        convo.title = title
+    convo.updated_at = datetime.now(timezone.utc)
+    record_change(db, convo, "convo", convo.id)
+    db.commit()
+    evt = {"type": EventType.UPDATE_CONVO, "payload": {"convo": {"id": convo.id, "title": convo.title, "seq": convo.seq, "updated_at": convo.updated_at}}, "ack_local_id": convo.local_id}
+    return convo_id, evt, f"convo:{convo_id}"
+
+def insert_messages(db: Session, items: List[Dict[str, Any]]) -> List[Any]:
+    """Stage a batch of messages, idempotent on (sender_id, local_id).
+
+    Membership and idempotency are checked with set-based lookups and every
+    touched convo is locked once. Attachment ids must name the sender's completed
+    uploads. New messages are flushed and reflected in the
+    convo summaries and search index. Returns one entry per item, the new or
+    previously stored Message or a WSError, and leaves the commit to the caller.
+    """
+    results: List[Any] = [None] * len(items)
+    todo = []
+    for i, item in enumerate(items):
+        if not item.get("local_id") or not item.get("convo_id"):
+            results[i] = WSError("Missing local_id or convo_id")
+        elif not manager.membership.is_member(db, item["convo_id"], item["sender_id"]):
+            results[i] = WSError("Not a participant")
+        else:
+            todo.append(i)
+    if not todo:
+        return results
+
+    # Idempotency check
+    senders = {int(items[i]["sender_id"]) for i in todo}
+    local_ids = {items[i]["local_id"] for i in todo}
+    q = select(Message).where(and_(Message.sender_id.in_(senders), Message.local_id.in_(local_ids)))
+    known = {(m.sender_id, m.local_id): m for m in db.execute(q).scalars()}
+    # a message archived since it was sent is still a duplicate
+    E = MessageArchiveEntry
+    q = select(E.message_id).where(and_(E.sender_id.in_(senders), E.local_id.in_(local_ids)))
+    archived_ids = db.execute(q).scalars().all()
+    if archived_ids:
+        for m in archive.get_many(db, archived_ids).values():
+            known.setdefault((m.sender_id, m.local_id), m)
+
+    # lock the convos first (in id order) so their seq counters stay gap-free
+    convo_ids = sorted({items[i]["convo_id"] for i in todo if (int(items[i]["sender_id"]), items[i]["local_id"]) not in known})
+    convos = {}
+    if convo_ids:
+        q = select(Convo).where(Convo.id.in_(convo_ids)).order_by(Convo.id).with_for_update()
+        convos = {c.id: c for c in db.execute(q).scalars()}
+
+    wanted = {a for i in todo if isinstance(items[i].get("attachments"), list) for a in items[i]["attachments"] if isinstance(a, str)}
+    uploads = {}
+    if wanted:
+        q = select(Attachment.id, Attachment.uploader_id).where(and_(Attachment.id.in_(wanted), Attachment.status == "ready"))
+        uploads = dict(db.execute(q).all())
+
+    now = datetime.now(timezone.utc)
+    new_messages = []
+    for i in todo:
+        item = items[i]
+        key = (int(item["sender_id"]), item["local_id"])
+        message = known.get(key)
+        if message is None:
+            convo = convos.get(item["convo_id"])
+            if convo is None:
+                results[i] = WSError("Convo not found")
+                continue
+            attachment_ids = item.get("attachments") or []
+            if not isinstance(attachment_ids, list) or len(attachment_ids) > ATTACHMENT_MAX_PER_MESSAGE or len(set(attachment_ids)) != len(attachment_ids):
+                results[i] = WSError(f"Invalid attachments (at most {ATTACHMENT_MAX_PER_MESSAGE} distinct ids)")
+                continue
+            if any(uploads.get(a) != key[0] for a in attachment_ids):
+                results[i] = WSError("Attachment not found")
+                continue
+            server_id = str(uuid4())
+            message = Message(id=server_id, local_id=item["local_id"], convo_id=convo.id, sender_id=key[0], content=item.get("content"))
+            message.seq = record_change(db, convo, "message", server_id)
+            db.add(message)
+            for pos, attachment_id in enumerate(attachment_ids):
+                db.add(MessageAttachment(message_id=server_id, attachment_id=attachment_id, convo_id=convo.id, position=pos))
+            # bump convo updated_at
+            convo.updated_at = now
+            known[key] = message
+            new_messages.append(message)
+        results[i] = message
+    if new_messages:
+        db.flush()
+        by_convo: Dict[str, List[Message]] = {}
+        for m in new_messages:
+            by_convo.setdefault(m.convo_id, []).append(m)
+        for convo_id, msgs in by_convo.items():
+            summary_add_messages(db, convo_id, msgs)
+        search_index.add(db, new_messages)
+    return results
+
+def _commit_messages(db: Session, items: List[Dict[str, Any]]) -> List[Any]:
+    """insert_messages + commit, returning message_event dicts (or WSError) per item."""
+    staged = insert_messages(db, items)
+    db.flush()
+    refs = attachment_refs(db, [m.id for m in staged if not isinstance(m, WSError)])
+    out = [m if isinstance(m, WSError) else message_event(m, refs.get(m.id)) for m in staged]
+    db.commit()
+    return out
+
+def db_commit_messages(db: Session, items: List[Dict[str, Any]]) -> List[Any]:
+    try:
+        return _commit_messages(db, items)
+    except IntegrityError:
+        # a concurrent writer stored one of these (sender_id, local_id) pairs first;
+        # redo item by item so the rest of the batch still lands
+        db.rollback()
+    out = []
+    for item in items:
+        try:
+            out.extend(_commit_messages(db, [item]))
+        except IntegrityError:
+            db.rollback()
+            out.extend(_commit_messages(db, [item]))
+    return out
+
+WRITE_BATCH_WINDOW_MS = float(os.getenv("WRITE_BATCH_WINDOW_MS", "2"))
+WRITE_BATCH_MAX = int(os.getenv("WRITE_BATCH_MAX", "256"))
+
+class MessageWriteBatcher:
+    """Group commit for SEND_MESSAGE.
+
+    Inserts from every connection are gathered for up to WRITE_BATCH_WINDOW_MS
+    (or WRITE_BATCH_MAX items) and committed in one transaction; each sender's
+    future resolves only once its batch is durable. While one batch commits the
+    next one accumulates, so a window of 0 still coalesces under load.
+    """
+
+    def __init__(self, window_ms: float = WRITE_BATCH_WINDOW_MS, max_items: int = WRITE_BATCH_MAX):
+        self.window = window_ms / 1000.0
+        self.max_items = max_items
+        self.pending: List[tuple] = []
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.items = 0
+
+    async def submit(self, item: Dict[str, Any]):
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self._run())
+        fut = asyncio.get_running_loop().create_future()
+        self.pending.append((item, fut))
+        self.wakeup.set()
+        result, db_seconds = await fut
+        # every sender waited for the whole commit, so each is charged for it
+        charge_db_time(db_seconds)
+        if isinstance(result, WSError):
+            raise result
+        return result
+
+    async def _run(self):
+        # this task inherited the context of whichever event started it; give it
+        # its own accumulator so batch DB time is handed to each sender instead
+        db_time = [0.0]
+        _event_db_time.set(db_time)
+        while True:
+            await self.wakeup.wait()
+            if self.window and len(self.pending) < self.max_items:
+                await asyncio.sleep(self.window)
+            batch = self.pending[:self.max_items]
+            del self.pending[:self.max_items]
+            if not self.pending:
+                self.wakeup.clear()
+            db_time[0] = 0.0
+            try:
+                results = await run_db(db_commit_messages, [item for item, _ in batch])
+            except Exception as e:
+                log.exception("messages.batch_failed size=%d", len(batch))
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            self.batches += 1
+            self.items += len(batch)
+            for (_, fut), result in zip(batch, results):
+                if not fut.done():
+                    fut.set_result((result, db_time[0]))
+
+message_batcher = MessageWriteBatcher()
+metrics.gauge("chat_write_batches_total", "Group commits of SEND_MESSAGE inserts", lambda: message_batcher.batches, kind="counter")
+metrics.gauge("chat_write_batch_items_total", "Messages written through group commit", lambda: message_batcher.items, kind="counter")
+
+async def send_message(conn: ClientConnection, user_id: str, payload: Dict[str, Any]):
+    if not payload.get("local_id") or not payload.get("convo_id"):
+        raise WSError("Missing local_id or convo_id")
+    item = {"sender_id": user_id, "convo_id": payload["convo_id"], "local_id": payload["local_id"], "content": payload.get("content"), "attachments": payload.get("attachments")}
+    m = await message_batcher.submit(item)
+    message_convos.put(m["id"], m["convo_id"])
+    return m["convo_id"], {"type": EventType.SEND_MESSAGE, "payload": {"message": m, "convo_seq": m["seq"]}, "ack_local_id": m["local_id"]}, None
+
+BULK_SEND_MAX = int(os.getenv("BULK_SEND_MAX", "500"))
+
+async def ingest_bulk(user_id: str, messages: List[Dict[str, Any]]):
+    """Outbox replay: store a list of messages in one transaction and fan out once per convo.
+
+    Returns (stored, rejected) where rejected items carry local_id, convo_id and error.
+    """
+    if len(messages) > BULK_SEND_MAX:
+        raise WSError(f"Too many messages (max {BULK_SEND_MAX})")
+    items = [{"sender_id": user_id, "convo_id": m.get("convo_id"), "local_id": m.get("local_id"), "content": m.get("content"), "attachments": m.get("attachments")} for m in messages]
+    results = await run_db(db_commit_messages, items) if items else []
+    stored, rejected = [], []
+    for item, r in zip(items, results):
+        if isinstance(r, WSError):
+            rejected.append({"local_id": item["local_id"], "convo_id": item["convo_id"], "error": str(r)})
+        else:
+            stored.append(r)
+    by_convo: Dict[str, List[Dict[str, Any]]] = {}
+    for m in stored:
+        message_convos.put(m["id"], m["convo_id"])
+        by_convo.setdefault(m["convo_id"], []).append(m)
+    for convo_id, msgs in by_convo.items():
+        evt = {"type": EventType.SEND_MESSAGES, "payload": {"convo_id": convo_id, "messages": msgs}, "ack_local_ids": [m["local_id"] for m in msgs]}
+        await manager.broadcast_to_convo(convo_id, evt)
+    return stored, rejected
+
+def _own_message(db: Session, user_id: str, mid: Optional[str], archived: bool = False) -> Message:
+    """The caller's message; from the archive too if `archived` (a transient copy)."""
+    if not mid:
+        raise WSError("Missing message id")
+    m = db.get(Message, mid)
+    if not m and archived:
+        m = archive.get_many(db, [mid]).get(mid)
+    if not m:
+        raise WSError("Message is archived" if archive.contains(db, mid) else "Message not found")
+    if m.sender_id != int(user_id):
+        raise WSError("Forbidden")
+    return m
+
+def db_delete_message(db: Session, user_id: str, payload: Dict[str, Any]):
+    """Delete one of the caller's messages, hot or archived; deleting twice is a no-op
+    that is still logged and broadcast.
+    """
+    m = _own_message(db, user_id, payload.get("id"), archived=True)
+    convo = db.get(Convo, m.convo_id, with_for_update=True)
+    now = datetime.now(timezone.utc)
+    # re-read under the lock; a concurrent writer may have changed or archived it
+    hot = db.execute(select(Message).where(Message.id == m.id).execution_options(populate_existing=True)).scalar_one_or_none()
+    if hot is not None:
+        m = hot
+    else:
+        m = archive.get_many(db, [m.id])[m.id]
+        if not m.deleted:
+            archive_delete(db, m.id, now)  # before the summaries look for the new last message
+    if not m.deleted:
+        summary_delete_message(db, m)
+        convo.updated_at = now  # every summary's message_count moved (and maybe the last message)
+        search_index.remove(db, [m.id])
+        # a deleted message's files are no longer reachable through it
+        db.execute(delete(MessageAttachment).where(MessageAttachment.message_id == m.id))
+    if hot is not None:
+        m.deleted = True
+        m.updated_at = now
+    convo_seq = record_change(db, convo, "message", m.id)
+    db.commit()
+    evt = {"type": EventType.DELETE_MESSAGE, "payload": {"id": m.id, "convo_id": m.convo_id, "convo_seq": convo_seq}, "ack_local_id": payload.get("local_id")}
+    return m.convo_id, evt, f"message:{m.id}"
+
+def db_update_message(db: Session, user_id: str, payload: Dict[str, Any]):
+    m = _own_message(db, user_id, payload.get("id"))
+    convo = db.get(Convo, m.convo_id, with_for_update=True)
+    db.refresh(m)
+    now = datetime.now(timezone.utc)
+    content = payload.get("content")
+    if content is not None:
+        m.content = content
+        search_index.remove(db, [m.id])
+        if not m.deleted:
+            search_index.add(db, [m])
+            if summary_edit_message(db, m):
+                convo.updated_at = now  # the chat list shows the new preview
+    m.updated_at = now
+    convo_seq = record_change(db, convo, "message", m.id)
+    db.commit()
+    evt = {"type": EventType.UPDATE_MESSAGE, "payload": {"message": message_event(m, attachment_refs(db, [m.id]).get(m.id)), "convo_seq": convo_seq}, "ack_local_id": m.local_id}
+    return m.convo_id, evt, f"message:{m.id}"
+
+def db_receipt(db: Session, user_id: str, event_type: EventType, payload: Dict[str, Any]):
+    """Advance the caller's delivered/seen watermark for a convo.
+
+    Clients ack a range with {"convo_id", "upto_seq"}; a single {"id"} ack is
+    read as "up to that message". Watermarks only move forward (seen implies
+    delivered). Returns (convo_id, receipt) or None when nothing moved.
+    """
+    convo_id = payload.get("convo_id")
+    if not convo_id:
+        raise WSError("Missing convo_id")
+    if not manager.membership.is_member(db, convo_id, user_id):
+        raise WSError("Not a participant")
+    upto = payload.get("upto_seq")
+    if upto is None and payload.get("id"):
+        upto = db.execute(select(Message.seq).where(and_(Message.id == payload["id"], Message.convo_id == convo_id))).scalar_one_or_none()
+    try:
+        upto = int(upto)
+    except (TypeError, ValueError):
+        raise WSError("Missing upto_seq")
+    head = db.execute(select(Convo.seq).where(Convo.id == convo_id)).scalar_one_or_none() or 0
+    upto = min(upto, head)
+
+    mine = and_(ConvoParticipant.convo_id == convo_id, ConvoParticipant.user_id == int(user_id))
+    # conditional updates, so concurrent acks from several devices never move a mark back
+    moved = db.execute(update(ConvoParticipant).where(and_(mine, ConvoParticipant.delivered_upto < upto)).values(delivered_upto=upto)).rowcount
+    if event_type == EventType.MESSAGE_SEEN:
+        # the row lock keeps old_seen exact for the unread delta
+        old_seen = db.execute(select(ConvoParticipant.seen_upto).where(mine).with_for_update()).scalar() or 0
+        values = {"seen_upto": upto, "last_read_at": datetime.now(timezone.utc)}
+        if db.execute(update(ConvoParticipant).where(and_(mine, ConvoParticipant.seen_upto < upto)).values(**values)).rowcount:
+            summary_seen(db, convo_id, int(user_id), old_seen, upto)
+            moved += 1
+    if not moved:
+        db.rollback()
+        return None
+    db.commit()
+    delivered, seen = db.execute(select(ConvoParticipant.delivered_upto, ConvoParticipant.seen_upto).where(mine)).one()
+    return convo_id, {"user_id": user_id, "delivered_upto": delivered, "seen_upto": seen}
+
+RECEIPT_FLUSH_MS = float(os.getenv("RECEIPT_FLUSH_MS", "500"))
+
+class ReceiptCoalescer:
+    """Throttle receipt fan-out to one RECEIPTS event per convo per interval.
+
+    Acks that land within the interval are merged per user (watermarks only grow,
+    so the highest value wins).
+    """
+
+    def __init__(self, interval_ms: float = RECEIPT_FLUSH_MS):
+        self.interval = interval_ms / 1000.0
+        self.pending: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self.tasks: set = set()
+
+    def add(self, convo_id: str, receipt: Dict[str, Any]):
+        receipts = self.pending.get(convo_id)
+        if receipts is None:
+            receipts = self.pending[convo_id] = {}
+            asyncio.get_running_loop().call_later(self.interval, self._flush, convo_id)
+        prev = receipts.get(receipt["user_id"])
+        if prev is not None:
+            receipt = {
+                "user_id": receipt["user_id"],
+                "delivered_upto": max(prev["delivered_upto"], receipt["delivered_upto"]),
+                "seen_upto": max(prev["seen_upto"], receipt["seen_upto"]),
+            }
+        receipts[receipt["user_id"]] = receipt
+
+    def _flush(self, convo_id: str):
+        receipts = self.pending.pop(convo_id, None)
+        if not receipts:
+            return
+        evt = {"type": EventType.RECEIPTS, "payload": {"convo_id": convo_id, "receipts": list(receipts.values())}}
+        task = asyncio.get_running_loop().create_task(manager.broadcast_to_convo(convo_id, evt))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+receipts = ReceiptCoalescer()
+
+async def send_messages(conn: ClientConnection, user_id: str, payload: Dict[str, Any]):
+    _, rejected = await ingest_bulk(user_id, payload.get("messages") or [])
+    if rejected:
+        conn.send_event({"type": "ERROR", "error": "Some messages were rejected", "rejected": rejected})
+
+async def typing_indicator(conn: ClientConnection, user_id: str, payload: Dict[str, Any]):
+    convo_id = payload.get("convo_id")
+    if not convo_id:
+        raise WSError("Missing convo_id")
+    members = manager.membership.cached_members(convo_id)
+    if members is None:
+        members = await run_db(manager.membership.load_members, convo_id)
+    if user_id not in members:
+        raise WSError("Not a participant")
+    presence.set_typing(convo_id, user_id, bool(payload.get("typing", True)))
+
+async def presence_snapshot(conn: ClientConnection, user_id: str, payload: Dict[str, Any]):
+    await presence.snapshot(conn)
+
+def on_db(fn):
+    """Adapt a `fn(db, user_id, payload)` handler to the registry signature."""
+    async def handler(conn: ClientConnection, user_id: str, payload: Dict[str, Any]):
+        return await run_db(fn, user_id, payload)
+    return handler
+
+def on_receipt(event_type: EventType):
+    async def handler(conn: ClientConnection, user_id: str, payload: Dict[str, Any]):
+        receipt = await run_db(db_receipt, user_id, event_type, payload)
+        if receipt is not None:
+            receipts.add(*receipt)
+    return handler
+
+# Ordering keys: events from one connection that share a key are handled one
+# after another in arrival order; everything else may run concurrently.
+def no_keys(payload: Dict[str, Any]) -> List[str]:
+    return []
+
+def convo_keys(field: str):
+    return lambda payload: [f"convo:{payload.get(field)}"]
+
+MESSAGE_CONVO_CACHE_SIZE = int(os.getenv("MESSAGE_CONVO_CACHE_SIZE", "100000"))
+
+class MessageConvos:
+    """Bounded LRU of message id -> convo id, so an edit or delete that names only
+    the message can still be ordered with the rest of its convo. Filled from sends
+    and, on a miss, from the messages table. Used on the event loop only.
+    """
+
+    def __init__(self, max_entries: int = MESSAGE_CONVO_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, str]" = OrderedDict()
+
+    def put(self, message_id: str, convo_id: str):
+        self.entries[message_id] = convo_id
+        self.entries.move_to_end(message_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def resolve(self, message_id: str) -> Optional[str]:
+        convo_id = self.entries.get(message_id)
+        if convo_id is not None:
+            self.entries.move_to_end(message_id)
+            return convo_id
+        convo_id = await run_db(db_message_convo, message_id)
+        if convo_id is not None:
+            self.put(message_id, convo_id)
+        return convo_id
+
+def db_message_convo(db: Session, message_id: str) -> Optional[str]:
+    return db.execute(select(Message.convo_id).where(Message.id == message_id)).scalar_one_or_none()
+
+message_convos = MessageConvos()
+
+async def message_keys(payload: Dict[str, Any]) -> List[str]:
+    """The message and its convo, whether or not the client sent convo_id."""
+    mid = payload.get("id")
+    keys = [f"message:{mid}"]
+    convo_id = await message_convos.resolve(mid) if isinstance(mid, str) and mid else None
+    if convo_id is not None:
+        keys.append(f"convo:{convo_id}")
+    return keys
+
+def bulk_keys(payload: Dict[str, Any]) -> List[str]:
+    messages = payload.get("messages")
+    if not isinstance(messages, list):
+        return []
+    return sorted({f"convo:{m.get('convo_id')}" for m in messages if isinstance(m, dict)})
+
+# EventType -> (handler, order_keys). A handler is `async fn(conn, user_id, payload)`
+# returning (convo_id, event, coalesce_key) to broadcast, or None. order_keys returns
+# the keys, or a coroutine for them when they need a lookup (see message_keys).
+WS_HANDLERS = {
+    EventType.CREATE_CONVO: (on_db(db_create_convo), convo_keys("id")),
+    EventType.UPDATE_CONVO: (on_db(db_update_convo), convo_keys("id")),
+    EventType.SEND_MESSAGE: (send_message, convo_keys("convo_id")),
+    EventType.SEND_MESSAGES: (send_messages, bulk_keys),
+    EventType.DELETE_MESSAGE: (on_db(db_delete_message), message_keys),
+    EventType.UPDATE_MESSAGE: (on_db(db_update_message), message_keys),
+    EventType.MESSAGE_DELIVERED: (on_receipt(EventType.MESSAGE_DELIVERED), convo_keys("convo_id")),
+    EventType.MESSAGE_SEEN: (on_receipt(EventType.MESSAGE_SEEN), convo_keys("convo_id")),
+    # ephemeral: never wait behind DB work
+    EventType.TYPING: (typing_indicator, no_keys),
+    EventType.PRESENCE: (presence_snapshot, no_keys),
+}
+
+# -----------------------------
+# Rate limiting and admission control
+# -----------------------------
+# Inbound events pass three gates, all in memory: a token bucket per connection
+# (every frame, valid or not), one per (user, event type) shared by the user's
+# connections on this worker, and a global cap on DB-bound handlers in flight.
+# An event that fails a gate is answered with an ERROR carrying
+# code="RATE_LIMITED" and retry_after (seconds) and is not handled.
+WS_CONN_RATE = float(os.getenv("WS_CONN_RATE", "50"))  # frames/s per connection
+WS_CONN_BURST = float(os.getenv("WS_CONN_BURST", "100"))
+# "TYPE=rate/burst,..." with rate in tokens per second; SEND_MESSAGES costs one
+# token per message. Entries in WS_RATE_LIMITS override these, a rate of 0 lifts the limit.
+WS_RATE_LIMITS_DEFAULT = (
+    "SEND_MESSAGE=10/30,SEND_MESSAGES=50/500,CREATE_CONVO=0.2/5,UPDATE_CONVO=0.5/10,"
+    "UPDATE_MESSAGE=2/20,DELETE_MESSAGE=2/20,MESSAGE_DELIVERED=20/50,MESSAGE_SEEN=20/50,"
+    "TYPING=2/10,PRESENCE=0.2/5"
+)
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+WS_ADMISSION_MAX = int(os.getenv("WS_ADMISSION_MAX", str(DB_THREADS * 8)))  # DB-bound handlers in flight
+WS_ADMISSION_WAIT_MS = float(os.getenv("WS_ADMISSION_WAIT_MS", "250"))
+
+def parse_rate_limits(spec: str) -> Dict[str, tuple]:
+    limits = {}
+    for item in filter(None, (s.strip() for s in spec.split(","))):
+        name, _, value = item.partition("=")
+        rate, _, burst = value.partition("/")
+        limits[name.strip().upper()] = (float(rate), float(burst or rate))
+    return limits
+
+WS_RATE_LIMITS = {
+    name: limit
+    for name, limit in {**parse_rate_limits(WS_RATE_LIMITS_DEFAULT), **parse_rate_limits(os.getenv("WS_RATE_LIMITS", ""))}.items()
+    if limit[0] > 0
+}
+
+class TokenBucket:
+    """Holds up to `burst` tokens, refilled at `rate` per second when next used."""
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def take(self, cost: float = 1.0) -> float:
+        """Take `cost` tokens: 0.0 if they were there, else the seconds until they will be."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        cost = min(cost, self.burst)  # an oversized request needs a full bucket
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+class RateLimiter:
+    """Token buckets per (user_id, event type), in an LRU of RATE_LIMIT_MAX_KEYS.
+
+    An evicted bucket comes back full, which is at most one burst of leeway for a
+    user idle long enough to be the least recently seen.
+    """
+
+    def __init__(self, limits: Dict[str, tuple], max_entries: int = RATE_LIMIT_MAX_KEYS):
+        self.limits = limits
+        self.max_entries = max_entries
+        self.buckets: "OrderedDict[tuple, TokenBucket]" = OrderedDict()
+
+    def check(self, user_id: str, event_type: str, cost: float = 1.0) -> float:
+        limit = self.limits.get(event_type)
+        if limit is None:
+            return 0.0
+        key = (user_id, event_type)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(*limit)
+            while len(self.buckets) > self.max_entries:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket.take(cost)
+
+class AdmissionControl:
+    """Caps DB-bound handlers in flight across every connection.
+
+    A handler waits at most WS_ADMISSION_WAIT_MS for a slot and is rejected after
+    that, so overload shows up as RATE_LIMITED errors rather than as latency for
+    everyone.
+    """
+
+    def __init__(self, limit: int = WS_ADMISSION_MAX, wait_ms: float = WS_ADMISSION_WAIT_MS):
+        self.limit = limit
+        self.wait = wait_ms / 1000.0
+        self.slots = asyncio.Semaphore(limit)
+        self.in_flight = 0
+        self.waiting = 0
+
+    async def acquire(self) -> bool:
+        if self.slots.locked():
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self.slots.acquire(), self.wait)
+            except asyncio.TimeoutError:
+                return False
+            finally:
+                self.waiting -= 1
+        else:
+            await self.slots.acquire()
+        self.in_flight += 1
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+        self.slots.release()
+
+rate_limiter = RateLimiter(WS_RATE_LIMITS)
+admission = AdmissionControl()
+# events that only touch memory skip admission
+UNADMITTED_EVENTS = {EventType.TYPING, EventType.PRESENCE}
+metrics.counter("chat_rate_limited_total", "Events and requests rejected by rate limits, by type and gate")
+metrics.gauge("chat_ws_admission_in_flight", "DB-bound handlers holding an admission slot", lambda: admission.in_flight)
+metrics.gauge("chat_ws_admission_waiting", "Handlers waiting for an admission slot", lambda: admission.waiting)
+metrics.gauge("chat_rate_limit_buckets", "Per-user token buckets held in memory", lambda: len(rate_limiter.buckets))
+
+def event_cost(msg: WSMessage) -> float:
+    if msg.type == EventType.SEND_MESSAGES:
+        messages = msg.payload.get("messages")
+        return float(len(messages)) if isinstance(messages, list) and messages else 1.0
+    return 1.0
+
+def reject_rate_limited(conn: ClientConnection, event_type: str, gate: str, retry_after: float, payload: Optional[Dict[str, Any]] = None):
+    metrics.inc("chat_rate_limited_total", type=event_type, gate=gate)
+    metrics.inc("chat_ws_events_total", type=event_type, outcome="rate_limited")
+    log.debug("ws.rate_limited user=%s type=%s gate=%s retry_after=%.3f", conn.user_id, event_type, gate, retry_after)
+    evt = {"type": "ERROR", "code": "RATE_LIMITED", "error": "Rate limited", "event": event_type, "retry_after": round(max(retry_after, 0.001), 3)}
+    if payload and payload.get("local_id"):
+        evt["ack_local_id"] = payload["local_id"]
+    conn.send_event(evt)
+
+async def handle_event(conn: ClientConnection, msg: WSMessage):
+    route = WS_HANDLERS.get(msg.type)
+    if route is None:
+        metrics.inc("chat_ws_events_total", type=msg.type.value, outcome="error")
+        conn.send_event({"type": "ERROR", "error": "Unknown event type"})
+        return
+    admitted = msg.type not in UNADMITTED_EVENTS
+    if admitted and not await admission.acquire():
+        reject_rate_limited(conn, msg.type.value, "admission", admission.wait, msg.payload)
+        return
+    started = time.perf_counter()
+    db_time = [0.0]
+    db_token = _event_db_time.set(db_time)
+    outcome = "ok"
+    try:
+        result = await route[0](conn, conn.user_id, msg.payload)
+    except WSError as e:
+        outcome = "error"
+        conn.send_event({"type": "ERROR", "error": str(e)})
+        return
+    except Exception:
+        outcome = "failed"
+        log.exception("ws.handler_failed user=%s type=%s", conn.user_id, msg.type.value)
+        conn.send_event({"type": "ERROR", "error": "Internal error"})
+        return
+    finally:
+        if admitted:
+            admission.release()
+        _event_db_time.reset(db_token)
+        metrics.observe("chat_ws_handler_seconds", time.perf_counter() - started, type=msg.type.value)
+        metrics.observe("chat_ws_event_db_seconds", db_time[0], type=msg.type.value)
+        metrics.inc("chat_ws_events_total", type=msg.type.value, outcome=outcome)
+    if result is not None:
+        convo_id, evt, key = result
+        await manager.broadcast_to_convo(convo_id, evt, key=key)
+
+WS_PIPELINE_DEPTH = int(os.getenv("WS_PIPELINE_DEPTH", "16"))
+
+class EventDispatcher:
+    """Pipelines one connection's inbound events.
+
+    Up to `depth` events are in flight at once and the receive loop stops reading
+    while every slot is taken. Each event first waits for the previous events
+    that share one of its order keys, so a burst to several convos is handled
+    concurrently while each convo, and each edited message, still sees events
+    (and their broadcasts) in the order the client sent them.
+    """
+
+    def __init__(self, conn: ClientConnection, depth: int = WS_PIPELINE_DEPTH):
+        self.conn = conn
+        self.slots = asyncio.Semaphore(depth)
+        self.tails: Dict[str, asyncio.Task] = {}  # order key -> last event task holding it
+        self.tasks: set = set()
+
+    async def submit(self, msg: WSMessage):
+        retry_after = rate_limiter.check(self.conn.user_id, msg.type.value, event_cost(msg))
+        if retry_after:
+            reject_rate_limited(self.conn, msg.type.value, "user", retry_after, msg.payload)
+            return
+        await self.slots.acquire()
+        route = WS_HANDLERS.get(msg.type)
+        keys = route[1](msg.payload) if route is not None else []
+        if asyncio.iscoroutine(keys):
+            keys = await keys  # resolved before the next event is read, so arrival order holds
+        waits = {self.tails[k] for k in keys if k in self.tails}
+        task = asyncio.create_task(self._run(msg, waits))
+        for k in keys:
+            self.tails[k] = task
+        self.tasks.add(task)
+        task.add_done_callback(lambda t: self._done(t, keys))
+
+    async def _run(self, msg: WSMessage, waits: set):
+        if waits:
+            t0 = time.perf_counter()
+            await asyncio.wait(waits)
+            metrics.observe("chat_ws_order_wait_seconds", time.perf_counter() - t0)
+        await handle_event(self.conn, msg)
+
+    def _done(self, task: asyncio.Task, keys: List[str]):
+        self.tasks.discard(task)
+        self.slots.release()
+        for k in keys:
+            if self.tails.get(k) is task:
+                del self.tails[k]
+
+    async def close(self):
+        """Let events already read finish; the client may have closed right after sending."""
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
 @app.websocket("/ws")
 async def ws_endpoint(websocket: WebSocket):
     # Expect token via query param or header 'Authorization: Bearer'
-    token = websocket.query_params.get("token")
-    authorization = None
-    if token:
-        authorization = f"Bearer {token}"
-    else:
-        auth_header = websocket.headers.get("authorization")
-        if auth_header:
-            authorization = auth_header
-    # Create a db session for the connection lifetime
-    db = SessionLocal()
+    token = websocket.query_params.get("token") or bearer_token(websocket.headers.get("authorization"))
+    conn: Optional[ClientConnection] = None
     try:
-        if not authorization:
+        if not token:
             await websocket.close(code=4401)
             return
-        # user = get_current_user(authorization, db)
-        uid = token
-        user = db.get(DjangoUser, uid)
-        if not user or user.is_active is False:
-            raise HTTPException(status_code=403, detail="User not found or inactive")
+        user = authenticator.cached(token)
+        if user is None:
+            try:
+                user = await run_db(authenticator.authenticate, token)
+            except HTTPException as e:
+                await websocket.close(code=4403 if e.status_code == 403 else 4401)
+                return
 
-        user = AuthedUser(user_id=str(uid), username=user.username, email=user.email, raw_claims={})
-        await manager.connect(user.user_id, websocket)
-        # Initial hello
-        await websocket.send_text(json.dumps({"type": "HELLO", "user_id": user.user_id}))
+        resume_from = websocket.query_params.get("last_event_id")
+        if resume_from is not None:
+            resume_from = int(resume_from) if resume_from.isdigit() else -1  # garbage -> resync
+        conn = await manager.connect(user.user_id, websocket, {"type": "HELLO", "user_id": user.user_id},
+                                     resume_from, websocket.query_params.get("stream_id"))
+        dispatcher = EventDispatcher(conn)
+        frames = TokenBucket(WS_CONN_RATE, WS_CONN_BURST) if WS_CONN_RATE > 0 else None
+        log.debug("ws.connect user=%s resume_from=%s", user.user_id, resume_from)
+        if websocket.query_params.get("presence") in ("1", "true"):
+            await presence.snapshot(conn)
 
         while True:
-            raw = await websocket.receive_text()
-            print("REcieved a message: ", raw)
-            try:
-                msg = WSMessage.model_validate_json(raw)
-            except Exception as e:
-                await websocket.send_text(json.dumps({"type": "ERROR", "error": "Invalid JSON"}))
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            raw = frame.get("text") if frame.get("text") is not None else frame.get("bytes") or b""
+            metrics.inc("chat_ws_received_bytes_total", len(raw), codec=conn.codec.name)
+            retry_after = frames.take() if frames is not None else 0.0
+            if retry_after:
+                reject_rate_limited(conn, "FRAME", "connection", retry_after)
                 continue
-
-            if msg.type == EventType.CREATE_CONVO:
-                convo_id = msg.payload.get("id")
-                title = msg.payload.get("title")
-                participant_ids: List[str] = msg.payload.get("participants", [])
-                if not convo_id:
-                    await websocket.send_text(json.dumps({"type": "ERROR", "error": "Missing convo id"}))
-                    continue
-                convo = db.get(Convo, convo_id)
-                if not convo:
-                    convo = Convo(id=convo_id, title=title, is_group=len(participant_ids) > 2)
-                    db.add(convo)
-                    db.commit()
-                # ensure participants (include sender)
-                if user.user_id not in participant_ids:
-                    participant_ids.append(user.user_id)
-                for pid in set(participant_ids):
-                    if not db.execute(select(ConvoParticipant).where(and_(ConvoParticipant.convo_id==convo_id, ConvoParticipant.user_id==pid))).scalar_one_or_none():
-                        db.add(ConvoParticipant(convo_id=convo_id, user_id=pid))
-                convo.updated_at = datetime.now(timezone.utc)
-                db.commit()
-                evt = {"type": EventType.CREATE_CONVO, "payload": {"convo": {"id": convo.id, "title": convo.title, "is_group": convo.is_group, "updated_at": convo.updated_at}}, "ack_local_id": convo.local_id}
-                await manager.broadcast_to_convo(db, convo_id, evt)
-
-            elif msg.type == EventType.UPDATE_CONVO:
-                convo_id = msg.payload.get("id")
-                title = msg.payload.get("title")
-                if not convo_id:
-                    await websocket.send_text(json.dumps({"type": "ERROR", "error": "Missing convo id"}))
-                    continue
-                convo = db.get(Convo, convo_id)
-                if not convo:
-                    await websocket.send_text(json.dumps({"type": "ERROR", "error": "Convo not found"}))
-                    continue
-                if title is not None:
-                    convo.title = title
-                convo.updated_at = datetime.now(timezone.utc)
-                db.commit()
-                await manager.broadcast_to_convo(db, convo_id, {"type": EventType.UPDATE_CONVO, "payload": {"convo": {"id": convo.id, "title": convo.title, "updated_at": convo.updated_at}}, "ack_local_id": convo.local_id})
-
-            elif msg.type == EventType.SEND_MESSAGE:
-                server_id = str(uuid4())
-                convo_id = msg.payload.get("convo_id")
-                content = msg.payload.get("content")
-                local_id = msg.payload.get("local_id")
-                if not local_id or not convo_id:
-                    await websocket.send_text(json.dumps({"type": "ERROR", "error": "Missing local_id or convo_id"}))
-                    continue
-                # Ensure sender participates
-                part = db.execute(select(ConvoParticipant).where(and_(ConvoParticipant.convo_id==convo_id, ConvoParticipant.user_id==user.user_id))).scalar_one_or_none()
-                if not part:
-                    await websocket.send_text(json.dumps({"type": "ERROR", "error": "Not a participant"}))
-                    continue
-                # Idempotency check
-                existing = db.execute(select(Message).where(and_(Message.sender_id==int(user.user_id), Message.local_id==local_id))).scalar_one_or_none()
-                if existing:
-                    server_id = existing.id
-                    message = existing
+            log.debug("ws.recv user=%s bytes=%d", user.user_id, len(raw))
+            try:
+                if isinstance(raw, bytes) and conn.codec.binary:
+                    msg = WSMessage.model_validate(conn.codec.decode(raw))
                 else:
-                    message = Message(id=server_id, local_id=local_id, convo_id=convo_id, sender_id=user.user_id, content=content)
-                    db.add(message)
-                    # set deliveries for other participants
-                    other_ids = [row[0] for row in db.execute(select(ConvoParticipant.user_id).where(and_(ConvoParticipant.convo_id==convo_id, ConvoParticipant.user_id!=int(user.user_id)))).all()]
-                    # for rid in other_ids:
-                    #     db.add(MessageDelivery(message_id=server_id, user_id=rid, delivered_at=datetime.now(timezone.utc)))
-                    # bump convo updated_at
-                    convo = db.get(Convo, convo_id)
-                    if convo:
-                        convo.updated_at = datetime.now(timezone.utc)
-                    db.commit()
-                evt_payload = {
-                    "message": {
-                        "id": message.id,
-                        "local_id": message.local_id,
-                        "convo_id": message.convo_id,
-                        "sender_id": message.sender_id,
-                        "content": message.content,
-                        "deleted": message.deleted,
-                        "created_at": message.created_at,
-                        "updated_at": message.updated_at,
-                    }
-                }
-                await manager.broadcast_to_convo(db, message.convo_id, {"type": EventType.SEND_MESSAGE, "payload": evt_payload, "ack_local_id": local_id})
-
-            elif msg.type == EventType.DELETE_MESSAGE:
-                mid = msg.payload.get("id")
-                local_id = msg.payload.get("local_id")
-                if not mid:
-                    await websocket.send_text(json.dumps({"type": "ERROR", "error": "Missing message id"}))
-                    continue
-                m = db.get(Message, mid)
-                if not m:
-                    await websocket.send_text(json.dumps({"type": "ERROR", "error": "Message not found"}))
-                    continue
-                if m.sender_id != user.user_id:
-                    await websocket.send_text(json.dumps({"type": "ERROR", "error": "Forbidden"}))
-                    continue
-                m.deleted = True
-                m.updated_at = datetime.now(timezone.utc)
-                db.commit()
-                await manager.broadcast_to_convo(db, m.convo_id, {"type": EventType.DELETE_MESSAGE, "payload": {"id": m.id, "convo_id": m.convo_id}, "ack_local_id": local_id})
-
-            elif msg.type == EventType.UPDATE_MESSAGE:
-                mid = msg.payload.get("id")
-                content = msg.payload.get("content")
-                if not mid:
-                    await websocket.send_text(json.dumps({"type": "ERROR", "error": "Missing message id"}))
-                    continue
-                m = db.get(Message, mid)
-                if not m:
-                    await websocket.send_text(json.dumps({"type": "ERROR", "error": "Message not found"}))
-                    continue
-                if m.sender_id != user.user_id:
-                    await websocket.send_text(json.dumps({"type": "ERROR", "error": "Forbidden"}))
-                    continue
-                if content is not None:
-                    m.content = content
-                m.updated_at = datetime.now(timezone.utc)
-                db.commit()
-                payload = {
-                    "message": {
-                        "id": m.id,
-                        "local_id": m.local_id,
-                        "convo_id": m.convo_id,
-                        "sender_id": m.sender_id,
-                        "content": None if m.deleted else m.content,
-                        "deleted": m.deleted,
-                        "created_at": m.created_at,
-                        "updated_at": m.updated_at,
-                    }
-                }
-                await manager.broadcast_to_convo(db, m.convo_id, {"type": EventType.UPDATE_MESSAGE, "payload": payload, "ack_local_id": m.local_id})
-
-            elif msg.type in (EventType.MESSAGE_DELIVERED, EventType.MESSAGE_SEEN):
+                    msg = WSMessage.model_validate_json(raw)
+            except Exception as e:
+                metrics.inc("chat_ws_events_total", type="INVALID", outcome="error")
+                log.info("ws.invalid_frame user=%s bytes=%d error=%s", user.user_id, len(raw), type(e).__name__)
+                conn.send_event({"type": "ERROR", "error": "Invalid frame" if conn.codec.binary else "Invalid JSON"})
                 continue
-                mid = msg.payload.get("id")
-                convo_id = msg.payload.get("convo_id")
-                local_id = msg.payload.get('local_id')
-                if not mid or not convo_id:
-                    await websocket.send_text(json.dumps({"type": "ERROR", "error": "Missing id or convo_id"}))
-                    continue
-                # ensure membership
-                part = db.execute(select(ConvoParticipant).where(and_(ConvoParticipant.convo_id==convo_id, ConvoParticipant.user_id==user.user_id))).scalar_one_or_none()
-                if not part:
-                    await websocket.send_text(json.dumps({"type": "ERROR", "error": "Not a participant"}))
-                    continue
-                # upsert delivery state
-                md = db.execute(select(MessageDelivery).where(and_(MessageDelivery.message_id==mid, MessageDelivery.user_id==user.user_id))).scalar_one_or_none()
-                now = datetime.now(timezone.utc)
-                if not md:
-                    md = MessageDelivery(message_id=mid, user_id=user.user_id)
-                    db.add(md)
-                if msg.type == EventType.MESSAGE_DELIVERED:
-                    md.delivered_at = now
-                else:
-                    md.seen_at = now
-                    # update last_read_at for convo participant
-                    part.last_read_at = now
-                db.commit()
-                await manager.broadcast_to_convo(db, convo_id, {"type": msg.type, "payload": {"message_id": mid, "user_id": user.user_id, "timestamp": now}, "ack_local_id": local_id}, exclude_user=user.user_id)
 
-            else:
-                await websocket.send_text(json.dumps({"type": "ERROR", "error": "Unknown event type"}))
+            await dispatcher.submit(msg)
 
     except WebSocketDisconnect:
         pass
     finally:
-        try:
-            # We may not know user_id if auth failed; guard
-            auth_header = authorization if authorization else ""
-            try:
-                _claims = jwt.get_unverified_claims(auth_header.split(" ")[-1]) if auth_header else {}
-                uid = _claims.get("sub") if isinstance(_claims, dict) else None
-                if uid:
-                    manager.disconnect(uid, websocket)
-            except Exception:
-                pass
-        finally:
-            db.close()
+        # conn is only set once auth succeeded and the socket was registered
+        if conn is not None:
+            await dispatcher.close()
+            manager.disconnect(conn.user_id, conn)
+            log.debug("ws.disconnect user=%s", conn.user_id)
+
+@app.post("/messages/bulk", response_model=BulkMessagesOut)
+async def post_messages_bulk(body: BulkMessagesIn, user: AuthedUser = Depends(get_current_user)):
+    """REST twin of SEND_MESSAGES for replaying an offline outbox."""
+    retry_after = rate_limiter.check(user.user_id, EventType.SEND_MESSAGES.value, max(1, len(body.messages)))
+    if retry_after:
+        metrics.inc("chat_rate_limited_total", type=EventType.SEND_MESSAGES.value, gate="user")
+        raise HTTPException(status_code=429, detail="Rate limited", headers={"Retry-After": str(int(retry_after) + 1)})
+    try:
+        stored, rejected = await ingest_bulk(user.user_id, [m.model_dump() for m in body.messages])
+    except WSError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    return BulkMessagesOut(
+        messages=[MessageOut(**{**m, "sender_id": str(m["sender_id"])}) for m in stored],
+        rejected=[RejectedMessage(**r) for r in rejected],
+    )
+
+# -----------------------------
+# Internal
+# -----------------------------
+@app.post("/internal/users/{user_id}/invalidate")
+async def invalidate_user(user_id: int, x_internal_token: Annotated[Optional[str], Header()] = None):
+    """Called by the Django side after deactivating or changing a user."""
+    if not INTERNAL_API_TOKEN:
+        raise HTTPException(status_code=404, detail="Not found")
+    if x_internal_token != INTERNAL_API_TOKEN:
+        raise HTTPException(status_code=403, detail="Forbidden")
+    authenticator.invalidate_user(user_id)
+    for conn in list(manager.connections.get(str(user_id), ())):
+        conn.abort(code=4403)
+    return {"ok": True}
 
 # -----------------------------
 # Health
 # -----------------------------
 @app.get("/healthz")
 async def healthz():
-    return {"ok": True, "time": datetime.now(timezone.utc).isoformat()}
+    return {"ok": True, "time": datetime.now(timezone.utc).isoformat(), "membership": manager.membership.stats(), "replay": manager.replay.stats(), "archive": archive.stats()}
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus text exposition of the in-process metrics."""
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# -----------------------------
+# Maintenance commands
+# -----------------------------
+def cmd_rebuild_search():
+    t0 = time.perf_counter()
+    n = search_index.rebuild(engine)
+    log.info("search.rebuild index=%s messages=%s seconds=%.2f", search_index.name, n, time.perf_counter() - t0)
+
+def cmd_rebuild_summaries():
+    t0 = time.perf_counter()
+    n = rebuild_summaries(engine)
+    log.info("summaries.rebuild rows=%s seconds=%.2f", n, time.perf_counter() - t0)
+
+def cmd_archive(days: Optional[str] = None):
+    t0 = time.perf_counter()
+    cutoff = datetime.now(timezone.utc) - timedelta(days=float(days) if days else ARCHIVE_AFTER_DAYS)
+    stats = archive_messages(engine, cutoff)
+    log.info(
+        "archive.run cutoff=%s convos=%s messages=%s segments_written=%s seconds=%.2f",
+        cutoff.isoformat(), stats["convos"], stats["messages"], stats["segments_written"], time.perf_counter() - t0,
+    )
+    totals = archive_totals(engine)
+    log.info("archive.totals segments=%s messages=%s raw_bytes=%s stored_bytes=%s", *totals.values())
+
+def cmd_gc_attachments(hours: Optional[str] = None):
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=float(hours) if hours else ATTACHMENT_UPLOAD_TTL_HOURS)
+    stats = gc_attachments(engine, cutoff)
+    log.info("attachments.gc cutoff=%s attachments=%s blobs=%s", cutoff.isoformat(), stats["attachments"], stats["blobs"])
+
+COMMANDS = {
+    "rebuild-search": cmd_rebuild_search,
+    "rebuild-summaries": cmd_rebuild_summaries,
+    "archive": cmd_archive,
+    "gc-attachments": cmd_gc_attachments,
+}
+
+if __name__ == "__main__" and len(sys.argv) > 1:
+    if sys.argv[1] not in COMMANDS:
+        sys.exit(f"usage: python backend.py [{'|'.join(COMMANDS)}] [args]")
+    COMMANDS[sys.argv[1]](*sys.argv[2:])
+elif __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        app,
+        host=os.getenv("HOST", "127.0.0.1"),
+        port=int(os.getenv("PORT", "8000")),
+        ws_per_message_deflate=os.getenv("WS_PER_MESSAGE_DEFLATE", "1") not in ("0", "false", "False"),
+    )
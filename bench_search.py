@@ -0,0 +1,230 @@
+"""
+Search benchmark for backend.py
+- Generates a synthetic corpus (default ~1M messages, Zipf-distributed vocabulary)
+  in a scratch SQLite file
+- Times backend.search_index.rebuild() and the on-disk size of the FTS5 table
+- Times GET /search's query for rare, common, multi-term and prefix queries with
+  the FTS5 index and with the LIKE fallback other engines get, for typical users
+  and for one heavy user who is in --heavy-convos convos
+- Times single-message commits with and without the in-transaction index update
+- Prints a table to stderr and machine-readable JSON to stdout (or --out)
+
+Run:
+  python bench_search.py --messages 1000000 --out bench_search.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--messages", type=int, default=1_000_000)
+    p.add_argument("--users", type=int, default=5_000)
+    p.add_argument("--convos", type=int, default=20_000)
+    p.add_argument("--members", type=int, default=4, help="participants per convo")
+    p.add_argument("--vocab", type=int, default=50_000, help="distinct words in the corpus")
+    p.add_argument("--words", type=int, default=12, help="mean words per message")
+    p.add_argument("--heavy-convos", type=int, default=2_000, help="convos the heavy user (user 1) is in")
+    p.add_argument("--runs", type=int, default=200, help="timed runs per query")
+    p.add_argument("--like-runs", type=int, default=20, help="timed runs per query for the LIKE fallback")
+    p.add_argument("--writes", type=int, default=200, help="single-message commits to time")
+    p.add_argument("--db", help="SQLite file to use (default: a temp file)")
+    p.add_argument("--seed", type=int, default=7)
+    p.add_argument("--out", help="write JSON results here instead of stdout")
+    return p.parse_args()
+
+
+args = parse_args()
+db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="chat-bench-"), "bench.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+
+import backend  # noqa: E402  (DATABASE_URL must be set first)
+from sqlalchemy import insert  # noqa: E402
+
+B = backend
+rng = random.Random(args.seed)
+NOW = datetime.now(timezone.utc).replace(tzinfo=None)
+CHUNK = 50_000
+VOCAB = [f"w{i}" for i in range(args.vocab)]
+# Zipf(1): word rank r appears ~1/r as often as the most common word
+CUM_WEIGHTS = list(itertools.accumulate(1 / (r + 1) for r in range(args.vocab)))
+
+
+def log(*a):
+    print(*a, file=sys.stderr, flush=True)
+
+
+# -----------------------------
+# Dataset
+# -----------------------------
+def generate():
+    log(f"generating {args.messages} messages in {args.convos} convos for {args.users} users -> {db_path}")
+    t0 = time.perf_counter()
+    with B.engine.begin() as conn:
+        conn.execute(insert(B.DjangoUser.__table__), [
+            {"id": i, "username": f"user{i}", "email": f"user{i}@example.com", "is_active": True, "date_joined": NOW}
+            for i in range(1, args.users + 1)
+        ])
+        convos, parts = [], []
+        members = {}
+        for c in range(args.convos):
+            cid = f"c{c}"
+            ids = rng.sample(range(1, args.users + 1), args.members)
+            members[cid] = ids
+            convos.append({"id": cid, "title": cid, "is_group": args.members > 2, "seq": 0, "created_at": NOW, "updated_at": NOW})
+            parts.extend({"convo_id": cid, "user_id": u, "role": "member", "joined_at": NOW, "delivered_upto": 0, "seen_upto": 0} for u in ids)
+        for cid in rng.sample(sorted(members), args.heavy_convos):
+            if 1 not in members[cid]:
+                members[cid].append(1)
+                parts.append({"convo_id": cid, "user_id": 1, "role": "member", "joined_at": NOW, "delivered_upto": 0, "seen_upto": 0})
+        conn.execute(insert(B.Convo.__table__), convos)
+        conn.execute(insert(B.ConvoParticipant.__table__), parts)
+
+    cids = list(members)
+    done = 0
+    while done < args.messages:
+        n = min(CHUNK, args.messages - done)
+        msgs = []
+        for k in range(n):
+            cid = rng.choice(cids)
+            ts = NOW - timedelta(seconds=k)
+            words = rng.choices(VOCAB, cum_weights=CUM_WEIGHTS, k=max(1, int(rng.expovariate(1 / args.words))))
+            msgs.append({"id": str(uuid4()), "local_id": f"l{done + k}", "convo_id": cid, "sender_id": rng.choice(members[cid]),
+                         "content": " ".join(words), "deleted": False, "seq": done + k, "created_at": ts, "updated_at": ts})
+        with B.engine.begin() as conn:
+            conn.execute(insert(B.Message.__table__), msgs)
+        done += n
+        log(f"  {done}/{args.messages}")
+    log(f"generated in {time.perf_counter() - t0:.1f}s")
+    return members
+
+
+def fts_size_bytes():
+    with B.engine.connect() as conn:
+        try:
+            return conn.exec_driver_sql(
+                "SELECT SUM(pgsize) FROM dbstat WHERE name LIKE ?", (f"{B.Fts5SearchIndex.table}%",)
+            ).scalar()
+        except Exception:  # dbstat is a compile-time option
+            return None
+
+
+# -----------------------------
+# Queries (the same call GET /search makes)
+# -----------------------------
+QUERIES = {
+    "rare_term": lambda: [VOCAB[rng.randrange(args.vocab // 2, args.vocab)]],
+    "common_term": lambda: [VOCAB[rng.randrange(0, 10)]],
+    "two_terms": lambda: [VOCAB[rng.randrange(0, 200)], VOCAB[rng.randrange(200, 5000)]],
+    "prefix": lambda: [VOCAB[rng.randrange(100, 1000)][:-1]],
+    "one_convo": lambda: [VOCAB[rng.randrange(0, 50)]],
+}
+
+
+def timed(index, name, runs, user_convos):
+    samples, hits = [], 0
+    for i in range(runs + 5):
+        terms = QUERIES[name]()
+        convo_ids = sorted(rng.choice(user_convos))
+        if name == "one_convo":
+            convo_ids = convo_ids[:1]
+        with B.SessionLocal() as db:
+            t0 = time.perf_counter()
+            rows = index.search(db, convo_ids, terms, B.SEARCH_PAGE_DEFAULT + 1, 0)
+            dt = (time.perf_counter() - t0) * 1000
+        if i >= 5:  # warm-up
+            samples.append(dt)
+            hits += len(rows)
+    samples.sort()
+    return {
+        "p50_ms": round(statistics.median(samples), 3),
+        "p95_ms": round(samples[int(len(samples) * 0.95) - 1], 3),
+        "mean_ms": round(statistics.fmean(samples), 3),
+        "mean_hits": round(hits / runs, 1),
+    }
+
+
+def timed_writes(index, n):
+    """One message insert (plus index update) and commit, as insert_messages does it."""
+    samples = []
+    for _ in range(n):
+        m = B.Message(id=str(uuid4()), local_id=str(uuid4()), convo_id=f"c{rng.randrange(args.convos)}", sender_id=None,
+                      content=" ".join(rng.choices(VOCAB, cum_weights=CUM_WEIGHTS, k=args.words)), deleted=False, created_at=NOW, updated_at=NOW)
+        with B.SessionLocal() as db:
+            t0 = time.perf_counter()
+            db.add(m)
+            index.add(db, [m])
+            db.commit()
+            samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    return {"p50_ms": round(statistics.median(samples), 3), "p95_ms": round(samples[int(n * 0.95) - 1], 3)}
+
+
+def run_suite(label, index, runs, user_convos):
+    out = {}
+    for name in QUERIES:
+        out[name] = timed(index, name, runs, user_convos)
+        log(f"  [{label}] {name:12s} p50={out[name]['p50_ms']:9.3f}ms p95={out[name]['p95_ms']:9.3f}ms hits={out[name]['mean_hits']}")
+    return out
+
+
+def main():
+    members = generate()
+    by_user = {}  # what membership.convos_for_user returns
+    for cid, ids in members.items():
+        for u in ids:
+            by_user.setdefault(u, []).append(cid)
+    heavy = [by_user.pop(1)]
+    typical = list(by_user.values())
+    if not isinstance(B.search_index, B.Fts5SearchIndex):
+        sys.exit("this SQLite build has no FTS5")
+
+    t0 = time.perf_counter()
+    indexed = B.search_index.rebuild(B.engine)
+    rebuild_s = time.perf_counter() - t0
+    with B.engine.begin() as conn:
+        conn.exec_driver_sql("ANALYZE")
+    log(f"rebuild-search: {indexed} messages in {rebuild_s:.1f}s, fts size={fts_size_bytes()}")
+
+    fts, like = {}, {}
+    for label, users, runs in (("typical", typical, args.runs), ("heavy", heavy, max(args.runs // 10, 10))):
+        log(f"{label} users, fts5:")
+        fts[label] = run_suite("fts5", B.search_index, runs, users)
+        log(f"{label} users, like (fallback):")
+        like[label] = run_suite("like", B.LikeSearchIndex(), min(runs, args.like_runs), users)
+
+    writes = {"without_index": timed_writes(B.SearchIndex(), args.writes), "with_fts5": timed_writes(B.search_index, args.writes)}
+    for k, v in writes.items():
+        log(f"  [write] {k:14s} p50={v['p50_ms']:9.3f}ms p95={v['p95_ms']:9.3f}ms")
+
+    result = {
+        "dataset": {"messages": args.messages, "users": args.users, "convos": args.convos, "members": args.members,
+                    "heavy_convos": len(heavy[0]), "vocab": args.vocab, "words": args.words, "db": db_path},
+        "rebuild": {"messages": indexed, "seconds": round(rebuild_s, 2), "fts_bytes": fts_size_bytes()},
+        "fts5": fts,
+        "like": like,
+        "speedup_p50": {label: {k: round(like[label][k]["p50_ms"] / v["p50_ms"], 1) for k, v in fts[label].items() if v["p50_ms"]} for label in fts},
+        "single_commit": writes,
+    }
+    text = json.dumps(result, indent=2, default=str)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
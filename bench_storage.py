@@ -0,0 +1,261 @@
+"""
+Storage benchmark for backend.py
+- Generates a synthetic dataset (default ~1M messages) in a scratch SQLite file
+- Times the hot queries twice:
+  * before: no composite indexes, rollback journal, synchronous=FULL, default cache
+  * after:  backend.apply_storage_profile() + the SQLITE_PRAGMAS backend applies on connect
+- Prints a table to stderr and machine-readable JSON to stdout (or --out)
+
+Run:
+  python bench_storage.py --messages 1000000 --out bench_storage.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--messages", type=int, default=1_000_000)
+    p.add_argument("--users", type=int, default=5_000)
+    p.add_argument("--convos", type=int, default=20_000)
+    p.add_argument("--members", type=int, default=4, help="participants per convo")
+    p.add_argument("--days", type=int, default=90, help="spread of message timestamps")
+    p.add_argument("--runs", type=int, default=200, help="timed runs per query")
+    p.add_argument("--writes", type=int, default=200, help="single-message commits to time")
+    p.add_argument("--db", help="SQLite file to use (default: a temp file)")
+    p.add_argument("--seed", type=int, default=7)
+    p.add_argument("--out", help="write JSON results here instead of stdout")
+    return p.parse_args()
+
+
+args = parse_args()
+db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="chat-bench-"), "bench.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+
+import backend  # noqa: E402  (DATABASE_URL must be set first)
+from sqlalchemy import and_, create_engine, insert, select  # noqa: E402
+from sqlalchemy.orm import Session  # noqa: E402
+
+B = backend
+rng = random.Random(args.seed)
+NOW = datetime.now(timezone.utc).replace(tzinfo=None)
+CHUNK = 50_000
+
+
+def log(*a):
+    print(*a, file=sys.stderr, flush=True)
+
+
+# -----------------------------
+# Dataset
+# -----------------------------
+def generate():
+    log(f"generating {args.messages} messages in {args.convos} convos for {args.users} users -> {db_path}")
+    t0 = time.perf_counter()
+    with B.engine.begin() as conn:
+        conn.execute(insert(B.DjangoUser.__table__), [
+            {"id": i, "username": f"user{i}", "email": f"user{i}@example.com", "is_active": True, "date_joined": NOW}
+            for i in range(1, args.users + 1)
+        ])
+        convos, parts = [], []
+        members = {}
+        for c in range(args.convos):
+            cid = f"c{c}"
+            ids = rng.sample(range(1, args.users + 1), args.members)
+            members[cid] = ids
+            convos.append({"id": cid, "title": cid, "is_group": args.members > 2, "seq": 0, "created_at": NOW, "updated_at": NOW})
+            parts.extend({"convo_id": cid, "user_id": u, "role": "member", "joined_at": NOW, "delivered_upto": 0, "seen_upto": 0} for u in ids)
+        conn.execute(insert(B.Convo.__table__), convos)
+        conn.execute(insert(B.ConvoParticipant.__table__), parts)
+
+    seqs = {cid: 0 for cid in members}
+    last = {}
+    cids = list(members)
+    span = args.days * 86400
+    done = 0
+    while done < args.messages:
+        n = min(CHUNK, args.messages - done)
+        msgs, log_rows = [], []
+        for k in range(n):
+            cid = rng.choice(cids)
+            seqs[cid] += 1
+            ts = NOW - timedelta(seconds=span * (1 - (done + k) / args.messages))
+            mid = str(uuid4())
+            sender = rng.choice(members[cid])
+            msgs.append({"id": mid, "local_id": f"l{done + k}", "convo_id": cid, "sender_id": sender, "content": f"message {done + k}",
+                         "deleted": False, "seq": seqs[cid], "created_at": ts, "updated_at": ts})
+            log_rows.append({"convo_id": cid, "convo_seq": seqs[cid], "entity": "message", "entity_id": mid, "created_at": ts})
+            last[cid] = ts
+        with B.engine.begin() as conn:
+            conn.execute(insert(B.Message.__table__), msgs)
+            conn.execute(insert(B.ChangeLog.__table__), log_rows)
+        done += n
+        log(f"  {done}/{args.messages}")
+    with B.engine.begin() as conn:
+        for cid, seq in seqs.items():
+            conn.execute(B.Convo.__table__.update().where(B.Convo.id == cid).values(seq=seq, updated_at=last.get(cid, NOW)))
+    B.rebuild_summaries(B.engine)
+    log(f"generated in {time.perf_counter() - t0:.1f}s")
+    return members
+
+
+# -----------------------------
+# Queries (the same shapes backend.py runs)
+# -----------------------------
+def q_messages_sync(db: Session, ctx):
+    uid = rng.randint(1, args.users)
+    since = NOW - timedelta(days=1)
+    q = (
+        select(B.Message)
+        .join(B.ConvoParticipant, B.ConvoParticipant.convo_id == B.Message.convo_id)
+        .where(and_(B.ConvoParticipant.user_id == uid, B.Message.updated_at >= since))
+        .order_by(B.Message.updated_at.desc(), B.Message.id.desc())
+        .limit(B.SYNC_PAGE_DEFAULT + 1)
+    )
+    db.execute(q).scalars().all()
+
+
+def q_convos_sync(db: Session, ctx):
+    uid = rng.randint(1, args.users)
+    q = (
+        B.convo_page_query(str(uid))
+        .where(B.Convo.updated_at >= NOW - timedelta(days=7))
+        .order_by(B.Convo.updated_at.desc(), B.Convo.id.desc())
+        .limit(B.SYNC_PAGE_DEFAULT + 1)
+    )
+    [B.convo_out(c, seen, summary) for c, seen, summary in db.execute(q).all()]
+
+
+def q_change_log(db: Session, ctx):
+    uid = rng.randint(1, args.users)
+    after = rng.randint(0, args.messages)
+    q = (
+        select(B.ChangeLog.seq, B.ChangeLog.entity, B.ChangeLog.entity_id)
+        .join(B.ConvoParticipant, B.ConvoParticipant.convo_id == B.ChangeLog.convo_id)
+        .where(and_(B.ConvoParticipant.user_id == uid, B.ChangeLog.seq > after))
+        .order_by(B.ChangeLog.seq)
+        .limit(B.SYNC_PAGE_DEFAULT + 1)
+    )
+    db.execute(q).all()
+
+
+def q_idempotency(db: Session, ctx):
+    k = rng.randrange(len(ctx["senders"]))  # rowid k+1 holds local_id l{k}
+    sender = ctx["senders"][k]
+    db.execute(select(B.Message).where(and_(B.Message.sender_id == sender, B.Message.local_id == f"l{k}"))).scalar_one_or_none()
+
+
+def q_membership(db: Session, ctx):
+    cid = f"c{rng.randrange(args.convos)}"
+    db.execute(select(B.ConvoParticipant.user_id).where(B.ConvoParticipant.convo_id == cid)).all()
+
+
+QUERIES = {
+    "messages_sync_page": q_messages_sync,
+    "convos_sync_page_with_summary": q_convos_sync,
+    "change_log_after_seq": q_change_log,
+    "idempotency_lookup": q_idempotency,
+    "membership_lookup": q_membership,
+}
+
+
+def timed(fn, session_factory, ctx, runs):
+    samples = []
+    for i in range(runs + 5):
+        with session_factory() as db:
+            t0 = time.perf_counter()
+            fn(db, ctx)
+            dt = (time.perf_counter() - t0) * 1000
+        if i >= 5:  # warm-up
+            samples.append(dt)
+    samples.sort()
+    return {
+        "p50_ms": round(statistics.median(samples), 3),
+        "p95_ms": round(samples[int(len(samples) * 0.95) - 1], 3),
+        "mean_ms": round(statistics.fmean(samples), 3),
+    }
+
+
+def timed_writes(eng, n):
+    """Single-message insert + commit, the per-SEND cost without batching."""
+    convo_ids = [f"c{rng.randrange(args.convos)}" for _ in range(n)]
+    samples = []
+    for cid in convo_ids:
+        t0 = time.perf_counter()
+        with eng.begin() as conn:
+            conn.execute(insert(B.Message.__table__).values(
+                id=str(uuid4()), local_id=str(uuid4()), convo_id=cid, sender_id=None, content="bench",
+                deleted=False, created_at=NOW, updated_at=NOW))
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    return {"p50_ms": round(statistics.median(samples), 3), "p95_ms": round(samples[int(n * 0.95) - 1], 3), "commits_per_s": round(n / (sum(samples) / 1000), 1)}
+
+
+def run_suite(label, eng, ctx):
+    from sqlalchemy.orm import sessionmaker
+
+    factory = sessionmaker(bind=eng, autoflush=False)
+    out = {}
+    for name, fn in QUERIES.items():
+        out[name] = timed(fn, factory, ctx, args.runs)
+        log(f"  [{label}] {name:32s} p50={out[name]['p50_ms']:9.3f}ms p95={out[name]['p95_ms']:9.3f}ms")
+    out["single_commit"] = timed_writes(eng, args.writes)
+    log(f"  [{label}] {'single_commit':32s} p50={out['single_commit']['p50_ms']:9.3f}ms commits/s={out['single_commit']['commits_per_s']}")
+    return out
+
+
+def main():
+    members = generate()
+    with B.engine.connect() as conn:
+        senders = [r[0] for r in conn.exec_driver_sql("SELECT sender_id FROM messages ORDER BY rowid LIMIT 100000")]
+    ctx = {"members": members, "senders": senders}
+
+    # before: strip the profile and use an engine without the connect-time pragmas
+    with B.engine.begin() as conn:
+        for name in B.STORAGE_INDEXES:
+            conn.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
+    B.engine.dispose()
+    plain = create_engine(f"sqlite:///{db_path}")
+    with plain.begin() as conn:
+        conn.exec_driver_sql("PRAGMA journal_mode=DELETE")
+        conn.exec_driver_sql("ANALYZE")
+    log("before (no storage profile):")
+    before = run_suite("before", plain, ctx)
+    plain.dispose()
+
+    # after: the profile exactly as backend.py applies it
+    B.apply_storage_profile(B.engine)
+    with B.engine.begin() as conn:
+        conn.exec_driver_sql("ANALYZE")
+    log("after (storage profile):")
+    after = run_suite("after", B.engine, ctx)
+
+    result = {
+        "dataset": {"messages": args.messages, "users": args.users, "convos": args.convos, "members": args.members, "db": db_path},
+        "pragmas": B.SQLITE_PRAGMAS,
+        "indexes": B.STORAGE_INDEXES,
+        "before": before,
+        "after": after,
+        "speedup_p50": {k: round(before[k]["p50_ms"] / after[k]["p50_ms"], 2) for k in before if after[k]["p50_ms"]},
+    }
+    text = json.dumps(result, indent=2, default=str)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+"""
+Realtime benchmark for backend.py
+- Seeds auth_user, convos and convo_participants in a scratch SQLite file
+- Starts the FastAPI app in-process (uvicorn, same event loop as the clients)
+- Opens N clients on /ws (development-mode tokens: the token is the user id) and drives
+  a configurable mix of SEND_MESSAGE / UPDATE_MESSAGE / CREATE_CONVO across groups of
+  different sizes, while --sync-clients poll GET /messages/sync concurrently
+- Reports p50/p95/p99 send->receive latency per event type (ack to the sender and
+  fan-out to the other members separately), messages/s, /messages/sync latency and
+  process memory, as JSON on stdout (or --out)
+
+Server and clients share one process and one loop, so latencies include client-side
+scheduling and the memory figures cover the single worker plus the clients; compare
+runs against each other rather than against production numbers.
+
+Run:
+  python bench_ws.py --clients 200 --group-sizes 2,8,32 --duration 20 --out bench_ws.json
+  python bench_ws.py --rate-limits server   # measure with the production rate limits in place
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import resource
+import socket
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--clients", type=int, default=200, help="simulated websocket clients (one user each)")
+    p.add_argument("--group-sizes", default="2,8,32", help="comma separated convo sizes")
+    p.add_argument("--convos-per-size", type=int, default=20)
+    p.add_argument("--rate", type=float, default=2.0, help="events per second per client")
+    p.add_argument("--mix", default="send=0.85,update=0.1,create=0.05", help="relative weights of send/update/create")
+    p.add_argument("--duration", type=float, default=20.0, help="seconds of load")
+    p.add_argument("--drain", type=float, default=3.0, help="seconds to wait for in-flight events after load stops")
+    p.add_argument("--sync-clients", type=int, default=4, help="concurrent GET /messages/sync pollers")
+    p.add_argument("--sync-limit", type=int, default=100)
+    p.add_argument("--codec", choices=["json", "msgpack"], default="json", help="wire format the clients negotiate")
+    p.add_argument("--no-compression", action="store_true", help="don't offer permessage-deflate")
+    p.add_argument("--rate-limits", default="off",
+                   help='per-user limits: "off" (default, so rejections don\'t skew latency), "server" for the '
+                        'backend\'s own, or a WS_RATE_LIMITS spec such as "SEND_MESSAGE=10/30"')
+    p.add_argument("--conn-rate", type=float, help="frames/s per connection (WS_CONN_RATE, 0 = off); "
+                                                   "default: off, or the backend's with --rate-limits server")
+    p.add_argument("--admission-max", type=int, help="DB-bound handlers in flight (WS_ADMISSION_MAX); default: the backend's")
+    p.add_argument("--db", help="SQLite file to use (default: a temp file)")
+    p.add_argument("--seed", type=int, default=7)
+    p.add_argument("--out", help="write JSON results here instead of stdout")
+    return p.parse_args()
+
+
+args = parse_args()
+db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="chat-bench-ws-"), "bench.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+os.environ.pop("PUBLIC_KEY_PEM", None)  # development mode: token == user id
+if args.rate_limits not in ("off", "server"):
+    os.environ["WS_RATE_LIMITS"] = args.rate_limits
+if args.conn_rate is not None:
+    os.environ["WS_CONN_RATE"] = str(args.conn_rate)
+elif args.rate_limits == "off":
+    os.environ["WS_CONN_RATE"] = "0"
+if args.admission_max is not None:
+    os.environ["WS_ADMISSION_MAX"] = str(args.admission_max)
+
+import backend  # noqa: E402  (DATABASE_URL must be set first)
+import httpx  # noqa: E402
+import uvicorn  # noqa: E402
+import websockets  # noqa: E402
+from sqlalchemy import insert  # noqa: E402
+
+if args.codec == "msgpack":
+    import msgpack  # noqa: E402
+
+B = backend
+if args.rate_limits == "off":
+    B.rate_limiter.limits.clear()
+rng = random.Random(args.seed)
+NOW = datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def log(*a):
+    print(*a, file=sys.stderr, flush=True)
+
+
+def rss_kb() -> int:
+    """Current resident set size of this process (falls back to peak RSS off Linux)."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def percentiles(samples):
+    if not samples:
+        return {"count": 0}
+    s = sorted(samples)
+
+    def pick(q):
+        return round(s[min(len(s) - 1, max(0, int(round(q * len(s))) - 1))], 3)
+
+    return {"count": len(s), "p50_ms": pick(0.50), "p95_ms": pick(0.95), "p99_ms": pick(0.99), "max_ms": round(s[-1], 3), "mean_ms": round(statistics.fmean(s), 3)}
+
+
+def encode(data):
+    return msgpack.packb(data) if args.codec == "msgpack" else json.dumps(data)
+
+
+def decode(raw):
+    return msgpack.unpackb(raw) if isinstance(raw, bytes) else json.loads(raw)
+
+
+def parse_mix(text):
+    weights = {}
+    for part in text.split(","):
+        name, _, w = part.partition("=")
+        weights[name.strip()] = float(w or 1)
+    unknown = set(weights) - {"send", "update", "create"}
+    if unknown:
+        raise SystemExit(f"unknown ops in --mix: {sorted(unknown)}")
+    return weights
+
+
+# -----------------------------
+# Dataset
+# -----------------------------
+def seed():
+    sizes = [int(s) for s in args.group_sizes.split(",") if s.strip()]
+    if max(sizes) > args.clients:
+        raise SystemExit("--group-sizes cannot exceed --clients")
+    users = list(range(1, args.clients + 1))
+    convos, parts = [], []
+    members = {}
+    for size in sizes:
+        for k in range(args.convos_per_size):
+            cid = f"g{size}-{k}"
+            ids = rng.sample(users, size)
+            members[cid] = ids
+            convos.append({"id": cid, "title": cid, "is_group": size > 2, "seq": 0, "created_at": NOW, "updated_at": NOW})
+            parts.extend({"convo_id": cid, "user_id": u, "role": "member", "joined_at": NOW, "delivered_upto": 0, "seen_upto": 0} for u in ids)
+    with B.engine.begin() as conn:
+        conn.execute(insert(B.DjangoUser.__table__), [
+            {"id": u, "username": f"user{u}", "email": f"user{u}@example.com", "is_active": True, "date_joined": NOW} for u in users
+        ])
+        conn.execute(insert(B.Convo.__table__), convos)
+        conn.execute(insert(B.ConvoParticipant.__table__), parts)
+    log(f"seeded {len(users)} users, {len(convos)} convos (sizes {sizes}) -> {db_path}")
+    return users, members
+
+
+# -----------------------------
+# Clients
+# -----------------------------
+class Stats:
+    def __init__(self):
+        # "<op>:<id>" -> perf_counter() at send; kept until the end since every member receives it
+        self.sent_at = {}
+        self.latency = {f"{op}_{leg}": [] for op in ("send", "update", "create") for leg in ("ack", "fanout")}
+        self.sent = {"send": 0, "update": 0, "create": 0}
+        self.received = 0
+        self.received_bytes = 0  # decoded frame sizes, before compression
+        self.errors = {}
+        self.sync = []
+        self.sync_errors = 0
+
+
+class Client:
+    def __init__(self, uid: int, convos, url: str, stats: Stats):
+        self.uid = uid
+        self.convos = convos
+        self.url = url
+        self.stats = stats
+        self.own_messages = []
+        self.counter = 0
+        self.ws = None
+        self.reader = None
+
+    async def connect(self):
+        self.ws = await websockets.connect(
+            f"{self.url}?token={self.uid}", max_queue=None,
+            subprotocols=[f"chat.v1.{args.codec}"], compression=None if args.no_compression else "deflate",
+        )
+        hello = decode(await self.ws.recv())
+        assert hello.get("type") == "HELLO", hello
+        self.reader = asyncio.create_task(self.read())
+
+    async def read(self):
+        st = self.stats
+        try:
+            async for raw in self.ws:
+                now = time.perf_counter()
+                evt = decode(raw)
+                st.received += 1
+                st.received_bytes += len(raw)
+                t = evt.get("type")
+                payload = evt.get("payload") or {}
+                if t == "SEND_MESSAGE":
+                    m = payload.get("message") or {}
+                    op, key, mine = "send", f"send:{evt.get('ack_local_id')}", str(m.get("sender_id")) == str(self.uid)
+                    if mine:
+                        self.own_messages.append(m["id"])
+                elif t == "UPDATE_MESSAGE":
+                    m = payload.get("message") or {}
+                    op, key, mine = "update", f"update:{m.get('id')}", str(m.get("sender_id")) == str(self.uid)
+                elif t == "CREATE_CONVO":
+                    c = payload.get("convo") or {}
+                    op, key = "create", f"create:{c.get('id')}"
+                    mine = c.get("id", "").startswith(f"u{self.uid}-")
+                elif t == "ERROR":
+                    st.errors[evt.get("error")] = st.errors.get(evt.get("error"), 0) + 1
+                    continue
+                else:
+                    continue
+                t0 = st.sent_at.get(key)
+                if t0 is not None:
+                    st.latency[f"{op}_{'ack' if mine else 'fanout'}"].append((now - t0) * 1000)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def send(self, op: str):
+        st = self.stats
+        self.counter += 1
+        if op == "update" and self.own_messages:
+            mid = rng.choice(self.own_messages)
+            st.sent_at[f"update:{mid}"] = time.perf_counter()
+            frame = {"type": "UPDATE_MESSAGE", "payload": {"id": mid, "content": f"edit {self.counter}"}}
+        elif op == "create" or not self.convos:
+            op = "create"
+            cid = f"u{self.uid}-{self.counter}"
+            others = rng.sample(range(1, args.clients + 1), min(args.clients, rng.choice([1, 3, 7])))
+            st.sent_at[f"create:{cid}"] = time.perf_counter()
+            frame = {"type": "CREATE_CONVO", "payload": {"id": cid, "title": cid, "participants": [str(u) for u in others]}}
+        else:
+            op = "send"
+            local_id = f"b{self.uid}-{self.counter}"
+            st.sent_at[f"send:{local_id}"] = time.perf_counter()
+            frame = {"type": "SEND_MESSAGE", "payload": {"convo_id": rng.choice(self.convos), "local_id": local_id, "content": f"bench {self.counter}"}}
+        st.sent[op] += 1
+        await self.ws.send(encode(frame))
+
+    async def drive(self, deadline: float, ops, weights):
+        # stagger start so clients don't fire in lockstep
+        await asyncio.sleep(rng.random() / args.rate)
+        while time.perf_counter() < deadline:
+            await self.send(rng.choices(ops, weights)[0])
+            await asyncio.sleep(rng.expovariate(args.rate))
+
+    async def close(self):
+        await self.ws.close()
+        if self.reader:
+            await self.reader
+
+
+async def sync_poller(base: str, uid: int, deadline: float, stats: Stats):
+    since = int(time.time()) - 3600
+    async with httpx.AsyncClient(base_url=base, headers={"Authorization": f"Bearer {uid}"}) as client:
+        while time.perf_counter() < deadline:
+            t0 = time.perf_counter()
+            r = await client.get("/messages/sync", params={"since": since, "limit": args.sync_limit})
+            if r.status_code == 200:
+                stats.sync.append((time.perf_counter() - t0) * 1000)
+            else:
+                stats.sync_errors += 1
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def run():
+    users, members = seed()
+    by_user = {u: [] for u in users}
+    for cid, ids in members.items():
+        for u in ids:
+            by_user[u].append(cid)
+    weights = parse_mix(args.mix)
+    ops = list(weights)
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(B.app, host="127.0.0.1", port=port, log_level="warning", ws_max_queue=1024))
+    serve = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    url, base = f"ws://127.0.0.1:{port}/ws", f"http://127.0.0.1:{port}"
+    memory = {"rss_kb_idle": rss_kb()}
+
+    stats = Stats()
+    clients = [Client(u, by_user[u], url, stats) for u in users]
+    t0 = time.perf_counter()
+    for i in range(0, len(clients), 50):
+        await asyncio.gather(*(c.connect() for c in clients[i:i + 50]))
+    connect_s = time.perf_counter() - t0
+    memory["rss_kb_connected"] = rss_kb()
+    log(f"connected {len(clients)} clients in {connect_s:.2f}s")
+
+    start = time.perf_counter()
+    deadline = start + args.duration
+    await asyncio.gather(
+        *(c.drive(deadline, ops, [weights[o] for o in ops]) for c in clients),
+        *(sync_poller(base, rng.choice(users), deadline, stats) for _ in range(args.sync_clients)),
+    )
+    elapsed = time.perf_counter() - start
+    await asyncio.sleep(args.drain)
+    memory["rss_kb_loaded"] = rss_kb()
+    async with httpx.AsyncClient(base_url=base) as client:
+        health = (await client.get("/healthz")).json()
+
+    await asyncio.gather(*(c.close() for c in clients), return_exceptions=True)
+    server.should_exit = True
+    await serve
+    memory["rss_kb_per_connection"] = round((memory["rss_kb_connected"] - memory["rss_kb_idle"]) / max(1, len(clients)), 2)
+
+    acked = sum(len(stats.latency[f"{op}_ack"]) for op in ("send", "update", "create"))
+    result = {
+        "config": {k: v for k, v in vars(args).items() if k != "out"} | {"db": db_path},
+        "connect_s": round(connect_s, 3),
+        "duration_s": round(elapsed, 3),
+        "sent": stats.sent,
+        "acked": acked,
+        "received_frames": stats.received,
+        "received_bytes": stats.received_bytes,
+        "bytes_per_frame": round(stats.received_bytes / max(1, stats.received), 1),
+        "throughput": {
+            "sent_per_s": round(sum(stats.sent.values()) / elapsed, 1),
+            "messages_per_s": round(stats.sent["send"] / elapsed, 1),
+            "delivered_frames_per_s": round(stats.received / (elapsed + args.drain), 1),
+        },
+        "latency": {k: percentiles(v) for k, v in stats.latency.items()},
+        "messages_sync": percentiles(stats.sync) | {"errors": stats.sync_errors, "req_per_s": round(len(stats.sync) / elapsed, 1)},
+        "errors": stats.errors,
+        "memory": memory,
+        "server": health,
+    }
+    return result
+
+
+def main():
+    # keep stdout clean for the JSON, whatever the app prints while serving
+    with contextlib.redirect_stdout(sys.stderr):
+        result = asyncio.run(run())
+    for k, v in result["latency"].items():
+        if v["count"]:
+            log(f"  {k:16s} n={v['count']:7d} p50={v['p50_ms']:8.2f}ms p95={v['p95_ms']:8.2f}ms p99={v['p99_ms']:8.2f}ms")
+    log(f"  messages/s={result['throughput']['messages_per_s']} sync p50={result['messages_sync'].get('p50_ms')}ms rss={result['memory']['rss_kb_loaded']}kB")
+    text = json.dumps(result, indent=2, default=str)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,11 @@ export const WEBSOCKET_URL = `${VITE_CHAT_API_BASE_URL}/ws`;
 export const ENDPOINTS = {
   MESSAGES_SYNC: `${VITE_CHAT_API_BASE_URL}/messages/sync`,    // GET missed messages
   CONVO_SYNC: `${VITE_CHAT_API_BASE_URL}/convos/sync`,    // GET missed messages
+  CONVO_MESSAGES: (convoId) => `${VITE_CHAT_API_BASE_URL}/convos/${encodeURIComponent(convoId)}/messages`, // GET history, newest first
+  SEARCH: `${VITE_CHAT_API_BASE_URL}/search`,    // GET full-text search, best match first
+  ATTACHMENTS: `${VITE_CHAT_API_BASE_URL}/attachments`,    // POST start a chunked upload
+  ATTACHMENT: (id) => `${VITE_CHAT_API_BASE_URL}/attachments/${encodeURIComponent(id)}`, // PUT chunk (Content-Range), GET status
+  ATTACHMENT_CONTENT: (id) => `${VITE_CHAT_API_BASE_URL}/attachments/${encodeURIComponent(id)}/content`, // GET file (Range-capable)
   SEND_MESSAGE: `${VITE_CHAT_API_BASE_URL}/messages/send`,     // POST new message
   MARK_DELIVERED: `${VITE_CHAT_API_BASE_URL}/messages/delivered`, // POST mark as delivered
 };
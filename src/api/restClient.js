@@ -2,15 +2,20 @@
 import { ENDPOINTS } from "./endpoints";
 import store from "../state/store"; // <-- import your Redux store
 
-// Helper to fetch with auth header
-async function apiFetch(url, options = {}) {
+// Helper to build default headers (auth)
+function authHeaders() {
   const state = store.getState();
   const username = state.auth.currentUser?.id; // <-- pull from authSlice
 
-  const defaultHeaders = {
+  return {
     "Content-Type": "application/json",
     ...(username ? { Authorization: `${username}` } : {}), // add header if username exists
   };
+}
+
+// Helper to fetch with auth header
+async function apiFetch(url, options = {}) {
+  const defaultHeaders = authHeaders();
 
   const response = await fetch(url, {
     headers: { ...defaultHeaders, ...options.headers },
@@ -24,16 +29,87 @@ async function apiFetch(url, options = {}) {
   return response.json();
 }
 
+// Follow X-Next-Cursor until the server has no more pages
+async function apiFetchAllPages(url) {
+  const rows = [];
+  let cursor = null;
+
+  do {
+    const pageUrl = cursor ? `${url}&cursor=${encodeURIComponent(cursor)}` : url;
+    const response = await fetch(pageUrl, { headers: authHeaders() });
+
+    if (!response.ok) {
+      throw new Error(`API Error: ${response.status}`);
+    }
+
+    rows.push(...(await response.json()));
+    cursor = response.headers.get("X-Next-Cursor");
+  } while (cursor);
+
+  return rows;
+}
+
 // Fetch missed messages since last sync
 export async function fetchMissedMessagesSince(lastSync) {
   const url = `${ENDPOINTS.MESSAGES_SYNC}?since=${lastSync}`;
-  return apiFetch(url);
+  return apiFetchAllPages(url);
 }
 
 // Fetch missed conversations since last sync
 export async function fetchMissedConvosSince(lastSync) {
   const url = `${ENDPOINTS.CONVO_SYNC}?since=${lastSync}`;
-  return apiFetch(url);
+  return apiFetchAllPages(url);
+}
+
+// One page of a conversation's history, newest first. Pass the previous page's
+// next_before to load older messages; unchanged pages revalidate via ETag (304).
+export async function fetchConvoMessagesPage(convoId, before = null, limit = 50) {
+  const params = new URLSearchParams({ limit: String(limit) });
+  if (before) params.set("before", before);
+  return apiFetch(`${ENDPOINTS.CONVO_MESSAGES(convoId)}?${params}`);
+}
+
+// Search the user's conversations (optionally just one). Pass the previous
+// page's next_cursor to get the next page of results.
+export async function searchMessages(query, { convoId = null, cursor = null, limit = 20 } = {}) {
+  const params = new URLSearchParams({ q: query, limit: String(limit) });
+  if (convoId) params.set("convo_id", convoId);
+  if (cursor) params.set("cursor", cursor);
+  return apiFetch(`${ENDPOINTS.SEARCH}?${params}`);
+}
+
+// Upload a File/Blob in chunks and resolve with its attachment metadata; send the
+// returned id in a message's `attachments`. Pass `resumeId` (a previous upload's id)
+// to continue from the bytes the server already has.
+export async function uploadAttachment(file, { resumeId = null, onProgress = null } = {}) {
+  const { Authorization } = authHeaders();
+  const auth = Authorization ? { Authorization } : {};
+  let upload = resumeId
+    ? await apiFetch(ENDPOINTS.ATTACHMENT(resumeId))
+    : await apiFetch(ENDPOINTS.ATTACHMENTS, {
+        method: "POST",
+        body: JSON.stringify({ size: file.size, filename: file.name || null, content_type: file.type || null }),
+      });
+
+  while (upload.status !== "ready") {
+    const start = upload.received;
+    const end = Math.min(start + upload.chunk_max, file.size) - 1;
+    const response = await fetch(ENDPOINTS.ATTACHMENT(upload.id), {
+      method: "PUT",
+      headers: { ...auth, "Content-Type": "application/octet-stream", "Content-Range": `bytes ${start}-${end}/${file.size}` },
+      body: file.slice(start, end + 1),
+    });
+    if (response.status === 409) {
+      upload = await apiFetch(ENDPOINTS.ATTACHMENT(upload.id)); // resume from what the server has
+      continue;
+    }
+    if (!response.ok) {
+      throw new Error(`API Error: ${response.status}`);
+    }
+    upload = await response.json();
+    if (onProgress) onProgress(upload.received / upload.size);
+  }
+  return upload.attachment;
 }
 
 // Mark a message as delivered
@@ -6,6 +6,11 @@ export async function saveConversation(conversation) {
   return db.conversations.put(conversation);
 }
 
+// Merge changed fields into a stored conversation
+export async function updateConversation(id, changes) {
+  return db.conversations.update(id, changes);
+}
+
 // Get all conversations
 export async function getAllConversations() {
   // 1. Fetch all conversations
@@ -15,9 +20,19 @@ export async function getAllConversations() {
     return [];
   }
 
-  // 2. For each conversation, fetch its latest message
+  // 2. For each conversation, fetch its latest message, unless the server
+  //    already sent its chat-list summary (last_message, unread_count)
   const conversationsWithLastMessage = await Promise.all(
     conversations.map(async (conversation) => {
+      if (conversation.last_message !== undefined) {
+        const last = conversation.last_message;
+        return {
+          ...conversation,
+          lastMessage: last ? { id: last.id, sender_id: last.sender_id, content: last.preview, timestamp: last.created_at } : null,
+          unreadCount: conversation.unread_count,
+        };
+      }
+
       const lastMessage = await db.messages
         .where("convo_id")
         .equals(conversation.id)
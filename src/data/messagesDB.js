@@ -6,6 +6,20 @@ export async function saveMessage(message) {
   return db.messages.add(message);
 }
 
+// Insert or merge a message from the server, matched by server_id then local_id
+export async function upsertMessage(message) {
+  const existing =
+    (message.server_id && await db.messages.where("server_id").equals(message.server_id).first()) ||
+    (message.local_id && await db.messages.where("local_id").equals(message.local_id).first());
+  if (existing) return db.messages.update(existing.id, message);
+  return db.messages.add(message);
+}
+
+// Tombstone a message deleted on the server
+export async function markMessageDeleted(serverId) {
+  return db.messages.where("server_id").equals(serverId).modify({ deleted: true, content: null });
+}
+
 // Update message status (e.g., pending → sent)
 export async function updateMessageStatus(localId, status, serverId = null) {
   return db.messages.where("local_id").equals(localId).modify({
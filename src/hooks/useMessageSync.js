@@ -4,12 +4,13 @@ import { useDispatch, useSelector } from 'react-redux';
 import { processPendingMessages } from '@/sync/outgoingQueue';
 import { fetchMissedMessages, fetchUpdatedConversations } from '@/sync/deltaSync';
 import { loadCachedConversations } from '@/state/conversationsSlice';
+import { setNeedsResync } from '@/state/connectionSlice';
 
 export const useMessageSync = () => {
   const dispatch = useDispatch();
 
   // ✅ Directly read connection status from Redux
-  const { isOnline, wsConnected } = useSelector((state) => state.connection);
+  const { isOnline, wsConnected, needsResync } = useSelector((state) => state.connection);
 
   useEffect(() => {
     if (isOnline && wsConnected) {
@@ -18,14 +19,16 @@ export const useMessageSync = () => {
       // 1. Flush pending outgoing messages
       processPendingMessages();
 
-      // 2. Fetch updated conversations from the server
-      fetchUpdatedConversations();
-
-      // 3. Fetch missed messages from the server
-      fetchMissedMessages();
+      // 2-3. Fetch updated conversations and missed messages, unless the
+      // socket resumed and the server already replayed what we missed
+      if (needsResync) {
+        fetchUpdatedConversations();
+        fetchMissedMessages();
+        dispatch(setNeedsResync(false));
+      }
 
       // 4. Load cached conversations into Redux state
       dispatch(loadCachedConversations());
     }
-  }, [isOnline, wsConnected, dispatch]);
+  }, [isOnline, wsConnected, needsResync, dispatch]);
 };
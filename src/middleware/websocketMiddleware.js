@@ -1,33 +1,84 @@
-import { setWsConnected } from '../state/connectionSlice';
+import { setWsConnected, setNeedsResync } from '../state/connectionSlice';
 import { updateMessageStatus, addMessage } from '../state/messagesSlice';
-import { saveMessage as addMessageToDB, updateMessageStatus as updateMessageStatusInDB } from '../data/messagesDB';
-import { receiveConversation } from '@/state/conversationsSlice';
+import { saveMessage as addMessageToDB, updateMessageStatus as updateMessageStatusInDB, getPendingMessages, upsertMessage, markMessageDeleted } from '../data/messagesDB';
+import { receiveConversation, updateChat, updateLastMessage } from '@/state/conversationsSlice';
+import { updateConversation } from '@/data/conversationsDB';
 import {WEBSOCKET_URL} from '@/api/endpoints'
+import { BULK_SEND_MAX } from '@/utils/constants'
 
 // Action type constants
 const WS_CONNECT = 'connection/initWebSocket';
 const WS_DISCONNECT = 'connection/closeWebSocket';
 const SEND_MESSAGE = 'messages/sendMessage/pending';
 const RESEND_PENDING = 'messages/resendPending'
+const RESEND_PENDING_BATCH = 'messages/resendPendingBatch'
 const CREATE_CHAT = 'chats/createConversation'
 
 let reconnectAttempts = 0;
 let reconnectTimer = null;
+// Resume point for the server's replay buffer (see HELLO / RESUMED / RESYNC_REQUIRED)
+let streamId = null;
+let lastEventId = null;
+// One outbox replay scheduled after a RATE_LIMITED error
+let rateLimitTimer = null;
+
+// Server message event -> client message shape (server id kept as server_id,
+// IndexedDB assigns its own primary key)
+const toClientMessage = ({ id, ...m }) => ({
+  ...m,
+  server_id: id,
+  timestamp: Date.parse(m.created_at),
+  status: 'sent',
+});
 
 export const websocketMiddleware = store => {
   let socket = null;
 
+  // A sent message leaves the outbox (status 'pending') once the server acks it
+  const markSent = async (convoId, localId, serverId) => {
+    store.dispatch(updateMessageStatus({ chatId: convoId, localId, status: 'sent', serverId }));
+    await updateMessageStatusInDB(localId, 'sent', serverId);
+  };
+
+  // Live and replayed message events from any sender (other users, our other
+  // devices) land in IndexedDB and the store; a resume relies on this instead of REST sync
+  const applyMessage = async (event) => {
+    const message = toClientMessage(event);
+    await upsertMessage(message);
+    store.dispatch(addMessage({ chatId: message.convo_id, message }));
+    store.dispatch(updateLastMessage({ chatId: message.convo_id, message }));
+  };
+
+  const applyDelete = async ({ id, convo_id }) => {
+    await markMessageDeleted(id);
+    const cached = store.getState().messages.byChatId[convo_id] || [];
+    if (cached.some((m) => m.server_id === id)) {
+      store.dispatch(addMessage({ chatId: convo_id, message: { server_id: id, convo_id, deleted: true, content: null } }));
+    }
+  };
+
+  // CREATE_CONVO also announces joins to an existing convo: merge, don't replace
+  const applyConvo = async (convo) => {
+    if (!store.getState().conversations.chats[convo.id]) {
+      await store.dispatch(receiveConversation(convo));
+      return;
+    }
+    await updateConversation(convo.id, convo);
+    store.dispatch(updateChat(convo));
+  };
+
   const connect = () => {
     if (socket && socket.readyState === WebSocket.OPEN) return;
     const state = store.getState();
   const currentUser = state.auth.currentUser;   // <-- access via store
   const token = currentUser?.token || currentUser?.id;
-    socket = new WebSocket(`${WEBSOCKET_URL}?token=${token}`);
+    const resume = streamId && lastEventId !== null ? `&last_event_id=${lastEventId}&stream_id=${streamId}` : '';
+    socket = new WebSocket(`${WEBSOCKET_URL}?token=${token}${resume}`);
 
     socket.onopen = async () => {
       console.log('[WS] Connected');
       reconnectAttempts = 0;
-      store.dispatch(setWsConnected(true));
+      // connected state is set once HELLO (and RESUMED / RESYNC_REQUIRED) arrive
     };
 
     socket.onclose = () => {
@@ -41,39 +92,125 @@ export const websocketMiddleware = store => {
       // socket.close();
     };
 
-    socket.onmessage = async (event) => {
+    // Events are applied one at a time, in arrival order, so an edit or delete
+    // never lands before the send it refers to
+    let applying = Promise.resolve();
+    socket.onmessage = (event) => {
       const data = JSON.parse(event.data);
+      applying = applying
+        .then(() => handleEvent(data, resume))
+        .catch((error) => console.error('[WS] Failed to apply event', data.type, error));
+    };
+  };
+
+  const handleEvent = async (data, resume) => {
+    switch (data.type) {
+      case 'HELLO':
+        if (!resume || data.stream_id !== streamId) {
+          // fresh session: REST sync, then follow live events from here
+          streamId = data.stream_id;
+          lastEventId = data.event_id;
+          store.dispatch(setNeedsResync(true));
+          store.dispatch(setWsConnected(true));
+        }
+        break;
+
+      case 'RESUMED':
+        console.log(`[WS] Resumed, ${data.replayed} missed events replayed`);
+        store.dispatch(setWsConnected(true));
+        break;
+
+      case 'RESYNC_REQUIRED':
+        lastEventId = data.event_id;
+        store.dispatch(setNeedsResync(true));
+        store.dispatch(setWsConnected(true));
+        break;
+
+      case 'MESSAGE_RECEIVED':
+        // 1. Save to IndexedDB
+        await addMessageToDB(data.message);
+
+        // 2. Update Redux
+        store.dispatch(addMessage({ chatId: data.message.convo_id, message: data.message }));
+        break;
+
+      case 'MESSAGE_ACK':
+        // Update Redux state
+        store.dispatch(updateMessageStatus({
+          chatId: data.convo_id,
+          localId: data.local_id,
+          status: 'sent',
+          serverId: data.server_id
+        }));
+
+        // Update IndexedDB
+        await updateMessageStatusInDB(data.local_id, { status: 'sent', server_id: data.server_id })
+        break;
 
-      switch (data.type) {
-        case 'MESSAGE_RECEIVED':
-          // 1. Save to IndexedDB
-          await addMessageToDB(data.message);
-
-          // 2. Update Redux
-          store.dispatch(addMessage({ chatId: data.message.convo_id, message: data.message }));
-          break;
-
-        case 'MESSAGE_ACK':
-          // Update Redux state
-          store.dispatch(updateMessageStatus({
-            chatId: data.convo_id,
-            localId: data.local_id,
-            status: 'sent',
-            serverId: data.server_id
-          }));
-
-          // Update IndexedDB
-          await updateMessageStatusInDB(data.local_id, { status: 'sent', server_id: data.server_id })
-          break;
-
-        case 'CREATE_CHAT':
-          store.dispatch(receiveConversation(data))
-          break;
-
-        default:
-          console.warn('[WS] Unknown message type:', data.type, data);
+      case 'SEND_MESSAGE':
+      case 'SEND_MESSAGES': {
+        // the broadcast of our own send is its ack (ack_local_id / ack_local_ids)
+        const me = String(store.getState().auth.currentUser?.id);
+        const acked = new Set(data.type === 'SEND_MESSAGE' ? [data.ack_local_id] : data.ack_local_ids);
+        const messages = data.type === 'SEND_MESSAGE' ? [data.payload.message] : data.payload.messages;
+        for (const m of messages) {
+          if (acked.has(m.local_id) && String(m.sender_id) === me) await markSent(m.convo_id, m.local_id, m.id);
+          else await applyMessage(m);
+        }
+        break;
       }
-    };
+
+      case 'UPDATE_MESSAGE':
+        await applyMessage(data.payload.message);
+        break;
+
+      case 'DELETE_MESSAGE':
+        await applyDelete(data.payload);
+        break;
+
+      case 'CREATE_CONVO':
+      case 'UPDATE_CONVO':
+        await applyConvo(data.payload.convo);
+        break;
+
+      case 'RECEIPTS':
+      case 'TYPING':
+      case 'PRESENCE':
+        break;
+
+      case 'CREATE_CHAT':
+        store.dispatch(receiveConversation(data))
+        break;
+
+      case 'ERROR':
+        if (data.code === 'RATE_LIMITED') {
+          console.warn(`[WS] Rate limited (${data.event}), retry after ${data.retry_after}s`);
+          // rejected sends stay pending in IndexedDB; replay them once the server allows it.
+          // Other events (TYPING, FRAME, CREATE_CONVO, ...) are not replayed: resending the
+          // outbox for them would only spend more SEND_MESSAGES tokens
+          const isSend = data.event === 'SEND_MESSAGE' || data.event === 'SEND_MESSAGES';
+          if (isSend && !rateLimitTimer) {
+            rateLimitTimer = setTimeout(async () => {
+              rateLimitTimer = null;
+              const pending = await getPendingMessages();
+              if (pending.length > 0) store.dispatch({ type: RESEND_PENDING_BATCH, payload: pending });
+            }, Math.ceil(data.retry_after * 1000));
+          }
+        } else {
+          console.warn('[WS] Server error:', data.error, data);
+        }
+        break;
+
+      default:
+        console.warn('[WS] Unknown message type:', data.type, data);
+    }
+
+    // Resume from the highest event_id applied, never from a later but lower one.
+    // The server queues replayable events in event_id order, so every earlier event
+    // for this user has arrived (or was superseded by a later one we have)
+    if (data.event_id !== undefined && data.type !== 'HELLO' && data.type !== 'RESYNC_REQUIRED' && (lastEventId === null || data.event_id > lastEventId)) {
+      lastEventId = data.event_id;
+    }
   };
 
   const retryConnection = () => {
@@ -118,6 +255,17 @@ export const websocketMiddleware = store => {
           console.log('[WS] Not connected. Message will be sent later.');
         }
         break;
+      case RESEND_PENDING_BATCH:
+        console.log("Resending pending batch: ", action.payload.length)
+        if (socket && socket.readyState === WebSocket.OPEN) {
+          // the server rejects frames of more than BULK_SEND_MAX messages
+          for (let i = 0; i < action.payload.length; i += BULK_SEND_MAX) {
+            socket.send(JSON.stringify({ type: 'SEND_MESSAGES', payload: { messages: action.payload.slice(i, i + BULK_SEND_MAX) } }));
+          }
+        } else {
+          console.log('[WS] Not connected. Messages will be sent later.');
+        }
+        break;
       case CREATE_CHAT:
         if (socket && socket.readyState === WebSocket.OPEN) {
           socket.send(JSON.stringify({ type: CREATE_CHAT, payload: action.payload }));
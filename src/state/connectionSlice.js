@@ -2,7 +2,9 @@ import { createSlice } from '@reduxjs/toolkit';
 
 const initialState = {
   isOnline: navigator.onLine,
-  wsConnected: false
+  wsConnected: false,
+  // false only after the server replayed everything missed while disconnected
+  needsResync: true
 };
 
 const connectionSlice = createSlice({
@@ -17,11 +19,14 @@ const connectionSlice = createSlice({
     },
     setWsConnected: (state, action) => {
       state.wsConnected = action.payload;
+    },
+    setNeedsResync: (state, action) => {
+      state.needsResync = action.payload;
     }
   }
 });
 
-export const { setOnlineStatus, setWsConnected, setNetworkStatus } = connectionSlice.actions;
+export const { setOnlineStatus, setWsConnected, setNetworkStatus, setNeedsResync } = connectionSlice.actions;
 
 // Thunks for controlling WebSocket
 export const initWebSocket = (url) => ({
@@ -173,7 +173,7 @@ const messagesSlice = createSlice({
       const { chatId, localId, serverId } = action.payload;
       if (!state.byChatId[chatId]) return;
       state.byChatId[chatId] = state.byChatId[chatId].filter(
-        (m) => !(m.local_id === localId || (serverId && m.server_id === serverId))
+        (m) => !((localId && m.local_id === localId) || (serverId && m.server_id === serverId))
       );
     }
   },
@@ -44,8 +44,7 @@ export const fetchMissedMessages = async () => {
   console.log(`[SYNC] Fetching messages since ${lastTimestamp}`);
 
   // Pass user_id to the API
-  const response = await fetchMissedMessagesSince(lastTimestamp);
-  const newMessages = response.data || [];
+  const newMessages = await fetchMissedMessagesSince(lastTimestamp);
 
   if (!Array.isArray(newMessages) || newMessages.length === 0) {
     console.log('[SYNC] No new messages from server.');
@@ -11,10 +11,11 @@ export async function processPendingMessages() {
     console.log(`[WS] Flushing ${pending.length} pending messages`);
   }
 
-  for (const message of pending) {
-    store.dispatch({
-      type: 'messages/resendPending',
-      payload: message
-    });
-  }
+  if (pending.length === 0) return;
+
+  // Replay the whole outbox as SEND_MESSAGES frames of at most BULK_SEND_MAX messages
+  store.dispatch({
+    type: 'messages/resendPendingBatch',
+    payload: pending
+  });
 }
\ No newline at end of file
@@ -0,0 +1,4 @@
+// utils/constants.js
+
+// Most messages the server accepts in one SEND_MESSAGES frame (backend BULK_SEND_MAX)
+export const BULK_SEND_MAX = 500;
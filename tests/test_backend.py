@@ -0,0 +1,406 @@
+"""
+Invariant tests for backend.py on a scratch SQLite file.
+
+Run:
+  python -m pytest -q tests
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import zlib
+from uuid import uuid4
+
+import pytest
+
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="chat-test-"), "test.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import backend as B  # noqa: E402  (DATABASE_URL must be set first)
+from sqlalchemy import func, insert, select  # noqa: E402
+
+USERS = ["1", "2", "3", "4"]
+
+
+@pytest.fixture(scope="module", autouse=True)
+def users():
+    with B.engine.begin() as conn:
+        conn.execute(insert(B.DjangoUser.__table__), [
+            {"id": int(u), "username": f"user{u}", "email": f"user{u}@example.com", "is_active": True, "date_joined": B.datetime.now()}
+            for u in USERS
+        ])
+
+
+def call(fn, *args):
+    with B.SessionLocal() as db:
+        return fn(db, *args)
+
+
+def new_convo(owner="1", participants=("2",)):
+    convo_id = str(uuid4())
+    call(B.db_create_convo, owner, {"id": convo_id, "title": "t", "participants": list(participants)})
+    return convo_id
+
+
+def send(sender, convo_id, content="hello"):
+    [m] = call(B.db_commit_messages, [{"sender_id": sender, "convo_id": convo_id, "local_id": str(uuid4()), "content": content}])
+    assert not isinstance(m, B.WSError), m
+    return m
+
+
+def archive_convo(convo_id):
+    """Archive every hot message so far (the convo's included), as `archive` would once they age."""
+    B.archive_messages(B.engine, B.datetime.now(B.timezone.utc) + B.timedelta(seconds=1))
+    with B.SessionLocal() as db:
+        assert db.execute(select(func.count()).select_from(B.Message).where(B.Message.convo_id == convo_id)).scalar() == 0
+
+
+def change_seqs(convo_id):
+    with B.SessionLocal() as db:
+        q = select(B.ChangeLog.convo_seq).where(B.ChangeLog.convo_id == convo_id).order_by(B.ChangeLog.convo_seq)
+        return list(db.execute(q).scalars()), db.get(B.Convo, convo_id).seq
+
+
+def run_concurrently(calls):
+    barrier = threading.Barrier(len(calls))
+    errors = []
+
+    def worker(fn, *args):
+        barrier.wait()
+        try:
+            call(fn, *args)
+        except Exception as e:  # collected and asserted on below
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=c) for c in calls]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return errors
+
+
+def test_concurrent_writers_get_gap_free_seqs():
+    convo_id = new_convo()
+    m = send("1", convo_id)
+    calls = []
+    for i in range(8):
+        if i % 2:
+            calls.append((B.db_update_message, "1", {"id": m["id"], "content": f"edit {i}"}))
+        else:
+            calls.append((B.db_update_convo, "1", {"id": convo_id, "title": f"title {i}"}))
+    calls.append((B.db_commit_messages, [{"sender_id": "2", "convo_id": convo_id, "local_id": str(uuid4()), "content": "x"} for _ in range(3)]))
+    assert run_concurrently(calls) == []
+    seqs, head = change_seqs(convo_id)
+    assert seqs == list(range(1, head + 1))
+    assert head == 2 + 8 + 3  # create, send, 8 updates, 3 sends
+
+
+def test_edit_is_ordered_with_its_convo_without_convo_id():
+    convo_id = new_convo()
+    m = send("1", convo_id)
+    B.message_convos.entries.clear()  # force the DB lookup
+    keys = asyncio.run(B.message_keys({"id": m["id"], "content": "edit"}))
+    assert keys == [f"message:{m['id']}", f"convo:{convo_id}"]
+    assert asyncio.run(B.message_keys({"id": "no-such-message"})) == ["message:no-such-message"]
+
+
+def test_coalesced_frame_keeps_broadcast_order():
+    conn = B.ClientConnection("1", None, max_queue=4, policy="coalesce")
+    conn.send(b"update 2", key="message:m")
+    conn.send(b"send 3")
+    conn.send(b"update 4", key="message:m")
+    assert [frame for _, frame in conn.queue if frame is not None] == [b"send 3", b"update 4"]
+    for i in range(20):
+        conn.send(f"update {5 + i}".encode(), key="message:m")
+    assert conn.queued() == 2 and len(conn.queue) <= 2 + conn.max_queue + 1
+    assert [frame for _, frame in conn.queue if frame is not None] == [b"send 3", b"update 24"]
+
+
+def test_replay_eviction_records_are_bounded():
+    buf = B.ReplayBuffer(size=2, max_age=10, max_users=100)
+    event = B.OutboundEvent({"type": "X"})
+    for user in range(50):
+        buf.add(str(user), buf.next_id(), event, None, now=0)
+        buf.add(str(user), buf.next_id(), event, None, now=0)
+        buf.add(str(user), buf.next_id(), event, None, now=0)  # evicts the first
+    assert len(buf.lost) == 50
+    assert buf.since("7", 21) is None  # 22 was evicted
+    assert [e[0] for e in buf.since("7", 22)] == [23, 24]
+    buf.add("new", buf.next_id(), event, None, now=11)
+    buf.prune(now=11)
+    assert buf.lost == {str(u): (3 * u + 3, 11) for u in range(50)}  # rings aged out whole
+    buf.prune(now=22)
+    assert list(buf.lost) == ["new"] and len(buf.rings) == 0  # only the newest record is kept
+    assert buf.floor == 150
+    assert buf.since("7", 24) is None  # forgotten, but still refused below the floor
+    assert buf.since("someone", buf.last_id) == []
+
+
+def test_resend_of_archived_message_is_a_duplicate():
+    convo_id = new_convo()
+    item = {"sender_id": "1", "convo_id": convo_id, "local_id": str(uuid4()), "content": "old"}
+    [first] = call(B.db_commit_messages, [item])
+    archive_convo(convo_id)
+    _, head = change_seqs(convo_id)
+    fresh = {**item, "local_id": str(uuid4())}
+    again, new = call(B.db_commit_messages, [item, fresh])
+    assert again["id"] == first["id"] and again["content"] == "old"
+    assert new["id"] != first["id"]
+    assert change_seqs(convo_id)[1] == head + 1
+
+
+def summary_rows():
+    with B.engine.connect() as conn:
+        return sorted(tuple(r) for r in conn.execute(select(B.ConvoSummary.__table__)).all())
+
+
+def assert_summaries_match_rebuild():
+    incremental = summary_rows()
+    B.rebuild_summaries(B.engine)
+    assert incremental == summary_rows()
+
+
+def seen(user, convo_id, upto, event_type=B.EventType.MESSAGE_SEEN):
+    call(B.db_receipt, user, event_type, {"convo_id": convo_id, "upto_seq": upto})
+
+
+def test_incremental_summaries_match_rebuild():
+    convo_id = new_convo("1", ("2", "3"))
+    assert_summaries_match_rebuild()
+
+    m1, m2, m3 = (send("1", convo_id, f"from 1 #{i}") for i in range(3))
+    batch = [{"sender_id": "2", "convo_id": convo_id, "local_id": str(uuid4()), "content": f"from 2 #{i}"} for i in range(2)]
+    b1, b2 = call(B.db_commit_messages, batch)
+    assert_summaries_match_rebuild()
+
+    # a resent batch is answered from the stored rows and counts nothing twice
+    call(B.db_commit_messages, batch + [batch[0]])
+    assert_summaries_match_rebuild()
+
+    seen("2", convo_id, m2["seq"])
+    seen("3", convo_id, b1["seq"], B.EventType.MESSAGE_DELIVERED)
+    seen("2", convo_id, m1["seq"])  # watermarks never move back
+    assert_summaries_match_rebuild()
+
+    call(B.db_update_message, "1", {"id": m3["id"], "content": "edited, not last"})
+    call(B.db_update_message, "2", {"id": b2["id"], "content": "edited, last"})
+    assert_summaries_match_rebuild()
+
+    call(B.db_delete_message, "1", {"id": m3["id"]})  # unread for 2 and 3
+    call(B.db_delete_message, "1", {"id": m1["id"]})  # already seen by 2
+    call(B.db_delete_message, "2", {"id": b2["id"]})  # the last message
+    call(B.db_delete_message, "2", {"id": b2["id"]})  # again
+    assert_summaries_match_rebuild()
+
+    call(B.db_create_convo, "1", {"id": convo_id, "participants": ["4"]})  # joins with history
+    seen("3", convo_id, b1["seq"])
+    assert_summaries_match_rebuild()
+
+
+def test_summaries_match_rebuild_across_the_archive():
+    convo_id = new_convo("1", ("2",))
+    old = [send(u, convo_id, f"old {i}") for i, u in enumerate(["1", "2", "1", "2"])]
+    seen("2", convo_id, old[0]["seq"])
+    archive_convo(convo_id)
+    assert_summaries_match_rebuild()
+
+    new = send("2", convo_id, "new")
+    seen("1", convo_id, old[2]["seq"])  # reads archived messages only
+    assert_summaries_match_rebuild()
+
+    call(B.db_create_convo, "1", {"id": convo_id, "participants": ["3"]})  # joins with archived history
+    seen("3", convo_id, new["seq"])  # reads across both tiers
+    assert_summaries_match_rebuild()
+
+    call(B.db_delete_message, "2", {"id": new["id"]})  # last message falls back to the archive
+    assert_summaries_match_rebuild()
+
+
+def test_concurrent_writes_keep_summaries_exact():
+    convo_id = new_convo("1", ("2", "3"))
+    msgs = [send("1", convo_id, f"m{i}") for i in range(6)]
+    calls = [(B.db_delete_message, "1", {"id": msgs[-1]["id"]}) for _ in range(4)]
+    calls += [(B.db_receipt, "2", B.EventType.MESSAGE_SEEN, {"convo_id": convo_id, "upto_seq": m["seq"]}) for m in msgs]
+    calls += [(B.db_commit_messages, [{"sender_id": "3", "convo_id": convo_id, "local_id": str(uuid4()), "content": "c"}]) for _ in range(4)]
+    assert run_concurrently(calls) == []
+    assert_summaries_match_rebuild()
+
+
+# the tables as the first release created them, before seq and the change log
+OLD_SCHEMA = """
+CREATE TABLE auth_user (id INTEGER PRIMARY KEY, username VARCHAR, email VARCHAR, is_active BOOLEAN, date_joined DATETIME);
+CREATE TABLE convos (id VARCHAR PRIMARY KEY, local_id VARCHAR, title VARCHAR, is_group BOOLEAN,
+    created_at DATETIME, updated_at DATETIME);
+CREATE TABLE convo_participants (id INTEGER PRIMARY KEY AUTOINCREMENT, convo_id VARCHAR REFERENCES convos (id) ON DELETE CASCADE,
+    user_id INTEGER REFERENCES auth_user (id) ON DELETE CASCADE, role VARCHAR, joined_at DATETIME, last_read_at DATETIME,
+    CONSTRAINT uq_convo_user UNIQUE (convo_id, user_id));
+CREATE TABLE messages (id VARCHAR PRIMARY KEY, local_id VARCHAR, convo_id VARCHAR REFERENCES convos (id) ON DELETE CASCADE,
+    sender_id INTEGER REFERENCES auth_user (id) ON DELETE SET NULL, content TEXT, deleted BOOLEAN,
+    created_at DATETIME, updated_at DATETIME, CONSTRAINT uq_sender_local_id UNIQUE (sender_id, local_id));
+CREATE TABLE message_deliveries (id INTEGER PRIMARY KEY AUTOINCREMENT, message_id VARCHAR REFERENCES messages (id) ON DELETE CASCADE,
+    user_id INTEGER REFERENCES auth_user (id) ON DELETE CASCADE, delivered_at DATETIME, seen_at DATETIME,
+    CONSTRAINT uq_message_user UNIQUE (message_id, user_id));
+INSERT INTO auth_user (id, username) VALUES (1, 'user1'), (2, 'user2');
+INSERT INTO convos VALUES ('c', NULL, 'old', 0, '2024-01-01 00:00:00', '2024-01-02 00:00:00');
+INSERT INTO convo_participants (convo_id, user_id, role) VALUES ('c', 1, 'member'), ('c', 2, 'member');
+INSERT INTO messages VALUES
+    ('m2', 'l2', 'c', 2, 'second', 0, '2024-01-01 00:00:02', '2024-01-01 00:00:02'),
+    ('m1', 'l1', 'c', 1, 'first', 0, '2024-01-01 00:00:01', '2024-01-01 00:00:01'),
+    ('m3', 'l3', 'c', 1, 'third', 0, '2024-01-01 00:00:03', '2024-01-01 00:00:03');
+INSERT INTO message_deliveries (message_id, user_id, delivered_at, seen_at) VALUES
+    ('m1', 2, '2024-01-01 00:00:05', '2024-01-01 00:00:05'), ('m3', 2, '2024-01-01 00:00:05', NULL);
+"""
+
+
+def test_upgrade_of_an_old_database():
+    eng = B.make_engine("sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="chat-old-"), "chat.db"))
+    raw = eng.raw_connection()
+    raw.executescript(OLD_SCHEMA)
+    raw.close()
+    for _ in range(2):  # a second start finds nothing to do
+        B.Base.metadata.create_all(bind=eng)
+        B.upgrade_schema(eng)
+        B.apply_storage_profile(eng)
+    with eng.connect() as conn:
+        seqs = dict(conn.execute(select(B.Message.id, B.Message.seq)).all())
+        log = conn.execute(select(B.ChangeLog.convo_seq, B.ChangeLog.entity, B.ChangeLog.entity_id).order_by(B.ChangeLog.convo_seq)).all()
+        assert conn.execute(select(B.Convo.seq)).scalar() == 4
+        marks = conn.execute(select(B.ConvoParticipant.user_id, B.ConvoParticipant.delivered_upto, B.ConvoParticipant.seen_upto)).all()
+    assert seqs == {"m1": 2, "m2": 3, "m3": 4}
+    assert log == [(1, "convo", "c"), (2, "message", "m1"), (3, "message", "m2"), (4, "message", "m3")]
+    assert sorted(marks) == [(1, 0, 0), (2, 4, 2)]  # from message_deliveries
+
+
+def test_sync_brings_history_to_a_late_joiner():
+    convo_id = new_convo("1", ("2",))
+    old = [send("1", convo_id, f"before {i}") for i in range(3)]
+    with B.SessionLocal() as db:
+        after_seq = db.execute(select(func.max(B.ChangeLog.seq))).scalar()
+    call(B.db_create_convo, "1", {"id": convo_id, "participants": ["3"]})
+    new = send("2", convo_id, "after")
+
+    with B.SessionLocal() as db:
+        user = B.AuthedUser(user_id="3", raw_claims={})
+        out = B.sync_changes(after_seq=after_seq, limit=100, user=user, db=db)
+        assert [m.id for m in out.messages] == [m["id"] for m in old + [new]]
+        assert [c.id for c in out.convos] == [convo_id]
+        # a caller already in the convo only gets what changed
+        out = B.sync_changes(after_seq=after_seq, limit=100, user=B.AuthedUser(user_id="2", raw_claims={}), db=db)
+        assert [m.id for m in out.messages] == [new["id"]]
+
+
+def test_convo_delta_sync_sees_summary_changes():
+    convo_id = new_convo("1", ("2",))
+    msgs = [send("1", convo_id, f"m{i}") for i in range(3)]
+    user = B.AuthedUser(user_id="2", raw_claims={})
+
+    def delta(since):
+        with B.SessionLocal() as db:
+            rows = B.get_convos(B.Response(), since=str(since), cursor=None, limit=100, stream=False, user=user, db=db)
+            return {c.id: (c.unread_count, c.message_count) for c in rows}
+
+    since = B.time.time()
+    B.time.sleep(0.01)
+    seen("2", convo_id, msgs[-1]["seq"])
+    assert delta(since) == {convo_id: (0, 3)}
+
+    since = B.time.time()
+    B.time.sleep(0.01)
+    call(B.db_delete_message, "1", {"id": msgs[0]["id"]})  # not the last message
+    assert delta(since) == {convo_id: (0, 2)}
+
+
+def test_membership_load_racing_a_join_is_not_cached():
+    convo_id = new_convo("1", ("2",))
+    index = B.MembershipIndex(max_entries=4)
+
+    class JoinDuringRead:
+        """A session whose read finishes before a concurrent join commits."""
+        def __init__(self, db):
+            self.db = db
+
+        def execute(self, q):
+            rows = self.db.execute(q)
+            call(B.db_create_convo, "1", {"id": convo_id, "participants": ["3"]})
+            index.add_members(convo_id, ["3"])
+            return rows
+
+    with B.SessionLocal() as db:
+        assert index.load_members(JoinDuringRead(db), convo_id) == {"1", "2"}  # stale, but not cached
+        assert index.cached_members(convo_id) is None
+        assert index.members(db, convo_id) == {"1", "2", "3"}
+        assert index.cached_members(convo_id) == {"1", "2", "3"}
+
+    for i in range(20):  # forgotten generations still refuse an older load
+        index.invalidate(user_id=str(100 + i))
+    assert len(index.generations) <= 8 and index.generation_floor > 0
+    generation = index.generation(index.members_by_convo, "evicted")
+    index.invalidate(convo_id="evicted")
+    for i in range(20):
+        index.invalidate(user_id=str(200 + i))
+    index._put(index.members_by_convo, "evicted", {"1"}, generation)
+    assert index.cached_members("evicted") is None
+
+
+
+
+def test_search_index_setup_races_and_only_falls_back_without_fts5(monkeypatch):
+    import sqlite3
+
+    path = os.path.join(tempfile.mkdtemp(prefix="chat-fts-"), "chat.db")
+    eng = B.make_engine("sqlite:///" + path)
+    B.Base.metadata.create_all(bind=eng)
+    raced = []
+
+    @B.sqla_event.listens_for(eng, "before_cursor_execute")
+    def other_worker_creates_it_first(conn, cursor, statement, *args):
+        if statement.startswith("CREATE VIRTUAL TABLE") and not raced:
+            raced.append(statement)
+            with sqlite3.connect(path) as other:
+                other.execute("CREATE VIRTUAL TABLE messages_fts USING fts5(content, message_id UNINDEXED)")
+
+    assert isinstance(B.make_search_index(eng), B.Fts5SearchIndex)
+    assert raced
+
+    def fails(message):
+        def setup(self, bind):
+            raise B.OperationalError("CREATE VIRTUAL TABLE", None, Exception(message))
+        return setup
+
+    monkeypatch.setattr(B.Fts5SearchIndex, "setup", fails("no such module: fts5"))
+    assert isinstance(B.make_search_index(eng), B.LikeSearchIndex)
+    monkeypatch.setattr(B.Fts5SearchIndex, "setup", fails("database is locked"))
+    with pytest.raises(B.OperationalError):
+        B.make_search_index(eng)
+
+
+def test_archived_message_can_be_deleted():
+    convo_id = new_convo("1", ("2",))
+    old = [send("1", convo_id, f"secret {i}") for i in range(3)]
+    archive_convo(convo_id)
+    _, head = change_seqs(convo_id)
+
+    with pytest.raises(B.WSError, match="Forbidden"):
+        call(B.db_delete_message, "2", {"id": old[1]["id"]})
+    with pytest.raises(B.WSError, match="archived"):
+        call(B.db_update_message, "1", {"id": old[1]["id"], "content": "edit"})
+
+    _, evt, _ = call(B.db_delete_message, "1", {"id": old[1]["id"]})
+    assert evt["payload"] == {"id": old[1]["id"], "convo_id": convo_id, "convo_seq": head + 1}
+    assert_summaries_match_rebuild()
+    call(B.db_delete_message, "1", {"id": old[2]["id"]})  # the last message
+    call(B.db_delete_message, "1", {"id": old[2]["id"]})  # again
+    assert_summaries_match_rebuild()
+    assert change_seqs(convo_id)[1] == head + 3
+
+    with B.SessionLocal() as db:
+        got = B.messages_by_id(db, [m["id"] for m in old])
+        assert [(got[m["id"]].deleted, got[m["id"]].content) for m in old] == [(False, "secret 0"), (True, None), (True, None)]
+        assert [m.id for m in B.archive.history(db, convo_id, None, 10)] == [m["id"] for m in reversed(old)]
+        if isinstance(B.search_index, B.Fts5SearchIndex):  # LIKE does not search the archive
+            assert [m.id for m in B.search_index.search(db, [convo_id], ["secret"], 10, 0)] == [old[0]["id"]]
+        blobs = b"".join(zlib.decompress(d) for d in db.execute(select(B.MessageArchiveSegment.data).where(B.MessageArchiveSegment.convo_id == convo_id)).scalars())
+    assert b"secret 0" in blobs and b"secret 1" not in blobs and b"secret 2" not in blobs